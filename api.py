@@ -1,30 +1,41 @@
 from flask import Flask, jsonify, request
-from utils import log_event
+from utils import log_event, log_writer
 from message_log import log_message
-from database import save_message, get_messages, get_channels, create_channel
+from database import query_messages, search_messages
+from channel_cache import channel_registry
+from persistence import message_writer
+from push import push_manager
+from compression import compression_stats
 from datetime import datetime
 
 app = Flask(__name__)
 
 @app.route('/api/channels', methods=['GET'])
 def get_channels_api():
-    channels = get_channels()
-    log_event(f"API: Lấy danh sách kênh: {channels}")
-    return jsonify(channels)
+    log_event("API: Lấy danh sách kênh")
+    return app.response_class(channel_registry.payload(), mimetype='application/json')
 
 @app.route('/api/channels/<channel>/messages', methods=['GET'])
 def get_messages_api(channel):
-    if channel not in get_channels():
+    if not channel_registry.contains(channel):
         log_event(f"API: Kênh {channel} không tìm thấy")
         return jsonify({"error": "Kênh không tìm thấy"}), 404
-    messages = get_messages(channel)
+    # Phân trang keyset tùy chọn: ?limit=N lấy N tin mới nhất, kèm before=<id> hoặc after=<id>
+    try:
+        limit = int(request.args['limit']) if 'limit' in request.args else None
+        before = int(request.args['before']) if 'before' in request.args else None
+        after = int(request.args['after']) if 'after' in request.args else None
+    except ValueError:
+        return jsonify({"error": "Tham số phân trang không hợp lệ"}), 400
+    messages = query_messages(channel, before_id=before, after_id=after, limit=limit,
+                              newest_first=after is None and limit is not None, active_only=True)
     formatted_messages = [f"{msg['sender']}: {msg['message']} [{msg['timestamp']}]" for msg in messages]
     log_event(f"API: Lấy {len(messages)} tin nhắn cho kênh {channel}")
     return jsonify(formatted_messages)
 
 @app.route('/api/channels/<channel>/messages', methods=['POST'])
 def post_message(channel):
-    if channel not in get_channels():
+    if not channel_registry.contains(channel):
         log_event(f"API: Kênh {channel} không tìm thấy")
         return jsonify({"error": "Kênh không tìm thấy"}), 404
     data = request.get_json()
@@ -35,10 +46,32 @@ def post_message(channel):
     sender = data.get('sender', 'API')
     timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
     formatted_message = f"{sender}: {message} [{timestamp}]"
-    save_message(channel, sender, message, timestamp)
+    if not message_writer.save(channel, sender, message, timestamp):
+        log_event(f"API: Không thể lưu tin nhắn vào kênh {channel}")
+        return jsonify({"error": "Không thể lưu tin nhắn"}), 500
     log_event(f"API: Gửi tin nhắn đến kênh {channel}: {message}")
     log_message(channel, message, sender, deleted=False)
     return jsonify({"status": "Tin nhắn đã được gửi"})
 
+@app.route('/api/search', methods=['GET'])
+def search_api():
+    query = request.args.get('q', '').strip()
+    if not query:
+        return jsonify({"error": "Thiếu từ khóa tìm kiếm"}), 400
+    channel = request.args.get('channel') or None
+    try:
+        limit = int(request.args.get('limit', 20))
+        offset = int(request.args.get('offset', 0))
+    except ValueError:
+        return jsonify({"error": "Tham số phân trang không hợp lệ"}), 400
+    results, has_more = search_messages(query, channel, limit, offset)
+    log_event(f"API: Tìm kiếm '{query}' trong kênh {channel}: {len(results)} kết quả")
+    return jsonify({"results": results, "has_more": has_more, "next_offset": offset + len(results) if has_more else None})
+
+@app.route('/api/metrics', methods=['GET'])
+def get_metrics_api():
+    return jsonify({"push": push_manager.metrics(), "persistence": message_writer.metrics(), "log": log_writer.metrics(),
+                    "compression": compression_stats.metrics()})
+
 if __name__ == "__main__":
     app.run(host='0.0.0.0', port=5001)
\ No newline at end of file
@@ -0,0 +1,205 @@
+import asyncio
+import socket
+import server
+import push
+from protocol import HEADER, MAX_FRAME_SIZE, MAX_IN_FLIGHT, ProtocolError, decode_payload, encode_message
+from utils import log_event
+from codec import JSON_CODEC, json_line
+
+HOST = server.HOST
+PORT = server.PORT
+IDLE_TIMEOUT = None  # Không ngắt các kết nối nhàn rỗi, để giữ được hàng chục nghìn peer
+STREAM_LIMIT = 16 * 1024 * 1024  # Độ dài tối đa của một dòng yêu cầu
+LISTEN_BACKLOG = 4096
+PUSH_BUFFER_LIMIT = 1024 * 1024  # Peer đọc quá chậm bị coi là đã chết
+
+class StreamConnection:
+    """Kết nối asyncio có cùng giao diện với server.ClientConnection.
+
+    Các handler chạy trong các shard của dispatcher, nên việc ghi được chuyển về event loop
+    bằng call_soon_threadsafe và không bao giờ chặn.
+    """
+    def __init__(self, loop, writer, addr):
+        self.loop = loop
+        self.writer = writer
+        self.addr = addr
+        self.version = 1
+        self.codec = JSON_CODEC
+        self.compression = None
+        self.in_flight = asyncio.Semaphore(MAX_IN_FLIGHT)
+
+    def send(self, payload, request_id=None):
+        self.send_encoded(self.codec.encode(payload), request_id)
+
+    def send_encoded(self, data, request_id=None, cached=False):
+        data = encode_message(data, self.version, self.codec, request_id, self.compression, cached)
+        self.loop.call_soon_threadsafe(self._write, data)
+
+    def _write(self, data):
+        if not self.writer.is_closing():
+            self.writer.write(data)
+
+    def finish(self, future):
+        """Chạy trên event loop khi một yêu cầu v2 xử lý xong."""
+        self.in_flight.release()
+        if not future.exception() and future.result() is False:
+            self.writer.close()
+
+async def read_message(reader, version, compression=None):
+    """Đọc một thông điệp (dòng str ở v1, payload bytes đã giải nén ở v2) từ StreamReader; None khi kết nối đóng."""
+    if version < 2:
+        line = await reader.readline()
+        return line.decode('utf-8') if line else None
+    try:
+        length, flags = HEADER.unpack(await reader.readexactly(HEADER.size))
+        if length > MAX_FRAME_SIZE:
+            raise ProtocolError(f"Frame quá lớn: {length} bytes")
+        return decode_payload(flags, await reader.readexactly(length), compression)
+    except asyncio.IncompleteReadError as e:
+        if e.partial:
+            raise
+        return None
+
+async def handle_connection(reader, writer):
+    loop = asyncio.get_running_loop()
+    addr = writer.get_extra_info('peername')
+    conn = StreamConnection(loop, writer, addr)
+    print(f"[+] Kết nối từ {addr}")
+    log_event(f"Kết nối từ {addr}")
+    try:
+        while True:
+            if IDLE_TIMEOUT:
+                message = await asyncio.wait_for(read_message(reader, conn.version, conn.compression), IDLE_TIMEOUT)
+            else:
+                message = await read_message(reader, conn.version, conn.compression)
+            if message is None:
+                break
+            request = server.parse_request(message, conn)
+            if request is None:
+                await writer.drain()
+                continue
+            if isinstance(request, dict) and request.get('type') == 'hello':
+                server.negotiate_protocol(request, conn)
+                await writer.drain()
+                continue
+            if conn.version >= 2:
+                # Client v2 ghép phản hồi theo request_id: đọc yêu cầu tiếp theo mà không chờ
+                await conn.in_flight.acquire()
+                future = server.dispatcher.submit(request, server.handle_request, request, addr, conn)
+                future.add_done_callback(lambda done: loop.call_soon_threadsafe(conn.finish, done))
+                await writer.drain()
+                continue
+            keep_open = await asyncio.wrap_future(server.dispatcher.submit(request, server.handle_request, request, addr, conn))
+            await writer.drain()
+            if not keep_open:
+                break
+    except asyncio.TimeoutError:
+        print(f"[SERVER] Hết thời gian chờ cho client {addr}")
+        log_event(f"Hết thời gian chờ cho client {addr}")
+    except (ConnectionError, asyncio.IncompleteReadError) as e:
+        log_event(f"Client {addr} ngắt kết nối: {type(e).__name__}: {str(e)}")
+    except Exception as e:
+        print(f"[SERVER] Lỗi xử lý client {addr}: {type(e).__name__}: {str(e)}")
+        log_event(f"Lỗi xử lý client {addr}: {e}")
+    finally:
+        writer.close()
+        try:
+            await writer.wait_closed()
+        except Exception:
+            pass
+
+class AsyncPushConnection:
+    """Kết nối push lâu dài chạy trên event loop; send() an toàn khi gọi từ thread khác."""
+    def __init__(self, loop, peer, writer):
+        self.loop = loop
+        self.peer = peer
+        self.writer = writer
+        self.alive = True
+
+    def send(self, data):
+        if not self.alive:
+            return False
+        self.loop.call_soon_threadsafe(self._write, data)
+        return True
+
+    def _write(self, data):
+        # Chạy trên event loop: bộ đệm của transport chỉ được đọc ở đây
+        if not self.alive or self.writer.is_closing():
+            return
+        if self.writer.transport.get_write_buffer_size() > PUSH_BUFFER_LIMIT:
+            push.push_manager.mark_dead(self, "bộ đệm ghi đầy")
+            return
+        self.writer.write(data)
+
+    def close(self):
+        self.alive = False
+        self.loop.call_soon_threadsafe(self.writer.close)
+
+async def open_push_connection(peer):
+    """Mở kết nối push trên event loop rồi đăng ký với push_manager; không thread nào chờ kết quả."""
+    try:
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(peer['ip'], peer['port']), push.PUSH_TIMEOUT)
+    except Exception as e:
+        push.push_manager.open_failed(peer, e)
+        return
+    writer.write(push.PUSH_HELLO)
+    conn = AsyncPushConnection(asyncio.get_running_loop(), peer, writer)
+    push.push_manager.attach(peer, conn)
+    await watch_push_connection(conn, reader)
+
+async def watch_push_connection(conn, reader):
+    """Trả lời ping của peer và đánh dấu kết nối chết khi peer đóng kết nối."""
+    try:
+        while conn.alive:
+            line = await reader.readline()
+            if not line:
+                break
+            try:
+                message = JSON_CODEC.decode(line)
+            except ValueError:
+                continue
+            if isinstance(message, dict) and message.get("type") == "ping":
+                conn._write(json_line({"type": "pong"}))
+    except Exception:
+        pass
+    push.push_manager.mark_dead(conn, "peer đóng kết nối")
+
+def raise_fd_limit():
+    """Nâng giới hạn file descriptor mềm lên mức tối đa để giữ được nhiều kết nối."""
+    try:
+        import resource
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if hard == resource.RLIM_INFINITY or hard > soft:
+            target = hard if hard != resource.RLIM_INFINITY else max(soft, 65536)
+            resource.setrlimit(resource.RLIMIT_NOFILE, (target, hard))
+            log_event(f"Nâng giới hạn file descriptor từ {soft} lên {target}")
+    except (ImportError, ValueError, OSError) as e:
+        log_event(f"Không thể nâng giới hạn file descriptor: {type(e).__name__}: {str(e)}")
+
+async def serve():
+    loop = asyncio.get_running_loop()
+    push.push_manager.opener = lambda peer: asyncio.run_coroutine_threadsafe(open_push_connection(peer), loop)
+    tcp_server = await asyncio.start_server(
+        handle_connection,
+        HOST, PORT, limit=STREAM_LIMIT, backlog=LISTEN_BACKLOG, reuse_address=True
+    )
+    for sock in tcp_server.sockets:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    print(f"[SERVER] Lắng nghe (asyncio) trên {HOST}:{PORT}...")
+    log_event(f"Server asyncio khởi động trên {HOST}:{PORT}")
+    async with tcp_server:
+        await tcp_server.serve_forever()
+
+def start_async_server():
+    raise_fd_limit()
+    server.prepare_server()
+    try:
+        asyncio.run(serve())
+    except KeyboardInterrupt:
+        pass
+    except Exception as e:
+        print(f"[SERVER ERROR] Không thể khởi động server asyncio: {type(e).__name__}: {str(e)}")
+        log_event(f"Không thể khởi động server asyncio: {e}")
+
+if __name__ == "__main__":
+    start_async_server()
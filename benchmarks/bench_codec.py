@@ -0,0 +1,50 @@
+"""So sánh kích thước và thời gian mã hóa/giải mã của các codec có trong tiến trình này
+với những thông điệp lớn nhất của giao thức: danh sách peer và một trang lịch sử.
+
+Codec chưa cài (msgpack, cbor2) được bỏ qua.
+
+Chạy từ thư mục gốc: python -m benchmarks.bench_codec
+"""
+import time
+import uuid
+from codec import CODECS
+
+PEERS = 50000
+HISTORY_PAGE = 500  # Bằng server.HISTORY_PAGE_SIZE
+ROUNDS = 5
+
+def peer_list(count):
+    return [{'ip': f"10.{i // 65536 % 256}.{i // 256 % 256}.{i % 256}", 'port': 6000 + i % 1000,
+             'username': f"user{i}", 'session_id': uuid.uuid4().hex, 'visitor': i % 7 == 0,
+             'invisible': False, 'online': i % 3 != 0} for i in range(count)]
+
+def history_page(count):
+    messages = [f"user{i % 40}: Tin nhắn thứ {i} trong kênh chung, xin chào mọi người! [2026-10-18 09:{i % 60:02d}:00]"
+                for i in range(count)]
+    return {"channel": "general", "messages": messages, "cursor": 123456, "has_more": True}
+
+def best_of(func, rounds=ROUNDS):
+    best = float("inf")
+    for _ in range(rounds):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best * 1000
+
+def main():
+    payloads = [(f"{PEERS} peer", peer_list(PEERS)), (f"lịch sử {HISTORY_PAGE} tin", history_page(HISTORY_PAGE))]
+    print(f"Codec có sẵn: {', '.join(CODECS)}")
+    print(f"{'thông điệp':<20} {'codec':<8} {'bytes':>10} {'tỉ lệ':>7} {'mã hóa ms':>10} {'giải mã ms':>11}")
+    for label, payload in payloads:
+        baseline = None
+        for name, codec in CODECS.items():
+            data = codec.encode(payload)
+            baseline = baseline or len(CODECS["json"].encode(payload))
+            encode_ms = best_of(lambda: codec.encode(payload))
+            decode_ms = best_of(lambda: codec.decode(data))
+            assert codec.decode(data) == payload
+            print(f"{label:<20} {name:<8} {len(data):>10} {len(data) / baseline:>6.0%} "
+                  f"{encode_ms:>10.2f} {decode_ms:>11.2f}")
+
+if __name__ == "__main__":
+    main()
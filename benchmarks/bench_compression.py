@@ -0,0 +1,30 @@
+"""Đo tỉ lệ nén và thời gian nén/giải nén frame v2 cho danh sách peer và trang lịch sử,
+với zlib thường và zlib kèm từ điển dựng sẵn (zlib-d1), trên từng codec có sẵn.
+Cột "gửi lại ms" là encode_message cho payload dùng chung (cached=True) sau lần nén đầu.
+
+Chạy từ thư mục gốc: python -m benchmarks.bench_compression
+"""
+from codec import CODECS
+from compression import COMPRESSIONS
+from protocol import encode_message
+from benchmarks.bench_codec import peer_list, history_page, best_of
+
+def main():
+    payloads = [("10 peer", peer_list(10)), ("200 peer", peer_list(200)), ("5000 peer", peer_list(5000)),
+                ("lịch sử 50 tin", history_page(50)), ("lịch sử 500 tin", history_page(500))]
+    print(f"{'thông điệp':<18} {'codec':<8} {'nén':<8} {'bytes':>9} {'sau nén':>9} {'tỉ lệ':>7} {'nén ms':>8} {'giải nén ms':>12} {'gửi lại ms':>11}")
+    for label, payload in payloads:
+        for codec_name, codec in CODECS.items():
+            data = codec.encode(payload)
+            for name, compression in COMPRESSIONS.items():
+                compressed = compression.compress(data)
+                assert compression.decompress(compressed) == data
+                compress_ms = best_of(lambda: compression.compress(data))
+                decompress_ms = best_of(lambda: compression.decompress(compressed))
+                encode_message(data, 2, codec, "c42", compression, cached=True)
+                resend_ms = best_of(lambda: encode_message(data, 2, codec, "c42", compression, cached=True))
+                print(f"{label:<18} {codec_name:<8} {name:<8} {len(data):>9} {len(compressed):>9} "
+                      f"{len(compressed) / len(data):>6.0%} {compress_ms:>8.2f} {decompress_ms:>12.2f} {resend_ms:>11.3f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+"""So sánh số tin nhắn/giây giữa cách cũ (mở kết nối mới cho mỗi lệnh, journal mặc định)
+và pool kết nối lâu dài với WAL trong database.py.
+
+Chạy từ thư mục gốc: python -m benchmarks.bench_database
+"""
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from datetime import datetime
+import database
+
+MESSAGES = 2000
+READERS = 4  # Số thread đọc lịch sử song song với thread ghi
+
+def old_save_message(channel, sender, message):
+    """Bản sao của save_message trước khi có connection manager."""
+    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    conn = sqlite3.connect(database.DB_FILE)
+    try:
+        conn.execute("INSERT INTO messages (channel, sender, message, timestamp, status) VALUES (?, ?, ?, ?, ?)",
+                     (channel, sender, message, timestamp, "HOẠT ĐỘNG"))
+        conn.commit()
+    finally:
+        conn.close()
+
+def old_get_messages(channel):
+    conn = sqlite3.connect(database.DB_FILE)
+    try:
+        return conn.execute("SELECT sender, message, timestamp, status FROM messages WHERE channel = ? ORDER BY timestamp",
+                            (channel,)).fetchall()
+    finally:
+        conn.close()
+
+def new_get_messages(channel):
+    return database.get_messages(channel)
+
+def fresh_database(directory, name, wal):
+    database.close_connections()
+    database.DB_FILE = os.path.join(directory, name)
+    if wal:
+        database.init_db()
+    else:
+        # Tạo schema trong chế độ rollback-journal mặc định như trước
+        conn = sqlite3.connect(database.DB_FILE)
+        conn.execute("CREATE TABLE messages (id INTEGER PRIMARY KEY AUTOINCREMENT, channel TEXT NOT NULL, sender TEXT NOT NULL, "
+                     "message TEXT NOT NULL, timestamp TEXT NOT NULL, status TEXT NOT NULL)")
+        conn.execute("CREATE INDEX idx_channel ON messages(channel)")
+        conn.commit()
+        conn.close()
+
+def run(save, read, readers):
+    stop = threading.Event()
+    reads = [0]
+
+    def reader():
+        while not stop.is_set():
+            read("bench")
+            reads[0] += 1
+
+    threads = [threading.Thread(target=reader, daemon=True) for _ in range(readers)]
+    for thread in threads:
+        thread.start()
+    start = time.perf_counter()
+    for i in range(MESSAGES):
+        save("bench", "user", f"tin nhắn {i}")
+    elapsed = time.perf_counter() - start
+    stop.set()
+    for thread in threads:
+        thread.join()
+    return MESSAGES / elapsed, reads[0] / elapsed
+
+def main():
+    # Tắt ghi log từng tin nhắn để chỉ đo phần database
+    database.log_event = lambda message: None
+    with tempfile.TemporaryDirectory() as directory:
+        print(f"{'kịch bản':<28} {'cũ (tin/s)':>12} {'mới (tin/s)':>12} {'tăng tốc':>9}")
+        for readers in (0, READERS):
+            fresh_database(directory, f"old-{readers}.db", wal=False)
+            old_rate, old_reads = run(old_save_message, old_get_messages, readers)
+            fresh_database(directory, f"new-{readers}.db", wal=True)
+            new_rate, new_reads = run(database.save_message, new_get_messages, readers)
+            label = f"ghi + {readers} thread đọc" if readers else "chỉ ghi"
+            print(f"{label:<28} {old_rate:>12.0f} {new_rate:>12.0f} {new_rate / old_rate:>8.1f}x")
+            if readers:
+                print(f"{'  lượt đọc/s':<28} {old_reads:>12.0f} {new_reads:>12.0f}")
+        database.close_connections()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+"""So sánh thông lượng giữa lock toàn cục và Dispatcher theo shard kênh.
+
+Dùng Dispatcher với cấu hình mặc định (CHANNEL_SHARDS shard) và tên kênh thông thường,
+nên các kênh có thể trùng shard như khi chạy thật; cột "shard" cho biết số shard thực sự dùng.
+
+Chạy từ thư mục gốc: python -m benchmarks.bench_dispatch
+"""
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dispatcher import Dispatcher, CHANNEL_SHARDS
+
+REQUESTS_PER_CHANNEL = 100
+WORK_SECONDS = 0.002  # Mô phỏng một lần ghi SQLite hoặc gửi thông báo
+CHANNEL_COUNTS = [1, 2, 4, 8, 16]
+
+def handle(results, channel, seq):
+    time.sleep(WORK_SECONDS)
+    results[channel].append(seq)
+    return True
+
+def run_global_lock(channels):
+    lock = threading.Lock()
+    results = {c: [] for c in channels}
+
+    def locked(channel, seq):
+        with lock:
+            return handle(results, channel, seq)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=len(channels)) as clients:
+        for channel in channels:
+            clients.submit(lambda c=channel: [locked(c, i) for i in range(REQUESTS_PER_CHANNEL)])
+    return time.perf_counter() - start, results
+
+def run_sharded(channels, dispatcher):
+    results = {c: [] for c in channels}
+
+    def client(channel):
+        futures = []
+        for i in range(REQUESTS_PER_CHANNEL):
+            request = {"type": "sync_upload", "channel": channel}
+            futures.append(dispatcher.submit(request, handle, results, channel, i))
+        for future in futures:
+            future.result()
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=len(channels)) as clients:
+        for channel in channels:
+            clients.submit(client, channel)
+    return time.perf_counter() - start, results
+
+def main():
+    dispatcher = Dispatcher()
+    print(f"Dispatcher mặc định: {CHANNEL_SHARDS} shard kênh")
+    print(f"{'kênh':>6} {'shard':>6} {'lock (req/s)':>14} {'shard (req/s)':>14} {'tăng tốc':>9}")
+    for count in CHANNEL_COUNTS:
+        channels = [f"channel-{i}" for i in range(count)]
+        shards = {dispatcher.channel_shard(channel) for channel in channels}
+        total = count * REQUESTS_PER_CHANNEL
+        lock_time, _ = run_global_lock(channels)
+        shard_time, results = run_sharded(channels, dispatcher)
+        for channel in channels:
+            assert results[channel] == list(range(REQUESTS_PER_CHANNEL)), f"Sai thứ tự trong kênh {channel}"
+        print(f"{count:>6} {len(shards):>6} {total / lock_time:>14.0f} {total / shard_time:>14.0f} {lock_time / shard_time:>8.1f}x")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+"""So sánh commit từng tin nhắn (save_message) với commit theo nhóm qua MessageWriter,
+với synchronous=NORMAL (mặc định) và FULL (fsync mỗi commit).
+
+Mỗi thread mô phỏng một client sync_upload: gửi tin nhắn rồi chờ xác nhận đã commit.
+Báo cáo thông lượng và độ trễ commit p50/p99.
+
+Chạy từ thư mục gốc: python -m benchmarks.bench_persistence
+"""
+import os
+import tempfile
+import threading
+import time
+import database
+from persistence import MessageWriter
+
+MESSAGES_PER_THREAD = 300
+THREAD_COUNTS = [1, 8, 32]
+MODES = [
+    ("từng commit", lambda: database.save_message),
+    ("nhóm, chờ 0ms", lambda: MessageWriter(flush_deadline=0).save),
+    ("nhóm, chờ 5ms", lambda: MessageWriter(flush_deadline=0.005).save),
+]
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+def run(save, threads):
+    latencies = [[] for _ in range(threads)]
+
+    def client(index):
+        for i in range(MESSAGES_PER_THREAD):
+            start = time.perf_counter()
+            assert save(f"channel-{index % 8}", f"user-{index}", f"tin nhắn {i}")
+            latencies[index].append(time.perf_counter() - start)
+
+    workers = [threading.Thread(target=client, args=(i,)) for i in range(threads)]
+    start = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = time.perf_counter() - start
+    merged = [latency for per_thread in latencies for latency in per_thread]
+    return len(merged) / elapsed, percentile(merged, 0.5) * 1000, percentile(merged, 0.99) * 1000
+
+def main():
+    # Tắt ghi log từng tin nhắn để chỉ đo phần database
+    database.log_event = lambda message: None
+    with tempfile.TemporaryDirectory() as directory:
+        print(f"{'sync':<7} {'thread':>6} {'cách ghi':<14} {'tin/s':>9} {'p50 (ms)':>9} {'p99 (ms)':>9}")
+        for synchronous in ("NORMAL", "FULL"):
+            database.SYNCHRONOUS = synchronous
+            for threads in THREAD_COUNTS:
+                for index, (label, make_save) in enumerate(MODES):
+                    database.close_connections()
+                    database.DB_FILE = os.path.join(directory, f"{synchronous}-{threads}-{index}.db")
+                    database.init_db()
+                    rate, p50, p99 = run(make_save(), threads)
+                    print(f"{synchronous:<7} {threads:>6} {label:<14} {rate:>9.0f} {p50:>9.2f} {p99:>9.2f}")
+        database.close_connections()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+"""So sánh Tracker cũ (danh sách, quét tuyến tính) với Tracker đánh chỉ mục khi có 50k peer.
+
+Mỗi thao tác được đo trên danh bạ đã có sẵn PEERS peer; get_list gồm cả việc tuần tự hóa JSON.
+
+Chạy từ thư mục gốc: python -m benchmarks.bench_tracker
+"""
+import json
+import random
+import threading
+import time
+import tracker
+
+PEERS = 50000
+OPERATIONS = 50
+
+class ListTracker:
+    """Bản sao của Tracker trước khi đánh chỉ mục."""
+    def __init__(self):
+        self.peers = []
+        self.lock = threading.Lock()
+
+    def add_peer(self, ip, port, username, session_id, visitor=False, invisible=False, online=True):
+        peer_info = {'ip': ip, 'port': port, 'username': username, 'session_id': session_id,
+                     'visitor': visitor, 'invisible': invisible, 'online': online}
+        if not self.peer_exists(ip, port):
+            self.peers.append(peer_info)
+
+    def remove_peer(self, ip, port):
+        self.peers = [peer for peer in self.peers if peer['ip'] != ip or peer['port'] != port]
+
+    def peer_exists(self, ip, port):
+        return any(peer['ip'] == ip and peer['port'] == port for peer in self.peers)
+
+    def update_peer_status(self, ip, port, online=True, invisible=False):
+        for peer in self.peers:
+            if peer['ip'] == ip and peer['port'] == port:
+                peer['online'] = online
+                peer['invisible'] = invisible
+                break
+
+    def get_peers(self):
+        with self.lock:
+            return [peer for peer in self.peers if not peer['invisible']]
+
+def address(i):
+    return f"10.{i // 65536}.{(i // 256) % 256}.{i % 256}", 6000 + i % 1000
+
+def populate(t):
+    if isinstance(t, ListTracker):
+        # Thêm trực tiếp để không phải trả O(n^2) của add_peer cũ khi chuẩn bị dữ liệu
+        for i in range(PEERS):
+            ip, port = address(i)
+            t.peers.append({'ip': ip, 'port': port, 'username': f"user{i}", 'session_id': str(i),
+                            'visitor': False, 'invisible': i % 10 == 0, 'online': True})
+    else:
+        for i in range(PEERS):
+            ip, port = address(i)
+            t.add_peer(ip, port, f"user{i}", str(i), invisible=i % 10 == 0)
+
+def operations(t, targets):
+    def get_list():
+        return t.get_peers_payload() if hasattr(t, 'get_peers_payload') else json.dumps(t.get_peers())
+
+    def register(ip, port):
+        if t.peer_exists(ip, port):
+            t.remove_peer(ip, port)
+        t.add_peer(ip, port, "user", "s")
+
+    return [
+        ("peer_exists", lambda ip, port: t.peer_exists(ip, port)),
+        ("update_status", lambda ip, port: t.update_peer_status(ip, port, online=True, invisible=False)),
+        ("đăng ký lại", register),
+        ("get_list", lambda ip, port: get_list()),
+        # Trường hợp thường gặp: nhiều get_list xen giữa các thay đổi
+        ("get_list x10 + update", lambda ip, port: ([get_list() for _ in range(10)], t.update_peer_status(ip, port, online=False))),
+    ]
+
+def measure(t):
+    random.seed(1)
+    targets = [address(random.randrange(PEERS)) for _ in range(OPERATIONS)]
+    results = {}
+    for name, op in operations(t, targets):
+        start = time.perf_counter()
+        for ip, port in targets:
+            op(ip, port)
+        results[name] = (time.perf_counter() - start) / OPERATIONS * 1e6
+    return results
+
+def main():
+    tracker.log_event = lambda message: None
+    old, new = ListTracker(), tracker.Tracker()
+    start = time.perf_counter()
+    populate(new)
+    print(f"Đăng ký {PEERS} peer vào Tracker mới: {time.perf_counter() - start:.2f}s")
+    populate(old)
+    old_results, new_results = measure(old), measure(new)
+    print(f"{'thao tác':<24} {'cũ (µs/op)':>12} {'mới (µs/op)':>12} {'tăng tốc':>9}")
+    for name in old_results:
+        print(f"{name:<24} {old_results[name]:>12.1f} {new_results[name]:>12.1f} {old_results[name] / new_results[name]:>8.0f}x")
+
+if __name__ == "__main__":
+    main()
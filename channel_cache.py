@@ -0,0 +1,78 @@
+import threading
+import database
+from utils import log_event
+from codec import JSON_CODEC
+
+class ChannelRegistry:
+    """Bộ nhớ đệm danh sách kênh dùng chung trong tiến trình.
+
+    Danh sách chỉ được đọc từ database lần đầu và sau khi bị vô hiệu hóa; kiểm tra
+    kênh tồn tại là tra cứu trong set, và danh sách đã mã hóa gửi cho client được tính sẵn
+    (một lần cho mỗi codec).
+    Mọi thay đổi đi qua create()/add() nên bộ nhớ đệm luôn được ghi xuyên (write-through).
+    Các bản chụp là bất biến nên việc đọc không cần khóa.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.snapshot = None  # (frozenset tên kênh, danh sách theo thứ tự, {tên codec: bytes đã mã hóa})
+
+    def _build(self, names):
+        names = list(names)
+        if not names:
+            # Database rỗng hoặc đọc lỗi: dùng tạm ["general"] nhưng không lưu, để lần sau đọc lại database
+            return frozenset(["general"]), ["general"], {}
+        self.snapshot = (frozenset(names), names, {})
+        return self.snapshot
+
+    def _current(self):
+        snapshot = self.snapshot
+        if snapshot is None:
+            with self.lock:
+                snapshot = self.snapshot
+                if snapshot is None:
+                    snapshot = self._build(database.get_channels())
+                    if self.snapshot is not None:
+                        log_event(f"Nạp {len(snapshot[1])} kênh vào bộ nhớ đệm")
+        return snapshot
+
+    def contains(self, channel):
+        return channel in self._current()[0]
+
+    def names(self):
+        return list(self._current()[1])
+
+    def payload(self, codec=JSON_CODEC):
+        """Danh sách kênh đã mã hóa bằng codec, tính một lần cho mỗi lần thay đổi."""
+        snapshot = self._current()
+        payload = snapshot[2].get(codec.name)
+        if payload is None:
+            # Hai thread có thể cùng mã hóa; kết quả giống nhau nên không cần khóa
+            payload = snapshot[2][codec.name] = codec.encode(snapshot[1])
+        return payload
+
+    def create(self, channel, creator):
+        """Tạo kênh trong database và cập nhật bộ nhớ đệm. Trả về False nếu kênh đã tồn tại."""
+        created = database.create_channel(channel, creator)
+        if created:
+            self.add([channel])
+        else:
+            # Kênh có thể đã được tạo bởi tiến trình khác: nạp lại ở lần đọc sau
+            self.invalidate()
+        return created
+
+    def add(self, channels):
+        """Ghi nhận các kênh đã được tạo trong database (ví dụ bởi save_message_batch)."""
+        current = self._current()
+        new = [channel for channel in dict.fromkeys(channels) if channel not in current[0]]
+        if new:
+            with self.lock:
+                # Chưa có bản chụp (database vừa rỗng hoặc lỗi): lần đọc sau nạp lại cả các kênh mới từ database
+                if self.snapshot is not None:
+                    names = self.snapshot[1]
+                    self._build(names + [channel for channel in new if channel not in names])
+
+    def invalidate(self):
+        with self.lock:
+            self.snapshot = None
+
+channel_registry = ChannelRegistry()
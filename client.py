@@ -5,9 +5,11 @@ import threading
 import time
 import tkinter as tk
 from tkinter import scrolledtext, messagebox, ttk, simpledialog
-from sync import add_unsynced_content, sync_to_server, go_online, go_offline, start_livestreaming, stop_livestreaming, peer_status, sync_from_server, set_visitor_mode, set_authenticated_mode, go_invisible, app
+from sync import add_unsynced_content, sync_to_server, go_online, go_offline, start_livestreaming, stop_livestreaming, peer_status, sync_from_server, set_visitor_mode, set_authenticated_mode, go_invisible, app, has_older_messages, fetch_older_messages, sync_channels, use_sync_scope
+from livestream import LivestreamPipeline
 from p2p import listen_for_connections, peer_connect, send_message_to_all_peers, send_message_to_peer, peer_connections, video_connections, create_video_label, receive_video, set_global_app
 from utils import log_event
+from protocol import ServerConnection
 from message_log import log_message
 from database import init_db
 import cv2
@@ -21,6 +23,8 @@ USERNAME = None
 SESSION_FILE = "session.txt"  # File lưu SESSION_ID
 MESSAGES_FILE = "messages.json"  # File lưu tin nhắn cục bộ
 PEER_PORT = 6000  # Giá trị mặc định cho PEER_PORT
+HEARTBEAT_INTERVAL = 15000  # Chu kỳ gửi heartbeat (ms), nhỏ hơn nhiều so với lease 45 giây của tracker
+PUSH_REOPEN_DELAY = 5000  # Chờ (ms) trước khi đăng ký lại khi kết nối push bị đóng, tránh vòng lặp dồn dập
 
 def load_session_id():
     """Đọc SESSION_ID từ file, tạo mới nếu không tồn tại"""
@@ -73,19 +77,25 @@ class ChatApp:
         self.root.geometry("900x600")
         self.root.minsize(400, 300)
         self.peers = []
-        self.server_socket = None
+        self.peer_map = {}  # {(ip, port): peer}, cập nhật bằng snapshot hoặc delta từ server
+        self.peer_epoch = None
+        self.peer_version = 0
+        self.peer_list_stale = True  # Cần hỏi lại server (chưa có danh sách, bỏ lỡ delta, vừa kết nối lại)
+        self.server_conn = None
         self.current_channel = "general"
         self.channels = ["general"]
         self.owned_channels = []
         self.is_visitor = False
         self.messages = load_messages()  # Khôi phục tin nhắn từ file
         self.displayed_messages = {}
+        self.loading_history = False
         self.request_counter = 0
         self.last_reconnect = 0
         self.password = None
         self.reconnect_attempts = 0
         self.max_reconnect_attempts = 5
         self.cap = None
+        self.livestream = None  # LivestreamPipeline khi đang phát
         self.video_windows = {}
         self.is_streaming = False
         self.is_primary_streamer = False
@@ -164,6 +174,7 @@ class ChatApp:
         self.chat_frame.pack(fill=tk.BOTH, expand=True, pady=5)
         self.chat_area = scrolledtext.ScrolledText(self.chat_frame, height=20, bg="#36393F", fg="#DCDDDE", font=("Helvetica", 10), insertbackground="#DCDDDE", borderwidth=0)
         self.chat_area.pack(fill=tk.BOTH, expand=True, padx=5, pady=5)
+        self.chat_area.configure(yscrollcommand=self.on_chat_scroll)
 
         # Thanh nhập tin nhắn
         message_frame = tk.Frame(self.chat_frame, bg="#36393F")
@@ -210,26 +221,23 @@ class ChatApp:
         }
         self.request_counter += 1
         try:
-            self.server_socket = self.create_socket()
-            self.server_socket.sendall((json.dumps(data) + '\n').encode('utf-8'))
-            self.server_socket.settimeout(15)
-            response = self.server_socket.recv(1024).decode('utf-8').strip()
-            response_data = json.loads(response)
+            self.server_conn = self.connect_server()
+            response_data = self.server_conn.request(data)
             if response_data.get("status") == "Đăng ký thành công":
                 messagebox.showinfo("Thành công", "Đăng ký thành công! Vui lòng đăng nhập.")
             else:
                 messagebox.showerror("Lỗi", response_data.get("error", "Lỗi đăng ký!"))
-            log_event(f"Kết quả đăng ký: {response}")
+            log_event(f"Kết quả đăng ký: {response_data}")
         except Exception as e:
             messagebox.showerror("Lỗi", f"Không thể đăng ký: {str(e)}")
             log_event(f"Lỗi đăng ký: {type(e).__name__}: {str(e)}")
         finally:
-            if self.server_socket:
+            if self.server_conn:
                 try:
-                    self.server_socket.close()
+                    self.server_conn.close()
                 except:
                     pass
-                self.server_socket = None
+                self.server_conn = None
 
     def login_authenticated(self):
         global USERNAME, PEER_PORT
@@ -242,6 +250,7 @@ class ChatApp:
         # Tạo PEER_PORT ổn định dựa trên USERNAME
         PEER_PORT = get_stable_port(USERNAME)
         self.root.title(f"Segment Chat - Port {PEER_PORT}")
+        use_sync_scope(f"{SERVER_HOST}:{SERVER_PORT}", USERNAME)
 
         # Ngắt kết nối peer cũ trước khi đăng nhập
         self.disconnect_old_peer()
@@ -254,19 +263,8 @@ class ChatApp:
         }
         self.request_counter += 1
         try:
-            self.server_socket = self.create_socket()
-            self.server_socket.sendall((json.dumps(data) + '\n').encode('utf-8'))
-            self.server_socket.settimeout(15)
-            response = ""
-            while True:
-                chunk = self.server_socket.recv(1024).decode('utf-8')
-                if not chunk:
-                    raise ValueError("Phản hồi từ server rỗng")
-                response += chunk
-                if '\n' in response:
-                    response = response.split('\n')[0]
-                    break
-            response_data = json.loads(response)
+            self.server_conn = self.connect_server()
+            response_data = self.server_conn.request(data)
             if response_data.get("status") == "Đăng nhập thành công":
                 self.is_visitor = False
                 self.password = password
@@ -274,16 +272,16 @@ class ChatApp:
                 self.start_networking()
                 self.start_channel_sync()
                 self.submit_info(password=password)
+                self.root.after(HEARTBEAT_INTERVAL, self.send_heartbeat)
                 self.get_channel_list()
                 # Tải tin nhắn từ server và hợp nhất với tin nhắn cục bộ
+                synced = sync_channels(self.server_conn, self.channels, [channel for channel in self.channels if not self.messages.get(channel)])
                 for channel in self.channels:
-                    server_messages = sync_from_server(self.server_socket, channel)
+                    server_messages = synced.get(channel)
                     if not isinstance(server_messages, list):
                         server_messages = []
-                    # Hợp nhất tin nhắn từ server với tin nhắn cục bộ
-                    current_messages = set(self.messages.get(channel, []))
-                    current_messages.update(server_messages)
-                    self.messages[channel] = list(current_messages)
+                    # Hợp nhất tin nhắn mới từ server vào tin nhắn cục bộ
+                    self.merge_messages(channel, server_messages)
                     self.displayed_messages[channel] = set()
                 # Hiển thị tin nhắn cho kênh hiện tại
                 if self.current_channel in self.messages:
@@ -306,12 +304,12 @@ class ChatApp:
             messagebox.showerror("Lỗi", f"Không thể đăng nhập: {str(e)}")
             log_event(f"Lỗi đăng nhập: {type(e).__name__}: {str(e)}")
         finally:
-            if self.server_socket and self.is_visitor:
+            if self.server_conn and self.is_visitor:
                 try:
-                    self.server_socket.close()
+                    self.server_conn.close()
                 except:
                     pass
-                self.server_socket = None
+                self.server_conn = None
 
     def login_visitor(self):
         global USERNAME, PEER_PORT
@@ -322,6 +320,7 @@ class ChatApp:
         # Tạo PEER_PORT ổn định dựa trên USERNAME
         PEER_PORT = get_stable_port(USERNAME)
         self.root.title(f"Segment Chat - Port {PEER_PORT}")
+        use_sync_scope(f"{SERVER_HOST}:{SERVER_PORT}", USERNAME)
 
         # Ngắt kết nối peer cũ trước khi đăng nhập
         self.disconnect_old_peer()
@@ -330,16 +329,16 @@ class ChatApp:
         self.start_networking()
         self.start_channel_sync()
         self.submit_info(visitor=True)
+        self.root.after(HEARTBEAT_INTERVAL, self.send_heartbeat)
         self.get_channel_list()
         # Tải tin nhắn từ server và hợp nhất với tin nhắn cục bộ
+        synced = sync_channels(self.server_conn, self.channels, [channel for channel in self.channels if not self.messages.get(channel)])
         for channel in self.channels:
-            server_messages = sync_from_server(self.server_socket, channel)
+            server_messages = synced.get(channel)
             if not isinstance(server_messages, list):
                 server_messages = []
-            # Hợp nhất tin nhắn từ server với tin nhắn cục bộ
-            current_messages = set(self.messages.get(channel, []))
-            current_messages.update(server_messages)
-            self.messages[channel] = list(current_messages)
+            # Hợp nhất tin nhắn mới từ server vào tin nhắn cục bộ
+            self.merge_messages(channel, server_messages)
             self.displayed_messages[channel] = set()
         # Hiển thị tin nhắn cho kênh hiện tại
         if self.current_channel in self.messages:
@@ -375,14 +374,13 @@ class ChatApp:
         except Exception as e:
             log_event(f"Lỗi khi ngắt kết nối peer cũ: {type(e).__name__}: {str(e)}")
 
-    def create_socket(self):
+    def connect_server(self):
+        """Mở kết nối đến server và thỏa thuận phiên bản giao thức (v2 nếu server hỗ trợ)"""
         try:
-            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-            s.settimeout(15)
-            s.connect((SERVER_HOST, SERVER_PORT))
-            s.settimeout(None)
-            return s
+            conn = ServerConnection.connect(SERVER_HOST, SERVER_PORT)
+            # Thông điệp server tự gửi trên kết nối này được xử lý như thông báo đẩy
+            conn.default_handler = lambda message: self.root.after(0, self.receive_message, message, None)
+            return conn
         except Exception as e:
             error_msg = f"[ERROR] Không thể kết nối đến server: {type(e).__name__}: {str(e)}"
             self.chat_area.insert(tk.END, f"{error_msg}\n")
@@ -403,32 +401,14 @@ class ChatApp:
         }
         self.request_counter += 1
         try:
-            self.server_socket.sendall((json.dumps(data) + '\n').encode('utf-8'))
-            self.server_socket.settimeout(15)
-            response = ""
-            while True:
-                chunk = self.server_socket.recv(1024).decode('utf-8')
-                if not chunk:
-                    raise ValueError("Phản hồi từ server rỗng")
-                response += chunk
-                if '\n' in response:
-                    response = response.split('\n')[0]
-                    break
-            try:
-                response_data = json.loads(response)
-                if "error" in response_data:
-                    self.chat_area.insert(tk.END, f"[ERROR] {response_data['error']}\n")
-                    log_event(f"Xác thực thất bại: {response_data['error']}")
-                    raise ValueError(f"Server error: {response_data['error']}")
-                else:
-                    self.chat_area.insert(tk.END, f"[SERVER RESPONSE] {response_data.get('message', 'Thông tin được gửi thành công')}\n")
-                    log_event(f"Gửi thông tin: {data}, phản hồi: {response}")
-            except json.JSONDecodeError:
-                if "Thông tin được gửi thành công" in response:
-                    log_event(f"Gửi thông tin: {data}, phản hồi văn bản: {response}")
-                else:
-                    raise ValueError(f"Phản hồi không phải JSON: {response}")
-            self.server_socket.settimeout(None)
+            response_data = self.server_conn.request(data)
+            if "error" in response_data:
+                self.chat_area.insert(tk.END, f"[ERROR] {response_data['error']}\n")
+                log_event(f"Xác thực thất bại: {response_data['error']}")
+                raise ValueError(f"Server error: {response_data['error']}")
+            else:
+                self.chat_area.insert(tk.END, f"[SERVER RESPONSE] {response_data.get('message', 'Thông tin được gửi thành công')}\n")
+                log_event(f"Gửi thông tin: {data}, phản hồi: {response_data}")
         except Exception as e:
             error_msg = f"[ERROR] Không thể gửi thông tin: {type(e).__name__}: {str(e)}"
             self.chat_area.insert(tk.END, f"{error_msg}\n")
@@ -448,10 +428,11 @@ class ChatApp:
         self.last_reconnect = current_time
         self.reconnect_attempts += 1
         try:
-            if self.server_socket:
-                self.server_socket.close()
-            self.server_socket = self.create_socket()
+            if self.server_conn:
+                self.server_conn.close()
+            self.server_conn = self.connect_server()
             self.submit_info(visitor=self.is_visitor, password=self.password)
+            self.peer_list_stale = True
             self.chat_area.insert(tk.END, "[INFO] Kết nối lại với server.\n")
             log_event(f"Kết nối lại với server với session ID: {SESSION_ID}")
             self.reconnect_attempts = 0
@@ -462,35 +443,30 @@ class ChatApp:
             self.root.after(5000, self.reconnect)
 
     def get_peer_list(self):
-        data = {"type": "get_list", "request_id": str(self.request_counter)}
+        """Hỏi server các thay đổi danh sách peer kể từ phiên bản đang có (hoặc ảnh chụp đầy đủ)"""
+        data = {"type": "get_list", "since_version": self.peer_version, "epoch": self.peer_epoch, "request_id": str(self.request_counter)}
         self.request_counter += 1
         try:
-            self.server_socket.sendall((json.dumps(data) + '\n').encode('utf-8'))
-            self.server_socket.settimeout(15)
-            response = ""
-            while True:
-                chunk = self.server_socket.recv(4096).decode('utf-8')
-                if not chunk:
-                    break
-                response += chunk
-                if '\n' in response:
-                    response = response.split('\n')[0]
-                    break
-            log_event(f"Phản hồi danh sách peer: {response}")
-            if not response:
-                raise ValueError("Phản hồi từ server rỗng")
             try:
-                peer_data = json.loads(response)
+                peer_data = self.server_conn.request(data)
             except json.JSONDecodeError as e:
-                log_event(f"Phản hồi JSON không hợp lệ cho danh sách peer: {response}, lỗi: {e}")
+                log_event(f"Phản hồi JSON không hợp lệ cho danh sách peer, lỗi: {e}")
                 raise ValueError(f"Phản hồi JSON không hợp lệ: {e}")
-            if not isinstance(peer_data, list):
+            log_event(f"Phản hồi danh sách peer: {peer_data}")
+            if isinstance(peer_data, list):
+                # Server cũ không có phiên bản: luôn hỏi lại ở lần sau
+                self.set_peers(peer_data, None, 0)
+                self.peer_list_stale = True
+            elif isinstance(peer_data, dict) and isinstance(peer_data.get("peers"), list):
+                self.set_peers(peer_data["peers"], peer_data.get("epoch"), peer_data.get("version", 0))
+                self.peer_list_stale = False
+            elif isinstance(peer_data, dict) and isinstance(peer_data.get("changes"), list):
+                self.apply_peer_changes(peer_data["changes"], peer_data.get("version", self.peer_version))
+                self.peer_list_stale = False
+            else:
                 raise ValueError(f"Kỳ vọng danh sách peer, nhận được: {peer_data}")
-            if not peer_data:
+            if not self.peers:
                 log_event("Nhận danh sách peer rỗng từ server")
-            self.peers = peer_data
-            self.update_peer_listbox()
-            self.server_socket.settimeout(None)
             return self.peers
         except Exception as e:
             error_msg = f"[ERROR] Không thể lấy danh sách peer: {type(e).__name__}: {str(e)}"
@@ -502,30 +478,17 @@ class ChatApp:
         for attempt in range(retries):
             try:
                 try:
-                    self.server_socket.getpeername()
+                    self.server_conn.getpeername()
                 except:
                     self.reconnect()
                 data = {"type": "get_channel_list", "request_id": str(self.request_counter)}
                 self.request_counter += 1
-                self.server_socket.sendall((json.dumps(data) + '\n').encode('utf-8'))
-                self.server_socket.settimeout(20)
-                response = ""
-                while True:
-                    chunk = self.server_socket.recv(8192).decode('utf-8')
-                    if not chunk:
-                        raise ValueError("Phản hồi từ server rỗng")
-                    response += chunk
-                    if '\n' in response:
-                        response = response.split('\n')[0]
-                        break
-                log_event(f"Phản hồi danh sách kênh: {response}")
-                if not response:
-                    raise ValueError("Phản hồi từ server rỗng")
                 try:
-                    new_channels = json.loads(response)
+                    new_channels = self.server_conn.request(data, timeout=20)
                 except json.JSONDecodeError as e:
-                    log_event(f"Phản hồi JSON không hợp lệ cho danh sách kênh: {response}, lỗi: {e}")
+                    log_event(f"Phản hồi JSON không hợp lệ cho danh sách kênh, lỗi: {e}")
                     raise ValueError(f"Phản hồi JSON không hợp lệ: {e}")
+                log_event(f"Phản hồi danh sách kênh: {new_channels}")
                 if not isinstance(new_channels, list):
                     raise ValueError(f"Kỳ vọng danh sách kênh, nhận được: {new_channels}")
                 if new_channels and new_channels != self.channels:
@@ -533,7 +496,6 @@ class ChatApp:
                     self.update_channel_menu()
                     self.chat_area.insert(tk.END, f"[SERVER] Cập nhật danh sách kênh: {self.channels}\n")
                     log_event(f"Cập nhật danh sách kênh: {self.channels}")
-                self.server_socket.settimeout(None)
                 return
             except Exception as e:
                 error_msg = f"[ERROR] Không thể lấy danh sách kênh (lần thử {attempt+1}/{retries}): {type(e).__name__}: {str(e)}"
@@ -544,7 +506,36 @@ class ChatApp:
                     self.update_channel_menu()
                     log_event("Sử dụng danh sách kênh mặc định: ['general']")
                 time.sleep(1)
-        self.server_socket.settimeout(None)
+
+    def set_peers(self, peers, epoch, version):
+        self.peer_map = {(peer['ip'], peer['port']): peer for peer in peers}
+        self.peer_epoch = epoch
+        self.peer_version = version
+        self.peers = list(self.peer_map.values())
+        self.update_peer_listbox()
+
+    def apply_peer_changes(self, changes, version):
+        for change in changes:
+            peer = change.get("peer", {})
+            key = (peer.get('ip'), peer.get('port'))
+            if change.get("op") == "remove":
+                self.peer_map.pop(key, None)
+            else:
+                self.peer_map[key] = peer
+        self.peer_version = version
+        self.peers = list(self.peer_map.values())
+        self.update_peer_listbox()
+        log_event(f"Áp dụng {len(changes)} thay đổi danh sách peer, phiên bản {version}")
+
+    def ensure_peer_list(self):
+        """Trả về danh sách peer hiện có; chỉ hỏi server khi danh sách có thể đã cũ.
+
+        Khi online, thay đổi được server đẩy qua peer_delta nên không cần hỏi lại. Peer
+        ẩn danh không nhận thông báo đẩy nên vẫn hỏi (chỉ nhận phần chênh lệch).
+        """
+        if self.peer_list_stale or peer_status["invisible"] or not peer_status["online"]:
+            return self.get_peer_list()
+        return self.peers
 
     def update_peer_listbox(self):
         self.peer_listbox.delete(0, tk.END)
@@ -577,20 +568,7 @@ class ChatApp:
         data = {"type": "create_channel", "channel": channel_name, "username": USERNAME, "request_id": str(self.request_counter)}
         self.request_counter += 1
         try:
-            self.server_socket.sendall((json.dumps(data) + '\n').encode('utf-8'))
-            self.server_socket.settimeout(15)
-            response = ""
-            while True:
-                chunk = self.server_socket.recv(1024).decode('utf-8')
-                if not chunk:
-                    break
-                response += chunk
-                if '\n' in response:
-                    response = response.split('\n')[0]
-                    break
-            if not response:
-                raise ValueError("Phản hồi từ server rỗng")
-            response_data = json.loads(response)
+            response_data = self.server_conn.request(data)
             if response_data.get("status") == "success":
                 self.channels.append(channel_name)
                 self.owned_channels.append(channel_name)
@@ -601,7 +579,6 @@ class ChatApp:
             else:
                 self.chat_area.insert(tk.END, f"[ERROR] {response_data.get('error', 'Không thể tạo kênh')}\n")
                 log_event(f"Lỗi tạo kênh: {response_data.get('error')}")
-            self.server_socket.settimeout(None)
         except Exception as e:
             error_msg = f"[ERROR] Không thể tạo kênh: {type(e).__name__}: {str(e)}"
             self.chat_area.insert(tk.END, f"{error_msg}\n")
@@ -630,11 +607,9 @@ class ChatApp:
             self.displayed_messages[channel] = set()
 
         # Lấy tin nhắn từ server
-        server_messages = sync_from_server(self.server_socket, channel)
+        server_messages = sync_from_server(self.server_conn, channel, full=not self.messages[channel])
         if isinstance(server_messages, list):
-            current_messages = set(self.messages[channel])
-            current_messages.update(server_messages)
-            self.messages[channel] = list(current_messages)
+            self.merge_messages(channel, server_messages)
             log_event(f"Lấy {len(server_messages)} tin nhắn từ server cho kênh {channel}")
         else:
             log_event(f"Không lấy được tin nhắn hợp lệ từ server cho kênh {channel}, giữ tin nhắn cục bộ")
@@ -658,8 +633,43 @@ class ChatApp:
         # Lưu tin nhắn sau khi chuyển kênh
         save_messages(self.messages)
 
+    def on_chat_scroll(self, first, last):
+        """Cập nhật thanh cuộn và tải trang tin nhắn cũ hơn khi người dùng cuộn lên đầu"""
+        self.chat_area.vbar.set(first, last)
+        if float(first) <= 0.0 and not self.loading_history and self.server_conn and has_older_messages(self.current_channel):
+            self.loading_history = True
+            self.root.after_idle(self.load_older_messages)
+
+    def load_older_messages(self):
+        channel = self.current_channel
+        try:
+            older = fetch_older_messages(self.server_conn, channel)
+            messages = self.messages.setdefault(channel, [])
+            known = set(messages)
+            older = [msg for msg in older if msg not in known]
+            if not older:
+                return
+            self.messages[channel] = older + messages
+            self.displayed_messages.setdefault(channel, set()).update(older)
+            # Chèn lên đầu và giữ nguyên dòng người dùng đang xem
+            self.chat_area.insert("1.0", "".join(f"{msg}\n" for msg in older))
+            self.chat_area.yview(f"{len(older) + 1}.0")
+            log_event(f"Tải thêm {len(older)} tin nhắn cũ cho kênh {channel}")
+            save_messages(self.messages)
+        finally:
+            self.loading_history = False
+
+    def merge_messages(self, channel, new_messages):
+        """Thêm các tin nhắn chưa có vào cuối danh sách của kênh, giữ nguyên thứ tự"""
+        messages = self.messages.setdefault(channel, [])
+        known = set(messages)
+        for msg in new_messages:
+            if msg not in known:
+                messages.append(msg)
+                known.add(msg)
+
     def connect_to_all_peers(self):
-        self.peers = self.get_peer_list()
+        self.peers = self.ensure_peer_list()
         if not self.peers:
             return
         for peer in self.peers:
@@ -674,6 +684,13 @@ class ChatApp:
 
     def receive_message(self, msg_data, s):
         try:
+            if msg_data.get("type") == "peer_delta":
+                # Thay đổi danh sách peer do server đẩy; bỏ lỡ phiên bản nào thì hỏi lại ở lần sau
+                if msg_data.get("epoch") == self.peer_epoch and msg_data.get("from_version") == self.peer_version:
+                    self.apply_peer_changes(msg_data.get("changes", []), msg_data.get("version", self.peer_version))
+                elif msg_data.get("epoch") != self.peer_epoch or msg_data.get("version", 0) > self.peer_version:
+                    self.peer_list_stale = True
+                return
             if msg_data.get("type") == "notification":
                 channel = msg_data.get("channel", "general")
                 msg = msg_data.get("message", "")
@@ -688,6 +705,20 @@ class ChatApp:
                     self.chat_area.insert(tk.END, f"[Mới] {msg}\n")
                     self.displayed_messages[channel].add(msg)
                 log_message(channel, msg, USERNAME, deleted=False)
+            elif msg_data.get("type") == "notification_batch":
+                for item in msg_data.get("messages", []):
+                    channel = item.get("channel", "general")
+                    msg = item.get("message", "")
+                    if channel not in self.messages:
+                        self.messages[channel] = []
+                    if channel not in self.displayed_messages:
+                        self.displayed_messages[channel] = set()
+                    if msg not in self.messages[channel]:
+                        self.messages[channel].append(msg)
+                    if channel == self.current_channel and msg not in self.displayed_messages[channel]:
+                        self.chat_area.insert(tk.END, f"[Mới] {msg}\n")
+                        self.displayed_messages[channel].add(msg)
+                log_event(f"Nhận lô {len(msg_data.get('messages', []))} tin nhắn thông báo")
             elif msg_data.get("type") == "channel_creation":
                 channel = msg_data.get("channel", "general")
                 msg = msg_data.get("message", "")
@@ -780,7 +811,7 @@ class ChatApp:
 
     def start_networking(self):
         try:
-            self.server_socket = self.create_socket()
+            self.server_conn = self.connect_server()
             threading.Thread(target=listen_for_connections, args=(PEER_PORT,), daemon=True).start()
             log_event("Bắt đầu networking")
         except Exception as e:
@@ -794,6 +825,41 @@ class ChatApp:
         self.get_channel_list()
         self.root.after(15000, self.start_channel_sync)
 
+    def send_heartbeat(self):
+        """Gia hạn lease trên tracker; nếu server đã xóa peer (lease hết hạn) thì đăng ký lại"""
+        data = {"type": "heartbeat", "port": PEER_PORT, "request_id": str(self.request_counter)}
+        self.request_counter += 1
+        try:
+            # Không chờ phản hồi trên thread Tk: xử lý khi phản hồi đến, qua root.after
+            future = self.server_conn.submit(data)
+            future.add_done_callback(lambda done: self.root.after(0, self.handle_heartbeat_reply, done))
+        except Exception as e:
+            log_event(f"Không thể gửi heartbeat: {type(e).__name__}: {str(e)}")
+        self.root.after(HEARTBEAT_INTERVAL, self.send_heartbeat)
+
+    def handle_heartbeat_reply(self, future):
+        try:
+            response = future.result()
+        except Exception as e:
+            log_event(f"Không thể gửi heartbeat: {type(e).__name__}: {str(e)}")
+            return
+        if "error" in response:
+            log_event("Lease trên tracker đã hết hạn, gửi lại thông tin peer")
+            self.submit_info(visitor=self.is_visitor, password=self.password)
+            self.peer_list_stale = True
+
+    def push_closed(self):
+        """Gọi từ thread đọc push khi kết nối push đóng; xử lý tiếp trên thread Tk."""
+        self.root.after(PUSH_REOPEN_DELAY, self.reopen_push)
+
+    def reopen_push(self):
+        """Danh sách peer không còn nhận delta: đánh dấu cũ và gửi lại submit_info để server mở lại kết nối push."""
+        if self.server_conn is None:
+            return
+        self.peer_list_stale = True
+        log_event("Kết nối push đã đóng, gửi lại thông tin peer để server mở lại")
+        self.submit_info(visitor=self.is_visitor, password=self.password)
+
     def send_channel_message(self):
         if self.is_visitor:
             messagebox.showwarning("Cảnh báo", "Khách không thể gửi tin nhắn!")
@@ -888,6 +954,8 @@ class ChatApp:
                 return False
             log_event("Camera mở thành công cho livestream")
             self.is_streaming = True
+            self.livestream = LivestreamPipeline(self.cap, USERNAME)
+            self.livestream.start()
             create_video_label(USERNAME)
             log_event("Tạo nhãn video cho chính mình (streamer)")
             self.update_video_frame()
@@ -898,10 +966,11 @@ class ChatApp:
             log_event(f"Lỗi mở camera: {type(e).__name__}: {str(e)}")
             return False
 
-    def update_video_frame(self):
-        if self.is_streaming and self.cap and self.cap.isOpened():
-            ret, frame = self.cap.read()
-            if ret:
+    def update_video_frame(self, shown=-1):
+        """Xem trước cục bộ bằng khung mới nhất của pipeline livestream (không đọc camera lần nữa)."""
+        if self.is_streaming and self.livestream and self.livestream.running:
+            frame, sequence = self.livestream.latest_preview()
+            if frame is not None and sequence != shown:
                 frame = cv2.resize(frame, (320, 240))
                 frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
                 img = Image.fromarray(frame)
@@ -910,7 +979,8 @@ class ChatApp:
                     label = self.video_windows[USERNAME]
                     label.imgtk = imgtk
                     label.configure(image=imgtk)
-            self.root.after(10, self.update_video_frame)
+                shown = sequence
+            self.root.after(int(self.livestream.frame_interval * 1000) // 2, self.update_video_frame, shown)
         else:
             if USERNAME in self.video_windows:
                 label = self.video_windows[USERNAME]
@@ -919,6 +989,10 @@ class ChatApp:
     def stop_camera(self):
         if self.cap:
             self.is_streaming = False
+            if self.livestream:
+                # Dừng thread chụp trước khi giải phóng camera mà nó đang đọc
+                self.livestream.stop()
+                self.livestream = None
             self.cap.release()
             self.cap = None
             if USERNAME in self.video_windows:
@@ -927,18 +1001,32 @@ class ChatApp:
                 del self.video_windows[USERNAME]
             log_event("Camera dừng")
 
-    def create_video_window(self):
-        """Tạo cửa sổ video riêng khi bắt đầu livestream"""
+    def create_video_window(self, title=None, on_close=None):
+        """Tạo cửa sổ video riêng khi bắt đầu livestream (hoặc khi xem livestream của peer khác)"""
         if self.video_window is None:
             self.video_window = tk.Toplevel(self.root)
-            self.video_window.title(f"Livestream - {USERNAME}")
+            self.video_window.title(title or f"Livestream - {USERNAME}")
             self.video_window.geometry("400x300")
             self.video_window.configure(bg="#36393F")
             self.video_frame = tk.LabelFrame(self.video_window, text="Livestream Video", font=("Helvetica", 10, "bold"), bg="#36393F", fg="#DCDDDE", bd=0)
             self.video_frame.pack(fill=tk.BOTH, expand=True, padx=5, pady=5)
             log_event("Tạo cửa sổ video riêng")
             # Gắn sự kiện đóng cửa sổ để dừng livestream
-            self.video_window.protocol("WM_DELETE_WINDOW", self.stop_livestream_ui)
+            self.video_window.protocol("WM_DELETE_WINDOW", on_close or self.stop_livestream_ui)
+
+    def show_stream(self, streamer):
+        """Mở cửa sổ video và nhãn cho livestream nhận được từ peer (gọi trên thread giao diện)."""
+        if self.video_window is None:
+            self.create_video_window(title=f"Livestream - {streamer}", on_close=self.close_video_window)
+        create_video_label(streamer)
+
+    def hide_stream(self, streamer):
+        """Gỡ nhãn video của peer đã dừng phát; đóng cửa sổ nếu không còn luồng nào."""
+        label = self.video_windows.pop(streamer, None)
+        if label is not None:
+            label.destroy()
+        if not self.video_windows and not self.is_streaming:
+            self.close_video_window()
 
     def close_video_window(self):
         """Đóng cửa sổ video khi dừng livestream"""
@@ -946,23 +1034,23 @@ class ChatApp:
             self.video_window.destroy()
             self.video_window = None
             self.video_frame = None
+            self.video_windows.clear()  # Các nhãn đã bị hủy cùng cửa sổ
             log_event("Đóng cửa sổ video riêng")
 
     def go_online_ui(self):
-        go_online(self.server_socket)
-        sync_to_server(self.server_socket)
+        go_online(self.server_conn)
+        self.peer_list_stale = True
+        sync_to_server(self.server_conn)
         self.chat_area.insert(tk.END, "[STATUS] Peer hiện đang online.\n")
         self.connect_to_all_peers()
         self.submit_info(visitor=self.is_visitor, password=self.password)
         self.update_status(online=True, invisible=False)
         
         # Tải tin nhắn mới từ server mà không reset chat_area
-        new_messages = sync_from_server(self.server_socket, self.current_channel)
+        new_messages = sync_from_server(self.server_conn, self.current_channel)
         if isinstance(new_messages, list):
             # Tích hợp tin nhắn mới vào danh sách hiện tại
-            current_messages = set(self.messages.get(self.current_channel, []))
-            current_messages.update(new_messages)
-            self.messages[self.current_channel] = list(current_messages)
+            self.merge_messages(self.current_channel, new_messages)
             log_event(f"Lấy {len(new_messages)} tin nhắn từ server cho kênh {self.current_channel}")
             
             # Hiển thị chỉ các tin nhắn mới
@@ -1024,7 +1112,7 @@ class ChatApp:
                 self.close_video_window()
                 return
 
-            self.peers = self.get_peer_list()
+            self.peers = self.ensure_peer_list()
             target_peers = [
                 {"username": peer['username'], "ip": peer['ip'], "port": peer['port']}
                 for peer in self.peers if peer['port'] != PEER_PORT and peer['username'] != USERNAME
@@ -1037,32 +1125,20 @@ class ChatApp:
                 "target_peers": target_peers
             }
             self.request_counter += 1
-            self.server_socket.sendall((json.dumps(data) + '\n').encode('utf-8'))
-            self.server_socket.settimeout(15)
-            response = ""
-            while True:
-                chunk = self.server_socket.recv(1024).decode('utf-8')
-                if not chunk:
-                    break
-                response += chunk
-                if '\n' in response:
-                    response = response.split('\n')[0]
-                    break
-            if not response:
-                raise ValueError("Phản hồi từ server rỗng")
-            response_data = json.loads(response)
+            response_data = self.server_conn.request(data)
             if response_data.get("status") == "success":
                 start_livestreaming()
                 self.is_streaming = True
                 self.is_primary_streamer = True
-                self.chat_area.insert(tk.END, "[STATUS] Livestream bắt đầu (chỉ xem cục bộ).\n")
-                log_event(f"Bắt đầu livestream cục bộ trong kênh {self.current_channel}")
+                for peer in target_peers:
+                    self.livestream.add_viewer(peer)
+                self.chat_area.insert(tk.END, f"[STATUS] Livestream bắt đầu, phát đến {len(target_peers)} peer.\n")
+                log_event(f"Bắt đầu livestream trong kênh {self.current_channel} đến {len(target_peers)} peer")
             else:
                 messagebox.showerror("Lỗi", response_data.get("error", "Không thể bắt đầu livestream!"))
                 log_event(f"Lỗi bắt đầu livestream: {response_data.get('error')}")
                 self.stop_camera()
                 self.close_video_window()
-            self.server_socket.settimeout(None)
         except Exception as e:
             error_msg = f"[ERROR] Không thể bắt đầu livestream: {type(e).__name__}: {str(e)}"
             self.chat_area.insert(tk.END, f"{error_msg}\n")
@@ -1088,20 +1164,7 @@ class ChatApp:
                 "request_id": str(self.request_counter)
             }
             self.request_counter += 1
-            self.server_socket.sendall((json.dumps(data) + '\n').encode('utf-8'))
-            self.server_socket.settimeout(15)
-            response = ""
-            while True:
-                chunk = self.server_socket.recv(1024).decode('utf-8')
-                if not chunk:
-                    break
-                response += chunk
-                if '\n' in response:
-                    response = response.split('\n')[0]
-                    break
-            if not response:
-                raise ValueError("Phản hồi từ server rỗng")
-            response_data = json.loads(response)
+            response_data = self.server_conn.request(data)
             if response_data.get("status") == "success":
                 self.chat_area.insert(tk.END, f"[SERVER RESPONSE] {response_data.get('message', 'Livestream kết thúc')}\n")
                 log_event(f"Kết thúc livestream trong kênh {self.current_channel}")
@@ -1109,7 +1172,6 @@ class ChatApp:
                 error_msg = response_data.get("error", "Không thể kết thúc livestream!")
                 self.chat_area.insert(tk.END, f"[ERROR] {error_msg}\n")
                 log_event(f"Lỗi kết thúc livestream: {error_msg}")
-            self.server_socket.settimeout(None)
         except Exception as e:
             error_msg = f"[ERROR] Không thể kết thúc livestream: {type(e).__name__}: {str(e)}"
             self.chat_area.insert(tk.END, f"{error_msg}\n")
@@ -1130,21 +1192,8 @@ class ChatApp:
         }
         self.request_counter += 1
         try:
-            self.server_socket.sendall((json.dumps(data) + '\n').encode('utf-8'))
-            self.server_socket.settimeout(15)
-            response = ""
-            while True:
-                chunk = self.server_socket.recv(1024).decode('utf-8')
-                if not chunk:
-                    break
-                response += chunk
-                if '\n' in response:
-                    response = response.split('\n')[0]
-                    break
-            if not response:
-                raise ValueError("Phản hồi từ server rỗng")
-            log_event(f"Cập nhật trạng thái: online={online}, invisible={invisible}, phản hồi: {response}")
-            self.server_socket.settimeout(None)
+            response_data = self.server_conn.request(data)
+            log_event(f"Cập nhật trạng thái: online={online}, invisible={invisible}, phản hồi: {response_data}")
         except Exception as e:
             error_msg = f"[ERROR] Không thể cập nhật trạng thái: {type(e).__name__}: {str(e)}"
             self.chat_area.insert(tk.END, f"{error_msg}\n")
@@ -1171,8 +1220,8 @@ class ChatApp:
             }
             self.request_counter += 1
             try:
-                self.server_socket.sendall((json.dumps(data) + '\n').encode('utf-8'))
-                self.server_socket.close()
+                self.server_conn.send(data)
+                self.server_conn.close()
             except Exception as e:
                 log_event(f"Lỗi khi ngắt kết nối với server: {type(e).__name__}: {str(e)}")
             for addr, conn in list(peer_connections.items()):
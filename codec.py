@@ -0,0 +1,79 @@
+import json
+from utils import log_event
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import cbor2
+except ImportError:
+    cbor2 = None
+
+class JsonCodec:
+    """Mã hóa mặc định, dùng được với mọi peer và server cũ."""
+    name = "json"
+
+    def encode(self, obj):
+        return json.dumps(obj).encode('utf-8')
+
+    def decode(self, data):
+        if not isinstance(data, str):
+            data = str(data, 'utf-8')
+        return json.loads(data)
+
+class MsgpackCodec:
+    """MessagePack: nhỏ hơn và nhanh hơn JSON với danh sách peer và lịch sử tin nhắn."""
+    name = "msgpack"
+
+    def encode(self, obj):
+        return msgpack.packb(obj, use_bin_type=True)
+
+    def decode(self, data):
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        return msgpack.unpackb(data, raw=False)
+
+class CborCodec:
+    """CBOR (RFC 8949), cùng mục đích với MessagePack."""
+    name = "cbor"
+
+    def encode(self, obj):
+        return cbor2.dumps(obj)
+
+    def decode(self, data):
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        return cbor2.loads(data)
+
+JSON_CODEC = JsonCodec()
+CODECS = {JSON_CODEC.name: JSON_CODEC}  # Các codec dùng được trong tiến trình này, theo thứ tự ưu tiên giảm dần
+if msgpack is not None:
+    CODECS = {MsgpackCodec.name: MsgpackCodec(), **CODECS}
+if cbor2 is not None:
+    CODECS[CborCodec.name] = CborCodec()
+    CODECS[JSON_CODEC.name] = CODECS.pop(JSON_CODEC.name)
+
+def available_codecs():
+    """Tên các codec được hỗ trợ, ưu tiên codec nhị phân; gửi kèm yêu cầu hello."""
+    return list(CODECS)
+
+def get_codec(name):
+    codec = CODECS.get(name)
+    if codec is None:
+        log_event(f"Codec {name} không được hỗ trợ, dùng json")
+        return JSON_CODEC
+    return codec
+
+def choose_codec(offered):
+    """Codec đầu tiên theo thứ tự ưu tiên của tiến trình này mà bên kia cũng hỗ trợ."""
+    offered = offered or []
+    for name, codec in CODECS.items():
+        if name in offered:
+            return codec
+    return JSON_CODEC
+
+def json_line(obj):
+    """Một dòng JSON (kết thúc bằng xuống dòng), dạng dùng trên các kết nối P2P và push vốn không thỏa thuận codec."""
+    return JSON_CODEC.encode(obj) + b'\n'
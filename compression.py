@@ -0,0 +1,105 @@
+import zlib
+import threading
+from utils import log_event
+
+COMPRESS_MIN_BYTES = 1024  # Payload nhỏ hơn được gửi nguyên: chi phí nén không đáng
+COMPRESS_LEVEL = 6
+MAX_DECOMPRESSED_SIZE = 16 * 1024 * 1024  # Bằng protocol.MAX_FRAME_SIZE: chặn "bom nén"
+
+# Từ điển nén dựng sẵn cho zlib: các đoạn lặp lại nhiều nhất trong danh sách peer và lịch sử
+# tin nhắn. Hai bên phải dùng đúng cùng một từ điển, nên khi sửa phải đổi tên thuật toán
+# (zlib-d1 -> zlib-d2) để không giải nén nhầm với bản cũ. zlib dùng hiệu quả nhất phần
+# cuối từ điển, nên các đoạn thường gặp nhất được đặt sau cùng.
+ZLIB_DICTIONARY = (
+    b'{"type": "peer_delta", "from_version": 0, "changes": [{"op": "remove", "reason": "expired", '
+    b'"op": "update", "op": "add", "peer": '
+    b'{"status": "success", "error": "", "channel": "general", "has_more": false, "has_more": true, '
+    b'"next_offset": null, "cursor": 0, "result": [], "request_id": "c1", '
+    b'{"epoch": "", "version": 0, "peers": [], '
+    b'ip port username session_id visitor invisible online messages cursor has_more request_id result '
+    b' [2026-01-01 00:00:00]", "Visitor_: ", "user: ", "messages": ["'
+    b'{"ip": "192.168.1.100", "port": 6000, "username": "user", "session_id": "", '
+    b'"visitor": true, "invisible": false, "online": false}, '
+    b'{"ip": "10.0.0.1", "port": 5000, "username": "", "session_id": "", '
+    b'"visitor": false, "invisible": false, "online": true}, '
+)
+
+class ZlibCompression:
+    """Nén từng frame bằng zlib, có thể kèm từ điển dựng sẵn.
+
+    Mỗi frame được nén độc lập (không giữ trạng thái giữa các frame) nên phản hồi từ nhiều
+    shard có thể được nén song song và gửi theo thứ tự bất kỳ.
+    """
+    def __init__(self, name, zdict=None, level=COMPRESS_LEVEL):
+        self.name = name
+        self.zdict = zdict
+        self.level = level
+
+    def compress(self, data):
+        if self.zdict:
+            compressor = zlib.compressobj(self.level, zdict=self.zdict)
+        else:
+            compressor = zlib.compressobj(self.level)
+        return compressor.compress(data) + compressor.flush()
+
+    def decompress(self, data):
+        decompressor = zlib.decompressobj(zdict=self.zdict) if self.zdict else zlib.decompressobj()
+        result = decompressor.decompress(data, MAX_DECOMPRESSED_SIZE)
+        if decompressor.unconsumed_tail:
+            raise ValueError(f"Dữ liệu giải nén vượt quá {MAX_DECOMPRESSED_SIZE} bytes")
+        return result
+
+class CompressionStats:
+    """Đếm số byte trước và sau khi nén, theo cả hai chiều, để thấy băng thông tiết kiệm được."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stats = {"frames": 0, "compressed_frames": 0, "raw_bytes": 0, "wire_bytes": 0,
+                      "received_frames": 0, "received_wire_bytes": 0, "received_raw_bytes": 0}
+
+    def sent(self, raw, wire):
+        with self.lock:
+            self.stats["frames"] += 1
+            self.stats["raw_bytes"] += raw
+            self.stats["wire_bytes"] += wire
+            if wire != raw:
+                self.stats["compressed_frames"] += 1
+
+    def received(self, wire, raw):
+        with self.lock:
+            self.stats["received_frames"] += 1
+            self.stats["received_wire_bytes"] += wire
+            self.stats["received_raw_bytes"] += raw
+
+    def metrics(self):
+        with self.lock:
+            stats = dict(self.stats)
+        stats["saved_bytes"] = stats["raw_bytes"] - stats["wire_bytes"]
+        stats["ratio"] = round(stats["wire_bytes"] / stats["raw_bytes"], 3) if stats["raw_bytes"] else None
+        return stats
+
+compression_stats = CompressionStats()
+COMPRESSIONS = {  # Theo thứ tự ưu tiên giảm dần
+    "zlib-d1": ZlibCompression("zlib-d1", ZLIB_DICTIONARY),
+    "zlib": ZlibCompression("zlib"),
+}
+
+def available_compressions():
+    """Tên các thuật toán nén được hỗ trợ; gửi kèm yêu cầu hello."""
+    return list(COMPRESSIONS)
+
+def get_compression(name):
+    """Thuật toán nén theo tên trong phản hồi hello; None nếu không nén."""
+    if name is None:
+        return None
+    compression = COMPRESSIONS.get(name)
+    if compression is None:
+        log_event(f"Thuật toán nén {name} không được hỗ trợ, gửi không nén")
+    return compression
+
+def choose_compression(offered):
+    """Thuật toán đầu tiên theo thứ tự ưu tiên của tiến trình này mà bên kia cũng hỗ trợ, hoặc None."""
+    offered = offered or []
+    for name, compression in COMPRESSIONS.items():
+        if name in offered:
+            return compression
+    return None
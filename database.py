@@ -1,92 +1,259 @@
 import sqlite3
+import threading
+from contextlib import contextmanager
 import bcrypt
 from utils import log_event
 import os
 from datetime import datetime
 
 DB_FILE = "chat_app.db"
+ACTIVE_STATUS = "HOẠT ĐỘNG"  # Trạng thái của tin nhắn chưa bị xóa
+SEARCH_LIMIT = 100  # Số kết quả tìm kiếm tối đa trong một trang
+FTS_AVAILABLE = True
+CACHE_SIZE_KB = 16384  # Bộ nhớ đệm trang của mỗi kết nối (KiB)
+STATEMENT_CACHE = 128  # Số câu lệnh đã biên dịch được giữ lại trên mỗi kết nối
+BUSY_TIMEOUT_MS = 5000  # Thời gian chờ khi database đang bị khóa ghi
+SYNCHRONOUS = "NORMAL"  # FULL: fsync mỗi lần commit, NORMAL: chỉ fsync khi checkpoint WAL
+
+POOL_SIZE = 8  # Số kết nối tối đa; thread cần thêm kết nối phải chờ một kết nối được trả lại
+POOL_TIMEOUT = 10  # Thời gian chờ tối đa (giây) để mượn một kết nối
+
+def open_connection():
+    """Mở một kết nối mới đến DB_FILE.
+
+    Kết nối dùng WAL nên người đọc không chặn người ghi, synchronous=NORMAL
+    (an toàn với WAL, chỉ fsync khi checkpoint) và giữ cache câu lệnh đã biên dịch.
+    """
+    # check_same_thread=False vì kết nối được trả về pool và mượn lại bởi thread khác;
+    # tại mỗi thời điểm chỉ một thread giữ kết nối
+    conn = sqlite3.connect(DB_FILE, cached_statements=STATEMENT_CACHE, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute(f"PRAGMA synchronous={SYNCHRONOUS}")
+    conn.execute(f"PRAGMA cache_size=-{CACHE_SIZE_KB}")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute(f"PRAGMA busy_timeout={BUSY_TIMEOUT_MS}")
+    return conn
+
+class ConnectionPool:
+    """Pool có giới hạn các kết nối lâu dài, mượn và trả theo từng lệnh.
+
+    Số kết nối không phụ thuộc vào số thread (ví dụ mỗi yêu cầu Flask một thread), và
+    kết nối được giữ lại trong pool thay vì chết theo thread đã mở nó.
+    """
+    def __init__(self, size=POOL_SIZE):
+        self.size = size
+        self.idle = []  # Kết nối rảnh; dùng như ngăn xếp để kết nối vừa trả (cache còn nóng) được mượn trước
+        self.keys = {}  # {kết nối: (DB_FILE, thế hệ) lúc mở}
+        self.opened = 0  # Số kết nối đang mở hoặc đang được mở, kể cả kết nối đang được mượn
+        self.generation = 0  # Tăng mỗi lần close_all để kết nối cũ bị đóng khi được trả
+        self.cond = threading.Condition()
+
+    def checkout(self, timeout=POOL_TIMEOUT):
+        conn = None
+        stale = []
+        try:
+            with self.cond:
+                while conn is None:
+                    key = (DB_FILE, self.generation)
+                    while self.idle and conn is None:
+                        candidate = self.idle.pop()
+                        if self.keys[candidate] == key:
+                            conn = candidate
+                        else:
+                            # Mở trước khi đổi DB_FILE hoặc close_connections
+                            del self.keys[candidate]
+                            self.opened -= 1
+                            stale.append(candidate)
+                    if conn is None:
+                        if self.opened < self.size:
+                            self.opened += 1
+                            break
+                        if not self.cond.wait(timeout):
+                            raise TimeoutError(f"Không mượn được kết nối database sau {timeout} giây")
+        finally:
+            for old in stale:
+                old.close()
+        if conn is not None:
+            return conn
+        try:
+            conn = open_connection()
+        except Exception:
+            with self.cond:
+                self.opened -= 1
+                self.cond.notify()
+            raise
+        with self.cond:
+            self.keys[conn] = key
+        return conn
+
+    def checkin(self, conn):
+        # Transaction dở dang (lệnh lỗi giữa chừng) không được để lại cho người mượn sau
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+        except sqlite3.Error:
+            pass
+        with self.cond:
+            if self.keys.get(conn) == (DB_FILE, self.generation):
+                self.idle.append(conn)
+                conn = None
+            else:
+                self.keys.pop(conn, None)
+                self.opened -= 1
+            self.cond.notify()
+        if conn is not None:
+            conn.close()
+
+    def close_all(self):
+        with self.cond:
+            idle, self.idle = self.idle, []
+            for conn in idle:
+                del self.keys[conn]
+            self.opened -= len(idle)
+            self.generation += 1
+            self.cond.notify_all()
+        for conn in idle:
+            conn.close()
+
+_pool = ConnectionPool()
+
+@contextmanager
+def connection():
+    """Mượn một kết nối từ pool trong khối with; transaction chưa commit bị hủy khi trả."""
+    conn = _pool.checkout()
+    try:
+        yield conn
+    finally:
+        _pool.checkin(conn)
+
+def close_connections():
+    """Đóng mọi kết nối trong pool (dùng khi tắt ứng dụng hoặc đổi DB_FILE); kết nối đang mượn bị đóng khi được trả."""
+    _pool.close_all()
 
 def init_db():
     """Khởi tạo database và các bảng nếu chưa tồn tại."""
     try:
-        conn = sqlite3.connect(DB_FILE)
-        cursor = conn.cursor()
+        with connection() as conn:
+            cursor = conn.cursor()
         
-        # Tạo bảng users
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS users (
-                username TEXT PRIMARY KEY,
-                password_hash TEXT NOT NULL
-            )
-        ''')
+            # Tạo bảng users
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS users (
+                    username TEXT PRIMARY KEY,
+                    password_hash TEXT NOT NULL
+                )
+            ''')
         
-        # Tạo bảng messages
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS messages (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                channel TEXT NOT NULL,
-                sender TEXT NOT NULL,
-                message TEXT NOT NULL,
-                timestamp TEXT NOT NULL,
-                status TEXT NOT NULL
-            )
-        ''')
+            # Tạo bảng messages
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS messages (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    channel TEXT NOT NULL,
+                    sender TEXT NOT NULL,
+                    message TEXT NOT NULL,
+                    timestamp TEXT NOT NULL,
+                    status TEXT NOT NULL
+                )
+            ''')
         
-        # Tạo bảng channels
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS channels (
-                name TEXT PRIMARY KEY,
-                creator TEXT NOT NULL,
-                created_at TEXT NOT NULL
-            )
-        ''')
+            # Tạo bảng channels
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS channels (
+                    name TEXT PRIMARY KEY,
+                    creator TEXT NOT NULL,
+                    created_at TEXT NOT NULL
+                )
+            ''')
         
-        # Thêm chỉ mục cho cột channel để tăng tốc truy vấn
-        cursor.execute('CREATE INDEX IF NOT EXISTS idx_channel ON messages(channel)')
+            # Mọi truy vấn tin nhắn là quét khoảng trên (channel, id); chỉ mục riêng phần
+            # cho tin nhắn chưa xóa. idx_channel cũ bị thay bằng idx_messages_channel_id
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_messages_channel_id ON messages(channel, id)')
+            cursor.execute(f"CREATE INDEX IF NOT EXISTS idx_messages_active ON messages(channel, id) WHERE status = '{ACTIVE_STATUS}'")
+            cursor.execute('DROP INDEX IF EXISTS idx_channel')
         
-        # Thêm kênh mặc định 'general' nếu chưa tồn tại
-        cursor.execute("SELECT name FROM channels WHERE name = ?", ("general",))
-        if not cursor.fetchone():
-            timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-            cursor.execute("INSERT INTO channels (name, creator, created_at) VALUES (?, ?, ?)",
-                          ("general", "system", timestamp))
+            init_search_index(cursor)
         
-        conn.commit()
-        log_event("Khởi tạo database thành công")
+            # Thêm kênh mặc định 'general' nếu chưa tồn tại
+            cursor.execute("SELECT name FROM channels WHERE name = ?", ("general",))
+            if not cursor.fetchone():
+                timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+                cursor.execute("INSERT INTO channels (name, creator, created_at) VALUES (?, ?, ?)",
+                              ("general", "system", timestamp))
+        
+            conn.commit()
+            log_event("Khởi tạo database thành công")
     except Exception as e:
         log_event(f"Lỗi khởi tạo database: {e}")
-    finally:
-        conn.close()
+
+def init_search_index(cursor):
+    """Tạo chỉ mục FTS5 (external content) trên messages, giữ đồng bộ bằng trigger.
+
+    Khi chỉ mục vừa được tạo trên database đã có tin nhắn, toàn bộ nội dung được lập chỉ mục lại một lần.
+    """
+    global FTS_AVAILABLE
+    try:
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'messages_fts'")
+        exists = cursor.fetchone() is not None
+        cursor.execute('''
+            CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+                message, sender, channel,
+                content='messages', content_rowid='id',
+                tokenize='unicode61 remove_diacritics 2'
+            )
+        ''')
+        cursor.execute('''
+            CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages BEGIN
+                INSERT INTO messages_fts(rowid, message, sender, channel) VALUES (new.id, new.message, new.sender, new.channel);
+            END
+        ''')
+        cursor.execute('''
+            CREATE TRIGGER IF NOT EXISTS messages_fts_delete AFTER DELETE ON messages BEGIN
+                INSERT INTO messages_fts(messages_fts, rowid, message, sender, channel) VALUES ('delete', old.id, old.message, old.sender, old.channel);
+            END
+        ''')
+        cursor.execute('''
+            CREATE TRIGGER IF NOT EXISTS messages_fts_update AFTER UPDATE OF message, sender, channel ON messages BEGIN
+                INSERT INTO messages_fts(messages_fts, rowid, message, sender, channel) VALUES ('delete', old.id, old.message, old.sender, old.channel);
+                INSERT INTO messages_fts(rowid, message, sender, channel) VALUES (new.id, new.message, new.sender, new.channel);
+            END
+        ''')
+        if not exists:
+            cursor.execute("INSERT INTO messages_fts(messages_fts) VALUES ('rebuild')")
+            log_event("Đã lập chỉ mục tìm kiếm cho các tin nhắn hiện có")
+        FTS_AVAILABLE = True
+    except sqlite3.OperationalError as e:
+        # SQLite được biên dịch không có FTS5: tìm kiếm quay về LIKE
+        FTS_AVAILABLE = False
+        log_event(f"Không thể tạo chỉ mục FTS5, tìm kiếm sẽ dùng LIKE: {e}")
 
 def register_user(username, password):
     """Đăng ký người dùng mới với mật khẩu băm."""
     if not username or not password:
         return False
     try:
-        conn = sqlite3.connect(DB_FILE)
-        cursor = conn.cursor()
+        # Băm mật khẩu (chậm) trước khi mượn kết nối, để không giữ kết nối của pool
         password_hash = bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt())
-        cursor.execute("INSERT INTO users (username, password_hash) VALUES (?, ?)", 
-                      (username, password_hash))
-        conn.commit()
-        log_event(f"Đăng ký người dùng: {username}")
-        return True
+        with connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("INSERT INTO users (username, password_hash) VALUES (?, ?)", 
+                          (username, password_hash))
+            conn.commit()
+            log_event(f"Đăng ký người dùng: {username}")
+            return True
     except sqlite3.IntegrityError:
         log_event(f"Người dùng {username} đã tồn tại")
         return False
     except Exception as e:
         log_event(f"Lỗi đăng ký người dùng: {e}")
         return False
-    finally:
-        conn.close()
 
 def login_user(username, password):
     """Xác thực người dùng dựa trên tên và mật khẩu."""
     try:
-        conn = sqlite3.connect(DB_FILE)
-        cursor = conn.cursor()
-        cursor.execute("SELECT password_hash FROM users WHERE username = ?", (username,))
-        result = cursor.fetchone()
+        with connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT password_hash FROM users WHERE username = ?", (username,))
+            result = cursor.fetchone()
         if result and bcrypt.checkpw(password.encode('utf-8'), result[0]):
             log_event(f"Đăng nhập thành công: {username}")
             return True
@@ -95,76 +262,206 @@ def login_user(username, password):
     except Exception as e:
         log_event(f"Lỗi đăng nhập: {e}")
         return False
-    finally:
-        conn.close()
 
-def save_message(channel, sender, message, timestamp=None, status="HOẠT ĐỘNG"):
-    """Lưu tin nhắn vào database."""
+def save_message(channel, sender, message, timestamp=None, status=ACTIVE_STATUS):
+    """Lưu tin nhắn vào database. Trả về True khi đã commit."""
     if not timestamp:
         timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
     try:
-        conn = sqlite3.connect(DB_FILE)
-        cursor = conn.cursor()
-        cursor.execute('''
-            INSERT INTO messages (channel, sender, message, timestamp, status)
-            VALUES (?, ?, ?, ?, ?)
-        ''', (channel, sender, message, timestamp, status))
-        conn.commit()
-        log_event(f"Lưu tin nhắn vào database: kênh={channel}, người gửi={sender}")
+        with connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                INSERT INTO messages (channel, sender, message, timestamp, status)
+                VALUES (?, ?, ?, ?, ?)
+            ''', (channel, sender, message, timestamp, status))
+            conn.commit()
+            log_event(f"Lưu tin nhắn vào database: kênh={channel}, người gửi={sender}")
+            return True
     except Exception as e:
         log_event(f"Lỗi lưu tin nhắn: {e}")
-    finally:
-        conn.close()
+        return False
+
+def save_message_batch(rows, creator="system", status=ACTIVE_STATUS):
+    """Lưu nhiều tin nhắn (channel, sender, message, timestamp) trong một transaction.
+
+    Các kênh chưa tồn tại được tạo trong cùng transaction. Trả về True khi đã commit.
+    """
+    if not rows:
+        return True
+    try:
+        with connection() as conn:
+            cursor = conn.cursor()
+            created_at = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            cursor.executemany("INSERT OR IGNORE INTO channels (name, creator, created_at) VALUES (?, ?, ?)",
+                               [(channel, creator, created_at) for channel in {row[0] for row in rows}])
+            cursor.executemany('''
+                INSERT INTO messages (channel, sender, message, timestamp, status)
+                VALUES (?, ?, ?, ?, ?)
+            ''', [(channel, sender, message, timestamp, status) for channel, sender, message, timestamp in rows])
+            conn.commit()
+            log_event(f"Lưu {len(rows)} tin nhắn vào database trong một transaction")
+            return True
+    except Exception as e:
+        log_event(f"Lỗi lưu lô tin nhắn: {e}")
+        return False
+
+def save_message_rows(rows):
+    """Lưu nhiều tin nhắn (channel, sender, message, timestamp, status) của các kênh đã tồn tại trong một transaction."""
+    if not rows:
+        return True
+    try:
+        with connection() as conn:
+            cursor = conn.cursor()
+            cursor.executemany('''
+                INSERT INTO messages (channel, sender, message, timestamp, status)
+                VALUES (?, ?, ?, ?, ?)
+            ''', rows)
+            conn.commit()
+            log_event(f"Lưu {len(rows)} tin nhắn vào database trong một lần commit")
+            return True
+    except Exception as e:
+        log_event(f"Lỗi lưu nhóm tin nhắn: {e}")
+        return False
 
-def get_messages(channel):
-    """Lấy tất cả tin nhắn của một kênh từ database."""
+def query_messages(channel, before_id=None, after_id=None, limit=None, newest_first=False, active_only=False):
+    """Truy vấn keyset trên chỉ mục (channel, id); kết quả luôn theo thứ tự id tăng dần.
+
+    before_id/after_id giới hạn khoảng id (không bao gồm biên). newest_first=True lấy
+    limit tin nhắn mới nhất trong khoảng thay vì cũ nhất. active_only chỉ lấy tin nhắn
+    chưa bị xóa, dùng chỉ mục riêng phần idx_messages_active.
+    """
+    conditions = ["channel = ?"]
+    params = [channel]
+    if after_id is not None:
+        conditions.append("id > ?")
+        params.append(after_id)
+    if before_id is not None:
+        conditions.append("id < ?")
+        params.append(before_id)
+    if active_only:
+        # Phải là hằng số trong câu lệnh (không phải tham số) để SQLite chọn được chỉ mục riêng phần
+        conditions.append(f"status = '{ACTIVE_STATUS}'")
+    sql = f"SELECT id, sender, message, timestamp, status FROM messages WHERE {' AND '.join(conditions)} ORDER BY id {'DESC' if newest_first else 'ASC'}"
+    if limit is not None:
+        sql += " LIMIT ?"
+        params.append(limit)
     try:
-        conn = sqlite3.connect(DB_FILE)
-        cursor = conn.cursor()
-        cursor.execute("SELECT sender, message, timestamp, status FROM messages WHERE channel = ? ORDER BY timestamp", (channel,))
-        messages = [{"sender": row[0], "message": row[1], "timestamp": row[2], "status": row[3]} for row in cursor.fetchall()]
-        log_event(f"Lấy {len(messages)} tin nhắn từ database cho kênh {channel}")
-        return messages
+        with connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(sql, params)
+            messages = [{"id": row[0], "sender": row[1], "message": row[2], "timestamp": row[3], "status": row[4]} for row in cursor.fetchall()]
+            if newest_first:
+                messages.reverse()
+            log_event(f"Lấy {len(messages)} tin nhắn cho kênh {channel} (trước id {before_id}, sau id {after_id})")
+            return messages
     except Exception as e:
-        log_event(f"Lỗi lấy tin nhắn: {e}")
+        log_event(f"Lỗi truy vấn tin nhắn: {e}")
         return []
-    finally:
-        conn.close()
+
+def get_messages(channel, active_only=False):
+    """Lấy tất cả tin nhắn của một kênh từ database theo thứ tự id."""
+    return query_messages(channel, active_only=active_only)
+
+def get_latest_messages(channel, limit, active_only=False):
+    """Lấy limit tin nhắn mới nhất của kênh."""
+    return query_messages(channel, limit=limit, newest_first=True, active_only=active_only)
+
+def get_messages_before(channel, before_id, limit, active_only=False):
+    """Lấy limit tin nhắn mới nhất có id nhỏ hơn before_id (trang cũ hơn khi cuộn lên)."""
+    return query_messages(channel, before_id=before_id, limit=limit, newest_first=True, active_only=active_only)
+
+def get_messages_after(channel, after_id, limit=None, active_only=False):
+    """Lấy tối đa limit tin nhắn có id lớn hơn after_id.
+
+    id do database cấp (AUTOINCREMENT) nên luôn tăng đơn điệu trong mỗi kênh và dùng được làm con trỏ đồng bộ.
+    """
+    return query_messages(channel, after_id=after_id, limit=limit, active_only=active_only)
+
+def fts_phrase(text):
+    return '"' + text.replace('"', '""') + '"'
+
+def like_pattern(text):
+    """Mẫu LIKE chứa text (dùng với ESCAPE '\\'): %, _ và \\ trong text được khớp nguyên văn."""
+    return "%" + text.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+
+def search_messages(query, channel=None, limit=20, offset=0):
+    """Tìm tin nhắn chưa xóa theo nội dung hoặc người gửi, xếp hạng bằng bm25.
+
+    Mỗi từ trong query được đặt trong dấu nháy (không dùng cú pháp FTS5 của người dùng),
+    các từ đều phải xuất hiện và từ cuối được khớp theo tiền tố. Trả về
+    (danh sách kết quả, còn trang sau hay không).
+    """
+    terms = query.split()
+    if not terms:
+        return [], False
+    limit = max(1, min(int(limit), SEARCH_LIMIT))
+    offset = max(0, int(offset))
+    try:
+        with connection() as conn:
+            cursor = conn.cursor()
+            if FTS_AVAILABLE:
+                match = "{message sender} : (" + " ".join(fts_phrase(term) for term in terms) + "*)"
+                params = []
+                if channel:
+                    # Lọc kênh ngay trong chỉ mục, sau đó so khớp chính xác tên kênh
+                    match += " AND channel : " + fts_phrase(channel)
+                sql = '''
+                    SELECT m.id, m.channel, m.sender, m.message, m.timestamp
+                    FROM messages_fts JOIN messages m ON m.id = messages_fts.rowid
+                    WHERE messages_fts MATCH ?'''
+                params.append(match)
+                if channel:
+                    sql += " AND m.channel = ?"
+                    params.append(channel)
+                sql += f" AND m.status = '{ACTIVE_STATUS}' ORDER BY bm25(messages_fts) LIMIT ? OFFSET ?"
+            else:
+                conditions = " AND ".join("(m.message LIKE ? ESCAPE '\\' OR m.sender LIKE ? ESCAPE '\\')" for _ in terms)
+                params = [like_pattern(term) for term in terms for _ in (0, 1)]
+                sql = f"SELECT m.id, m.channel, m.sender, m.message, m.timestamp FROM messages m WHERE {conditions}"
+                if channel:
+                    sql += " AND m.channel = ?"
+                    params.append(channel)
+                sql += f" AND m.status = '{ACTIVE_STATUS}' ORDER BY m.id DESC LIMIT ? OFFSET ?"
+            params += [limit + 1, offset]
+            cursor.execute(sql, params)
+            rows = cursor.fetchall()
+            results = [{"id": row[0], "channel": row[1], "sender": row[2], "message": row[3], "timestamp": row[4]} for row in rows[:limit]]
+            log_event(f"Tìm kiếm '{query}' trong kênh {channel}: {len(results)} kết quả")
+            return results, len(rows) > limit
+    except Exception as e:
+        log_event(f"Lỗi tìm kiếm tin nhắn: {e}")
+        return [], False
 
 def create_channel(channel, creator):
     """Lưu kênh mới vào database."""
     try:
-        conn = sqlite3.connect(DB_FILE)
-        cursor = conn.cursor()
-        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        cursor.execute("INSERT INTO channels (name, creator, created_at) VALUES (?, ?, ?)", 
-                      (channel, creator, timestamp))
-        conn.commit()
-        log_event(f"Tạo kênh trong database: {channel} bởi {creator}")
-        return True
+        with connection() as conn:
+            cursor = conn.cursor()
+            timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            cursor.execute("INSERT INTO channels (name, creator, created_at) VALUES (?, ?, ?)", 
+                          (channel, creator, timestamp))
+            conn.commit()
+            log_event(f"Tạo kênh trong database: {channel} bởi {creator}")
+            return True
     except sqlite3.IntegrityError:
         log_event(f"Kênh {channel} đã tồn tại")
         return False
     except Exception as e:
         log_event(f"Lỗi tạo kênh: {e}")
         return False
-    finally:
-        conn.close()
 
 def get_channels():
     """Lấy danh sách tất cả kênh từ database."""
     try:
-        conn = sqlite3.connect(DB_FILE)
-        cursor = conn.cursor()
-        cursor.execute("SELECT name FROM channels")
-        channels = [row[0] for row in cursor.fetchall()]
-        log_event(f"Lấy {len(channels)} kênh từ database")
-        return channels
+        with connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT name FROM channels")
+            channels = [row[0] for row in cursor.fetchall()]
+            log_event(f"Lấy {len(channels)} kênh từ database")
+            return channels
     except Exception as e:
         log_event(f"Lỗi lấy danh sách kênh: {e}")
         return []
-    finally:
-        conn.close()
 
 if __name__ == "__main__":
     if not os.path.exists(DB_FILE):
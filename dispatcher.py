@@ -0,0 +1,66 @@
+import threading
+import queue
+import zlib
+from concurrent.futures import Future, ThreadPoolExecutor
+from utils import log_event
+
+CHANNEL_SHARDS = 8  # Số shard cho các yêu cầu theo kênh
+POOL_WORKERS = 8  # Số thread cho xác thực và các yêu cầu không cần thứ tự
+
+# Yêu cầu gắn với một kênh: xử lý tuần tự trong shard của kênh đó
+CHANNEL_REQUESTS = {'sync_upload', 'sync_download', 'get_history', 'start_livestream', 'stop_livestream', 'create_channel'}
+# sync_upload_batch có thể gồm nhiều kênh nên chạy trong pool; SQLite tự tuần tự hóa transaction của nó
+# Yêu cầu thay đổi tracker: xử lý tuần tự trong shard tracker
+TRACKER_REQUESTS = {'get_list', 'update_status', 'disconnect', 'heartbeat'}
+
+class SerialShard:
+    """Shard có một worker thread duy nhất, giữ đúng thứ tự các tác vụ được gửi vào."""
+    def __init__(self, name):
+        self.name = name
+        self.tasks = queue.Queue()
+        self.thread = threading.Thread(target=self._run, name=f"shard-{name}", daemon=True)
+        self.thread.start()
+
+    def submit(self, fn, *args):
+        future = Future()
+        self.tasks.put((future, fn, args))
+        return future
+
+    def _run(self):
+        while True:
+            future, fn, args = self.tasks.get()
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(fn(*args))
+            except BaseException as e:
+                log_event(f"Lỗi trong shard {self.name}: {type(e).__name__}: {str(e)}")
+                future.set_exception(e)
+
+class Dispatcher:
+    """Định tuyến mỗi yêu cầu đến shard phù hợp thay cho một lock toàn cục.
+
+    Các kênh khác nhau và người dùng khác nhau được xử lý song song, trong khi
+    các yêu cầu của cùng một kênh vẫn giữ nguyên thứ tự.
+    """
+    def __init__(self, channel_shards=CHANNEL_SHARDS, pool_workers=POOL_WORKERS):
+        self.channel_shards = [SerialShard(f"channel-{i}") for i in range(channel_shards)]
+        self.tracker_shard = SerialShard("tracker")
+        self.pool = ThreadPoolExecutor(max_workers=pool_workers, thread_name_prefix="auth")
+
+    def channel_shard(self, channel):
+        key = str(channel).encode('utf-8')
+        return self.channel_shards[zlib.crc32(key) % len(self.channel_shards)]
+
+    def submit(self, request, fn, *args):
+        """Gửi fn(*args) đến shard của yêu cầu, trả về một Future."""
+        request_type = request.get('type') if isinstance(request, dict) else None
+        if request_type in CHANNEL_REQUESTS and 'channel' in request:
+            return self.channel_shard(request['channel']).submit(fn, *args)
+        if request_type in TRACKER_REQUESTS:
+            return self.tracker_shard.submit(fn, *args)
+        return self.pool.submit(fn, *args)
+
+    def call_tracker(self, fn, *args):
+        """Chạy một thay đổi tracker trong shard tracker và chờ kết quả (không gọi từ chính shard tracker)."""
+        return self.tracker_shard.submit(fn, *args).result()
@@ -0,0 +1,256 @@
+import threading
+import time
+from typing import Dict, Any
+import cv2
+from utils import log_event, SampledCounter
+from p2p import connect_video, close_video, send_video_frame, unsent_bytes, VIDEO_FLAG_HELLO
+
+# Các mức chất lượng (rộng, cao, chất lượng JPEG, fps), từ cao xuống thấp. Mỗi người xem
+# được gửi ở một mức và tự chuyển mức theo độ trễ và băng thông đo được.
+QUALITY_LEVELS = [
+    (320, 240, 70, 20),
+    (160, 120, 50, 20),
+    (160, 120, 40, 15),
+    (160, 120, 30, 10),
+    (112, 84, 30, 8),
+    (80, 60, 25, 5),
+]
+DEFAULT_LEVEL = 1  # Tương đương chất lượng trước khi có điều chỉnh: 160x120, JPEG 50, 20 fps
+LATENCY_TARGET = 0.3  # Tuổi tối đa (giây) của khung khi được gửi xong trước khi giảm mức
+ADAPT_WINDOW = 1.0  # Chu kỳ (giây) đánh giá và điều chỉnh mức của mỗi người xem
+BUSY_HIGH = 0.8  # Tỉ lệ thời gian bận gửi vượt mức này thì giảm mức
+BUSY_LOW = 0.4  # Dưới mức này (và độ trễ thấp) trong UPGRADE_WINDOWS chu kỳ liền thì tăng mức
+UPGRADE_WINDOWS = 3
+VIEWER_SEND_BUFFER = 64 * 1024  # SO_SNDBUF nhỏ để khung không nằm hàng giây trong kernel
+VIEWER_MAX_BACKLOG = 16 * 1024  # Còn nhiều byte chưa gửi hơn thì chờ, khung mới tiếp tục ghi đè slot
+BACKLOG_POLL = 0.005
+
+class ViewerSender:
+    """Gửi khung đến một người xem bằng thread riêng, chỉ giữ khung mới nhất (latest-wins).
+
+    Khung mới ghi đè khung chưa kịp gửi, và khung chỉ được gửi khi hàng đợi gửi của kernel
+    dưới VIEWER_MAX_BACKLOG, nên người xem chậm bị bỏ khung thay vì tích lũy độ trễ. Sau
+    mỗi ADAPT_WINDOW giây, độ trễ (tuổi khung khi gửi xong) và tỉ lệ thời gian bận gửi quyết
+    định việc giảm hoặc tăng mức trong QUALITY_LEVELS[min_level..max_level].
+    """
+    def __init__(self, peer: Dict[str, Any], streamer: str, level: int = DEFAULT_LEVEL,
+                 min_level: int = 0, max_level: int = len(QUALITY_LEVELS) - 1, latency_target: float = LATENCY_TARGET):
+        self.peer = peer
+        self.streamer = streamer
+        self.min_level = min_level
+        self.max_level = max_level
+        self.level = min(max(level, min_level), max_level)
+        self.latency_target = latency_target
+        self.slot = None  # Khung mới nhất chưa gửi
+        self.sequence = 0  # Số thứ tự trên kết nối này: chỉ tăng khi thật sự gửi một khung
+        self.cond = threading.Condition()
+        self.running = True
+        self.alive = True
+        self.last_offer = 0.0
+        self.window_start = time.monotonic()
+        self.window_busy = 0.0  # Tổng thời gian chờ hàng đợi kernel và nằm trong sendall của chu kỳ hiện tại
+        self.window_bytes = 0
+        self.window_age = 0.0  # Tuổi lớn nhất của khung khi gửi xong trong chu kỳ
+        self.good_windows = 0
+        self.stats = SampledCounter(f"Gửi video đến {peer['username']}")
+        self.thread = threading.Thread(target=self._run, name=f"video-{peer['username']}", daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def wants(self, now):
+        """Mức chất lượng (rộng, cao, JPEG) người xem cần cho khung chụp lúc now, hoặc None nếu chưa đến lượt theo fps."""
+        width, height, quality, fps = QUALITY_LEVELS[self.level]
+        if now - self.last_offer < 1 / fps - 0.005:
+            return None
+        self.last_offer = now
+        return width, height, quality
+
+    def offer(self, frame):
+        """frame = (thời điểm chụp µs, bộ đệm JPEG) dùng chung giữa các người xem cùng mức."""
+        with self.cond:
+            if self.slot is not None:
+                self.stats.add("bỏ khung")
+            self.slot = frame
+            self.cond.notify()
+
+    def stop(self):
+        with self.cond:
+            self.running = False
+            self.cond.notify()
+
+    def _run(self):
+        conn = connect_video(self.peer, send_buffer=VIEWER_SEND_BUFFER)
+        if conn is None:
+            self.alive = False
+            return
+        try:
+            send_video_frame(conn, 0, self.streamer.encode('utf-8'), VIDEO_FLAG_HELLO)
+            self.window_start = time.monotonic()
+            while True:
+                with self.cond:
+                    while self.running and self.slot is None:
+                        self.cond.wait()
+                    if not self.running:
+                        break
+                started = time.monotonic()
+                backlog = unsent_bytes(conn)
+                if backlog is not None and backlog > VIEWER_MAX_BACKLOG:
+                    self.stats.add("chờ hàng đợi")
+                    while self.running and backlog is not None and backlog > VIEWER_MAX_BACKLOG:
+                        time.sleep(BACKLOG_POLL)
+                        backlog = unsent_bytes(conn)
+                with self.cond:
+                    if not self.running:
+                        break
+                    (timestamp_us, jpeg), self.slot = self.slot, None
+                # Khung bị bỏ (theo fps hoặc bị ghi đè) không tiêu số thứ tự, nên bên nhận
+                # chỉ thấy khoảng trống khi khung đã gửi thật sự bị mất
+                send_video_frame(conn, self.sequence, jpeg, timestamp_us=timestamp_us)
+                self.sequence = (self.sequence + 1) & 0xFFFFFFFF
+                finished = time.monotonic()
+                self.window_busy += finished - started
+                self.window_bytes += len(jpeg)
+                self.window_age = max(self.window_age, (time.time_ns() // 1000 - timestamp_us) / 1e6)
+                self.stats.add("khung")
+                self.stats.add("bytes", len(jpeg))
+                self._adapt(finished)
+        except Exception as e:
+            log_event(f"Lỗi gửi video đến {self.peer['username']}: {type(e).__name__}: {str(e)}")
+        finally:
+            self.alive = False
+            self.stats.flush()
+            close_video(conn)
+
+    def _adapt(self, now):
+        elapsed = now - self.window_start
+        if elapsed < ADAPT_WINDOW:
+            return
+        busy = self.window_busy / elapsed
+        age = self.window_age
+        if age > self.latency_target or busy > BUSY_HIGH:
+            self.good_windows = 0
+            if self.level < self.max_level:
+                self._set_level(self.level + 1, age, busy, elapsed)
+        elif busy < BUSY_LOW and age < self.latency_target / 2:
+            self.good_windows += 1
+            if self.good_windows >= UPGRADE_WINDOWS and self.level > self.min_level:
+                self.good_windows = 0
+                self._set_level(self.level - 1, age, busy, elapsed)
+        else:
+            self.good_windows = 0
+        self.window_start = now
+        self.window_busy = 0.0
+        self.window_bytes = 0
+        self.window_age = 0.0
+
+    def _set_level(self, level, age, busy, elapsed):
+        width, height, quality, fps = QUALITY_LEVELS[level]
+        log_event(f"Video đến {self.peer['username']}: chuyển sang {width}x{height} JPEG {quality} @ {fps} fps "
+                  f"(trễ {age * 1000:.0f} ms, bận {busy:.0%}, {self.window_bytes * 8 / elapsed / 1000:.0f} kbit/s)")
+        self.level = level
+        self.stats.add("đổi mức")
+
+class LivestreamPipeline:
+    """Một thread chụp camera; mỗi khung được mã hóa JPEG một lần cho mỗi mức chất lượng đang dùng.
+
+    Bộ đệm JPEG được chia sẻ (theo tham chiếu) cho mọi người xem cùng mức, nên chi phí CPU
+    phụ thuộc vào số mức đang dùng chứ không vào số người xem. Khung gốc mới nhất được giữ
+    lại cho bản xem trước cục bộ, thay vì đọc camera lần thứ hai.
+    """
+    def __init__(self, cap, streamer: str, min_level: int = 0, max_level: int = len(QUALITY_LEVELS) - 1,
+                 start_level: int = DEFAULT_LEVEL, latency_target: float = LATENCY_TARGET):
+        self.cap = cap
+        self.streamer = streamer
+        self.min_level = min_level
+        self.max_level = max_level
+        self.start_level = start_level
+        self.latency_target = latency_target
+        # Chụp theo fps cao nhất mà người xem có thể được gửi
+        self.frame_interval = 1 / max(fps for _, _, _, fps in QUALITY_LEVELS[min_level:max_level + 1])
+        self.lock = threading.Lock()
+        self.viewers = {}  # {(ip, port): ViewerSender}
+        self.preview = (None, -1)  # (khung gốc BGR mới nhất, số thứ tự)
+        self.running = False
+        self.thread = None
+        self.stats = SampledCounter("Livestream")
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self._capture_loop, name="livestream-capture", daemon=True)
+        self.thread.start()
+        log_event(f"Bắt đầu pipeline livestream @ {1 / self.frame_interval:.0f} fps, "
+                  f"mức {self.min_level}-{self.max_level}, độ trễ mục tiêu {self.latency_target * 1000:.0f} ms")
+
+    def add_viewer(self, peer: Dict[str, Any]):
+        key = (peer['ip'], peer['port'])
+        with self.lock:
+            viewer = self.viewers.get(key)
+            if viewer is not None and viewer.alive:
+                return
+            viewer = self.viewers[key] = ViewerSender(peer, self.streamer, self.start_level, self.min_level,
+                                                      self.max_level, self.latency_target)
+        viewer.start()
+
+    def remove_viewer(self, peer: Dict[str, Any]):
+        with self.lock:
+            viewer = self.viewers.pop((peer['ip'], peer['port']), None)
+        if viewer is not None:
+            viewer.stop()
+
+    def latest_preview(self):
+        """(khung gốc BGR mới nhất, số thứ tự); khung là None nếu chưa chụp được khung nào."""
+        return self.preview
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None and self.thread is not threading.current_thread():
+            self.thread.join(timeout=2)
+        with self.lock:
+            viewers, self.viewers = list(self.viewers.values()), {}
+        for viewer in viewers:
+            viewer.stop()
+        self.stats.flush()
+        log_event("Dừng pipeline livestream")
+
+    def _capture_loop(self):
+        sequence = 0
+        next_frame = time.monotonic()
+        while self.running and self.cap.isOpened():
+            ret, frame = self.cap.read()
+            if not ret:
+                log_event("Không thể đọc khung video từ camera")
+                break
+            timestamp_us = time.time_ns() // 1000
+            now = time.monotonic()
+            self.preview = (frame, sequence)
+            with self.lock:
+                viewers = [viewer for viewer in self.viewers.values() if viewer.alive]
+            encoded = {}  # {(rộng, cao, JPEG): khung đã mã hóa} của khung này
+            for viewer in viewers:
+                tier = viewer.wants(now)
+                if tier is None:
+                    continue
+                if tier not in encoded:
+                    encoded[tier] = self._encode(frame, tier, timestamp_us)
+                if encoded[tier] is not None:
+                    viewer.offer(encoded[tier])
+            if encoded:
+                self.stats.add("khung")
+                self.stats.add("mã hóa", len(encoded))
+            sequence = (sequence + 1) & 0xFFFFFFFF
+            next_frame += self.frame_interval
+            delay = next_frame - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                next_frame = time.monotonic()
+        self.running = False
+
+    def _encode(self, frame, tier, timestamp_us):
+        """(thời điểm chụp µs, JPEG) của khung ở một mức; không gắn số thứ tự để bộ đệm dùng chung được cho mọi người xem."""
+        width, height, quality = tier
+        if frame.shape[1] != width or frame.shape[0] != height:
+            frame = cv2.resize(frame, (width, height))
+        ok, jpeg = cv2.imencode('.jpg', frame, [int(cv2.IMWRITE_JPEG_QUALITY), quality])
+        return (timestamp_us, jpeg) if ok else None
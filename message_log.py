@@ -1,41 +1,306 @@
 import os
+import json
+import time
+import atexit
+import struct
+import bisect
+import threading
+from collections import deque
 from datetime import datetime
 from utils import log_event
 
 LOG_DIR = "logs"
-MESSAGE_LOG_FILE = os.path.join(LOG_DIR, "message_log.txt")
+MESSAGE_LOG_DIR = os.path.join(LOG_DIR, "message_log")
+SEGMENT_MAX_BYTES = 8 * 1024 * 1024  # Kích thước tối đa của một segment trước khi mở segment mới
+INDEX_INTERVAL_BYTES = 4096  # Cứ mỗi khoảng này trong segment thì ghi một mục chỉ mục (thời gian, vị trí)
+RECOVER_CHUNK = 65536  # Kích thước mỗi lần đọc ngược khi tìm dòng hoàn chỉnh cuối cùng
+AUDIT_QUEUE_SIZE = 10000  # Hàng đợi đầy thì bên ghi phải chờ: log kiểm toán không bỏ bản ghi
+INDEX_ENTRY = struct.Struct(">dQ")  # (timestamp, offset trong file .log)
+
+class MessageLog:
+    """Log kiểm toán tin nhắn chỉ ghi nối (append-only), chia thành các segment.
+
+    Mỗi segment gồm file NNNNNNNN.log (mỗi dòng một bản ghi JSON) và file NNNNNNNN.idx
+    chứa chỉ mục thưa (timestamp, offset) cho mỗi INDEX_INTERVAL_BYTES dữ liệu. Khi segment
+    vượt SEGMENT_MAX_BYTES thì segment mới được mở; các segment cũ được giữ nguyên, không
+    bị xóa. Việc ghi do một thread nền gom lô; read() dùng chỉ mục để nhảy thẳng tới
+    khoảng thời gian cần đọc.
+    """
+    def __init__(self, directory=MESSAGE_LOG_DIR, segment_max_bytes=SEGMENT_MAX_BYTES,
+                 index_interval=INDEX_INTERVAL_BYTES, queue_size=AUDIT_QUEUE_SIZE):
+        self.directory = directory
+        self.segment_max_bytes = segment_max_bytes
+        self.index_interval = index_interval
+        self.queue_size = queue_size
+        self.records = deque()
+        self.cond = threading.Condition()
+        self.thread = None
+        self.writing = False
+        self.segment = None  # Số thứ tự segment đang ghi
+        self.log_file = None
+        self.index_file = None
+        self.size = 0
+        self.last_indexed = None  # Offset của mục chỉ mục gần nhất
+        self.last_ts = 0.0
+        self.stats = {"written": 0, "segments": 0, "errors": 0}
+
+    def append(self, channel, message, sender, deleted=False):
+        record = {
+            "ts": time.time(),
+            "channel": channel,
+            "sender": sender,
+            "message": message,
+            "status": "ĐÃ XÓA" if deleted else "HOẠT ĐỘNG"
+        }
+        with self.cond:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name="message-log-writer", daemon=True)
+                self.thread.start()
+            while len(self.records) >= self.queue_size:
+                self.cond.wait()
+            self.records.append(record)
+            if len(self.records) == 1:
+                self.cond.notify_all()
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while not self.records:
+                    self.cond.wait()
+                batch, self.records = self.records, deque()
+                self.writing = True
+                # Đánh thức các bên ghi đang chờ vì hàng đợi đầy
+                self.cond.notify_all()
+            self._write_batch(batch)
+            with self.cond:
+                self.writing = False
+                self.cond.notify_all()
+
+    def _write_batch(self, batch):
+        try:
+            if self.log_file is None:
+                self._open_active()
+            chunks = []
+            index_entries = []
+            offset = self.size
+            for record in batch:
+                # Giữ timestamp không giảm trong log để chỉ mục luôn được sắp xếp
+                record["ts"] = self.last_ts = max(record["ts"], self.last_ts)
+                line = (json.dumps(record, ensure_ascii=False) + "\n").encode('utf-8', errors='replace')
+                if offset > 0 and offset + len(line) > self.segment_max_bytes:
+                    self._flush_chunks(chunks, index_entries)
+                    chunks, index_entries = [], []
+                    self._roll()
+                    offset = 0
+                if self.last_indexed is None or offset - self.last_indexed >= self.index_interval:
+                    index_entries.append(INDEX_ENTRY.pack(record["ts"], offset))
+                    self.last_indexed = offset
+                chunks.append(line)
+                offset += len(line)
+            self._flush_chunks(chunks, index_entries)
+            with self.cond:
+                self.stats["written"] += len(batch)
+        except Exception as e:
+            with self.cond:
+                self.stats["errors"] += 1
+            error_msg = f"Lỗi ghi log tin nhắn: {type(e).__name__}: {str(e)}"
+            print(error_msg)
+            log_event(error_msg)
+            self._close()
+
+    def _flush_chunks(self, chunks, index_entries):
+        if chunks:
+            data = b"".join(chunks)
+            self.log_file.write(data)
+            self.log_file.flush()
+            self.size += len(data)
+        if index_entries:
+            self.index_file.write(b"".join(index_entries))
+            self.index_file.flush()
+
+    def _segment_path(self, number, ext):
+        return os.path.join(self.directory, f"{number:08d}.{ext}")
+
+    def _segments(self):
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return []
+        return sorted(int(name[:-4]) for name in names if name.endswith(".log") and name[:-4].isdigit())
+
+    def _open_active(self):
+        os.makedirs(self.directory, exist_ok=True)
+        segments = self._segments()
+        self.segment = segments[-1] if segments else 0
+        log_path = self._segment_path(self.segment, "log")
+        self.log_file = open(log_path, "ab")
+        self.size = self.log_file.tell()
+        if self.size:
+            self._recover_tail(log_path)
+        self._open_index()
+
+    def _recover_tail(self, log_path):
+        """Cắt bỏ dòng ghi dở ở cuối segment (nếu tiến trình trước dừng giữa chừng)."""
+        cut = 0  # Chỉ cắt về 0 khi cả file không có ký tự xuống dòng nào
+        with open(log_path, "rb") as f:
+            f.seek(self.size - 1)
+            if f.read(1) == b"\n":
+                return
+            # Bản ghi dở có thể dài hơn một khối: đọc ngược từng khối cho đến khi gặp xuống dòng
+            end = self.size
+            while end > 0:
+                start = max(0, end - RECOVER_CHUNK)
+                f.seek(start)
+                newline = f.read(end - start).rfind(b"\n")
+                if newline >= 0:
+                    cut = start + newline + 1
+                    break
+                end = start
+        self.log_file.truncate(cut)
+        self.size = self.log_file.seek(0, os.SEEK_END)
+        log_event(f"Cắt bản ghi dở ở cuối {log_path}")
+
+    def _open_index(self):
+        """Mở chỉ mục của segment đang ghi; dựng lại nếu thiếu hoặc không khớp với file .log."""
+        index_path = self._segment_path(self.segment, "idx")
+        entries = self._load_index(self.segment)
+        if (entries and entries[-1][1] >= self.size) or (self.size and not entries):
+            entries = self._rebuild_index(self.segment)
+            with open(index_path, "wb") as f:
+                f.write(b"".join(INDEX_ENTRY.pack(ts, offset) for ts, offset in entries))
+            log_event(f"Dựng lại chỉ mục {index_path}")
+        self.index_file = open(index_path, "ab")
+        self.last_indexed = entries[-1][1] if entries else None
+        if entries:
+            self.last_ts = max(self.last_ts, entries[-1][0])
+
+    def _rebuild_index(self, number):
+        entries = []
+        last_indexed = None
+        offset = 0
+        with open(self._segment_path(number, "log"), "rb") as f:
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break
+                if last_indexed is None or offset - last_indexed >= self.index_interval:
+                    try:
+                        entries.append((json.loads(line)["ts"], offset))
+                        last_indexed = offset
+                    except (ValueError, KeyError):
+                        pass
+                offset += len(line)
+        return entries
+
+    def _load_index(self, number):
+        try:
+            with open(self._segment_path(number, "idx"), "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return []
+        usable = len(data) - len(data) % INDEX_ENTRY.size
+        return [entry for entry in INDEX_ENTRY.iter_unpack(data[:usable])]
+
+    def _roll(self):
+        self._close()
+        self.segment += 1
+        self.log_file = open(self._segment_path(self.segment, "log"), "ab")
+        self.index_file = open(self._segment_path(self.segment, "idx"), "ab")
+        self.size = 0
+        self.last_indexed = None
+        with self.cond:
+            self.stats["segments"] += 1
+        log_event(f"Mở segment log tin nhắn mới {self.segment:08d}")
+
+    def _close(self):
+        for f in (self.log_file, self.index_file):
+            if f is not None:
+                try:
+                    f.close()
+                except Exception:
+                    pass
+        self.log_file = None
+        self.index_file = None
+
+    def flush(self, timeout=5):
+        """Chờ cho đến khi mọi bản ghi trong hàng đợi đã được ghi xuống segment."""
+        with self.cond:
+            if self.thread is None:
+                return True
+            return self.cond.wait_for(lambda: not self.records and not self.writing, timeout)
+
+    def read(self, start=None, end=None, channel=None, limit=None):
+        """Đọc các bản ghi có start <= ts <= end (datetime hoặc epoch giây), theo thứ tự ghi.
+
+        Chỉ mục đầu mỗi segment cho biết segment nào cần đọc; trong segment, chỉ mục thưa
+        cho vị trí để seek tới, nên chỉ phải quét tối đa INDEX_INTERVAL_BYTES dữ liệu thừa.
+        """
+        if isinstance(start, datetime):
+            start = start.timestamp()
+        if isinstance(end, datetime):
+            end = end.timestamp()
+        self.flush()
+        results = []
+        segments = [(number, self._load_index(number)) for number in self._segments()]
+        # Bỏ qua các segment kết thúc trước start: segment kế tiếp đã bắt đầu trước start
+        first = 0
+        if start is not None:
+            for i, (_, entries) in enumerate(segments):
+                if entries and entries[0][0] < start:
+                    first = i
+        for number, entries in segments[first:]:
+            if end is not None and entries and entries[0][0] > end:
+                break
+            offset = 0
+            if start is not None and entries:
+                position = bisect.bisect_left([ts for ts, _ in entries], start) - 1
+                if position >= 0:
+                    offset = entries[position][1]
+            if self._read_segment(number, offset, start, end, channel, limit, results):
+                break
+        return results
+
+    def _read_segment(self, number, offset, start, end, channel, limit, results):
+        """Thêm bản ghi phù hợp vào results; trả về True khi đã đủ limit hoặc đã qua end."""
+        try:
+            f = open(self._segment_path(number, "log"), "rb")
+        except FileNotFoundError:
+            return False
+        with f:
+            f.seek(offset)
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                ts = record.get("ts", 0)
+                if start is not None and ts < start:
+                    continue
+                if end is not None and ts > end:
+                    return True
+                if channel is not None and record.get("channel") != channel:
+                    continue
+                record["time"] = datetime.fromtimestamp(ts).strftime("%Y-%m-%d %H:%M:%S")
+                results.append(record)
+                if limit is not None and len(results) >= limit:
+                    return True
+        return False
+
+    def metrics(self):
+        with self.cond:
+            stats = dict(self.stats)
+            stats["queued"] = len(self.records)
+            stats["segment"] = self.segment
+        return stats
+
+message_audit = MessageLog()
+atexit.register(message_audit.flush)
 
 def log_message(channel, message, sender, deleted=False):
-    """Ghi log tin nhắn vào file để debug (tin nhắn chính được lưu trong database)."""
-    if not os.path.exists(LOG_DIR):
-        os.makedirs(LOG_DIR)
-
-    try:
-        with open(MESSAGE_LOG_FILE, "r", encoding='utf-8') as f:
-            lines = f.readlines()
-        if len(lines) >= 5000:  # Giảm giới hạn để tiết kiệm tài nguyên
-            with open(MESSAGE_LOG_FILE, "w", encoding='utf-8') as f:
-                f.write("")
-            lines = []
-    except FileNotFoundError:
-        lines = []
-    except UnicodeDecodeError as e:
-        error_msg = f"Không thể đọc file log tin nhắn do lỗi mã hóa: {type(e).__name__}: {str(e)}"
-        print(error_msg)
-        log_event(error_msg)
-        lines = []
-
-    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    status = "ĐÃ XÓA" if deleted else "HOẠT ĐỘNG"
-    log_entry = f"[{timestamp}] Kênh: {channel}, Người gửi: {sender}, Tin nhắn: {message}, Trạng thái: {status}\n"
-    try:
-        with open(MESSAGE_LOG_FILE, "a", encoding='utf-8') as f:
-            f.write(log_entry)
-    except UnicodeEncodeError as e:
-        error_msg = f"Không thể ghi log tin nhắn do lỗi mã hóa: {type(e).__name__}: {str(e)}"
-        print(error_msg)
-        log_event(error_msg)
-    except Exception as e:
-        error_msg = f"Lỗi ghi log tin nhắn: {type(e).__name__}: {str(e)}"
-        print(error_msg)
-        log_event(error_msg)
\ No newline at end of file
+    """Ghi log kiểm toán tin nhắn (tin nhắn chính được lưu trong database). Không chặn trừ khi hàng đợi đầy."""
+    message_audit.append(channel, message, sender, deleted)
+
+def read_message_log(start=None, end=None, channel=None, limit=None):
+    """Đọc log kiểm toán trong khoảng thời gian [start, end], có thể lọc theo kênh."""
+    return message_audit.read(start, end, channel, limit)
@@ -2,18 +2,33 @@ import socket
 import threading
 import json
 import time
-from utils import log_event
+from utils import log_event, SampledCounter, DEBUG
+from codec import json_line
 import cv2
-import pickle
+import numpy as np
 import struct
 from PIL import Image, ImageTk
 import tkinter as tk
 from typing import Dict, Any
 
+try:
+    import fcntl
+    import termios
+except ImportError:  # Windows: không đo được hàng đợi gửi của kernel
+    fcntl = None
+
 peer_connections: Dict[tuple, socket.socket] = {}  # Socket cho tin nhắn JSON
 video_connections: Dict[tuple, socket.socket] = {}  # Socket cho video
 global_app = None
 VIDEO_PORT_OFFSET = 1  # Cổng video = PEER_PORT + 1
+PEER_HELLO = "peer_hello"  # Dòng đầu tiên peer gửi khi mở kết nối P2P
+PUSH_HELLO = "push_hello"  # Dòng đầu tiên server gửi trên kết nối push (khớp push.PUSH_HELLO)
+HELLO_TIMEOUT = 5  # Thời gian chờ dòng đầu tiên; client cũ không gửi gì thì coi là peer
+VIDEO_HEADER = struct.Struct("<IIQB")  # (độ dài JPEG, số thứ tự, thời điểm chụp µs, cờ), cùng kích thước trên mọi nền tảng
+VIDEO_FLAG_END = 0x01  # Người phát dừng: khung rỗng, bên nhận kết thúc bình thường
+VIDEO_FLAG_HELLO = 0x02  # Khung đầu tiên của mỗi kết nối: payload là tên người phát (UTF-8)
+MAX_VIDEO_FRAME_SIZE = 4 * 1024 * 1024  # Khung lớn hơn bị coi là dữ liệu hỏng
+VIDEO_BUFFER_SIZE = 256 * 1024  # Kích thước ban đầu của bộ đệm nhận, tự mở rộng khi gặp khung lớn hơn
 
 def set_global_app(app: Any) -> None:
     global global_app
@@ -32,122 +47,175 @@ def create_video_label(streamer: str) -> None:
         except Exception as e:
             log_event(f"Lỗi khi tạo nhãn video cho {streamer}: {type(e).__name__}: {str(e)}")
 
-def stream_video(peer: Dict[str, Any], cap) -> None:
-    """Gửi khung video qua socket TCP riêng đến peer"""
-    if cap is None:
-        log_event(f"Không thể gửi video đến {peer['username']}: Camera không được khởi tạo")
-        return
+def send_video_frame(conn: socket.socket, sequence: int, jpeg, flags: int = 0, timestamp_us: int = None) -> None:
+    """Gửi header cố định rồi gửi thẳng bộ đệm JPEG của cv2.imencode (không sao chép, không pickle)."""
+    if timestamp_us is None:
+        timestamp_us = time.time_ns() // 1000
+    conn.sendall(VIDEO_HEADER.pack(len(jpeg), sequence, timestamp_us, flags))
+    if len(jpeg):
+        conn.sendall(jpeg)
+
+def unsent_bytes(conn: socket.socket):
+    """Số byte còn nằm trong hàng đợi gửi của kernel (Linux/macOS), hoặc None nếu không đo được."""
+    if fcntl is None or not hasattr(termios, "TIOCOUTQ"):
+        return None
+    try:
+        return struct.unpack("i", fcntl.ioctl(conn.fileno(), termios.TIOCOUTQ, b"\0\0\0\0"))[0]
+    except OSError:
+        return None
+
+class VideoFrameReader:
+    """Đọc các khung video (header VIDEO_HEADER + JPEG) bằng recv_into vào một bộ đệm dùng lại.
+
+    socket.timeout giữa chừng không làm mất dữ liệu đã nhận: lần gọi read_frame() sau
+    tiếp tục đúng chỗ cũ.
+    """
+    def __init__(self, conn: socket.socket, size: int = VIDEO_BUFFER_SIZE):
+        self.conn = conn
+        self.buffer = bytearray(size)
+        self.view = memoryview(self.buffer)
+        self.header = bytearray(VIDEO_HEADER.size)
+        self.header_view = memoryview(self.header)
+        self.filled = 0  # Số byte đã nhận của phần đang đọc (header hoặc JPEG)
+        self.pending = None  # Header đã giải mã của khung đang nhận
+
+    def read_frame(self):
+        """Trả về (số thứ tự, thời điểm chụp µs, cờ, memoryview JPEG), hoặc None khi kết nối đóng.
+
+        memoryview trỏ vào bộ đệm dùng chung nên chỉ hợp lệ đến lần đọc kế tiếp.
+        """
+        if self.pending is None:
+            if not self._fill(self.header_view):
+                return None
+            length, sequence, timestamp_us, flags = VIDEO_HEADER.unpack(self.header)
+            if length > MAX_VIDEO_FRAME_SIZE:
+                raise ValueError(f"Khung video quá lớn: {length} bytes")
+            if length > len(self.buffer):
+                self.buffer = bytearray(max(length, 2 * len(self.buffer)))
+                self.view = memoryview(self.buffer)
+            self.pending = (length, sequence, timestamp_us, flags)
+        length, sequence, timestamp_us, flags = self.pending
+        if not self._fill(self.view[:length]):
+            return None
+        self.pending = None
+        return sequence, timestamp_us, flags, self.view[:length]
+
+    def _fill(self, target) -> bool:
+        while self.filled < len(target):
+            received = self.conn.recv_into(target[self.filled:])
+            if not received:
+                return False
+            self.filled += received
+        self.filled = 0
+        return True
+
+def connect_video(peer: Dict[str, Any], send_buffer: int = 1024 * 1024):
+    """Mở socket TCP video đến peer (thử 3 lần). Trả về socket, hoặc None nếu không kết nối được.
 
+    send_buffer giới hạn SO_SNDBUF: bộ đệm nhỏ giữ số khung nằm chờ trong kernel ở mức thấp.
+    """
     video_port = peer['port'] + VIDEO_PORT_OFFSET
     addr = (peer['ip'], video_port)
     for attempt in range(3):
-        if addr not in video_connections:
-            try:
-                s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-                s.settimeout(15)
-                s.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 1024 * 1024)
-                s.connect(addr)
-                video_connections[addr] = s
-                log_event(f"Kết nối video với {peer['username']} tại {peer['ip']}:{video_port}")
-                break
-            except Exception as e:
-                log_event(f"Lỗi kết nối video với {peer['username']} (lần {attempt+1}/3): {type(e).__name__}: {str(e)}")
-                if attempt == 2:
-                    log_event(f"Bỏ qua kết nối video với {peer['username']} sau 3 lần thất bại")
-                    return
-                time.sleep(1)
-
-    conn = video_connections.get(addr)
-    if not conn:
-        log_event(f"Không tìm thấy kết nối video với {peer['username']}")
-        return
-
-    last_frame_time = time.time()
-    frame_interval = 1 / 20
-    while global_app.is_streaming and cap.isOpened():
-        ret, frame = cap.read()
-        if not ret:
-            log_event("Không thể đọc khung video từ camera")
-            break
-        frame = cv2.resize(frame, (160, 120))
-        encode_param = [int(cv2.IMWRITE_JPEG_QUALITY), 50]
-        _, buffer = cv2.imencode('.jpg', frame, encode_param)
-        data = pickle.dumps(buffer)
         try:
-            conn.sendall(struct.pack("L", len(data)))
-            conn.sendall(data)
-            log_event(f"Gửi khung video đến {peer['username']} (kích thước: {len(data)} bytes)")
-        except socket.timeout:
-            log_event(f"Timeout khi gửi khung video đến {peer['username']}, thử lại...")
-            continue
+            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            s.settimeout(15)
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, send_buffer)
+            s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            s.connect(addr)
+            video_connections[addr] = s
+            log_event(f"Kết nối video với {peer['username']} tại {peer['ip']}:{video_port}")
+            return s
         except Exception as e:
-            log_event(f"Lỗi gửi khung video đến {peer['username']}: {type(e).__name__}: {str(e)}")
-            break
-        
-        elapsed_time = time.time() - last_frame_time
-        sleep_time = max(0, frame_interval - elapsed_time)
-        time.sleep(sleep_time)
-        last_frame_time = time.time()
+            log_event(f"Lỗi kết nối video với {peer['username']} (lần {attempt+1}/3): {type(e).__name__}: {str(e)}")
+            if attempt == 2:
+                log_event(f"Bỏ qua kết nối video với {peer['username']} sau 3 lần thất bại")
+                return None
+            time.sleep(1)
 
+def close_video(conn: socket.socket) -> None:
+    """Báo cho bên xem biết luồng đã dừng rồi đóng socket video."""
+    try:
+        send_video_frame(conn, 0, b"", VIDEO_FLAG_END)
+    except Exception:
+        pass
     try:
+        addr = conn.getpeername()
         conn.close()
         video_connections.pop(addr, None)
         log_event(f"Đóng kết nối video với {addr}")
-    except:
+    except Exception:
         pass
 
-def receive_video(conn, streamer: str) -> None:
-    """Nhận và hiển thị khung video từ socket TCP riêng"""
+def receive_video(conn, streamer: str = None) -> None:
+    """Nhận và hiển thị khung video từ socket TCP riêng.
+
+    Nếu streamer là None, tên người phát được lấy từ khung VIDEO_FLAG_HELLO đầu tiên.
+    """
     if global_app is None:
         raise ValueError("global_app chưa được thiết lập")
-    data = b""
-    payload_size = struct.calcsize("L")
     conn.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1024 * 1024)
-    while global_app.is_streaming:
+    addr = conn.getpeername()
+    stats = SampledCounter(f"Nhận video từ {streamer or addr}")
+    try:
+        streamer = receive_video_frames(conn, streamer, stats)
+    finally:
+        stats.flush()
+        video_connections.pop(addr, None)
         try:
-            conn.settimeout(15)
-            while len(data) < payload_size:
-                packet = conn.recv(4096)
-                if not packet:
-                    log_event(f"Kết nối video với {streamer} bị đóng khi nhận kích thước dữ liệu")
-                    return
-                data += packet
-                log_event(f"Nhận được {len(packet)} bytes từ {streamer}")
-            packed_msg_size = data[:payload_size]
-            data = data[payload_size:]
-            msg_size = struct.unpack("L", packed_msg_size)[0]
-            log_event(f"Nhận kích thước khung video từ {streamer}: {msg_size} bytes")
+            conn.close()
+        except Exception:
+            pass
+    if streamer is not None:
+        global_app.root.after(0, global_app.hide_stream, streamer)
+    log_event(f"Kết thúc nhận video từ {streamer}")
 
-            while len(data) < msg_size:
-                packet = conn.recv(4096)
-                if not packet:
-                    log_event(f"Kết nối video với {streamer} bị đóng khi nhận dữ liệu khung")
-                    return
-                data += packet
-                log_event(f"Nhận thêm {len(packet)} bytes từ {streamer}, tổng cộng {len(data)}/{msg_size} bytes")
-            if len(data) < msg_size:
-                log_event(f"Không nhận đủ dữ liệu khung từ {streamer}")
-                return
-            frame_data = data[:msg_size]
-            data = data[msg_size:]
+def receive_video_frames(conn, streamer: str, stats: SampledCounter):
+    """Vòng nhận khung video; trả về tên người phát (None nếu chưa nhận được khung hello)."""
+    reader = VideoFrameReader(conn)
+    expected = None  # Số thứ tự kế tiếp; người phát đánh số riêng cho từng người xem nên khoảng trống là khung mất thật
+    conn.settimeout(15)
+    while True:
+        try:
+            frame_info = reader.read_frame()
+            if frame_info is None:
+                log_event(f"Kết nối video với {streamer} bị đóng")
+                return streamer
+            sequence, timestamp_us, flags, jpeg = frame_info
+            if flags & VIDEO_FLAG_END:
+                log_event(f"{streamer} dừng phát video")
+                return streamer
+            if flags & VIDEO_FLAG_HELLO:
+                streamer = str(jpeg, 'utf-8')
+                log_event(f"Bắt đầu nhận video từ {streamer}")
+                global_app.root.after(0, global_app.show_stream, streamer)
+                continue
+            if expected is not None and sequence != expected:
+                stats.add("mất khung", (sequence - expected) & 0xFFFFFFFF)
+            expected = (sequence + 1) & 0xFFFFFFFF
+            stats.add("khung")
+            stats.add("bytes", VIDEO_HEADER.size + len(jpeg))
+            stats.add("trễ ms", max(0, time.time_ns() // 1000 - timestamp_us) // 1000)
 
-            buffer = pickle.loads(frame_data)
-            frame = cv2.imdecode(buffer, cv2.IMREAD_COLOR)
+            # Giải mã thẳng trên bộ đệm nhận, không sao chép
+            frame = cv2.imdecode(np.frombuffer(jpeg, dtype=np.uint8), cv2.IMREAD_COLOR)
+            if frame is None:
+                stats.add("lỗi giải mã")
+                continue
             img = Image.fromarray(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))
             imgtk = ImageTk.PhotoImage(image=img)
             if streamer in global_app.video_windows:
                 label = global_app.video_windows[streamer]
                 label.imgtk = imgtk
                 label.configure(image=imgtk)
-                log_event(f"Cập nhật khung video từ {streamer}")
+                stats.add("hiển thị")
         except socket.timeout:
-            log_event(f"Timeout khi nhận dữ liệu video từ {streamer}, tiếp tục chờ...")
+            stats.add("timeout")
             continue
         except Exception as e:
             log_event(f"Lỗi nhận khung video từ {streamer}: {type(e).__name__}: {str(e)}")
-            break
-    log_event(f"Kết thúc nhận video từ {streamer}")
+            return streamer
 
 def peer_connect(peer: Dict[str, Any]) -> None:
     for attempt in range(3):
@@ -156,6 +224,7 @@ def peer_connect(peer: Dict[str, Any]) -> None:
             s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
             s.settimeout(15)
             s.connect((peer['ip'], peer['port']))
+            s.sendall(json_line({"type": PEER_HELLO}))
             peer_connections[(peer['ip'], peer['port'])] = s
             log_event(f"Kết nối P2P với {peer['username']} tại {peer['ip']}:{peer['port']}")
             threading.Thread(target=receive_messages, args=(s,), daemon=True).start()
@@ -213,9 +282,7 @@ def listen_for_connections(port: int) -> None:
         # Chấp nhận kết nối tin nhắn
         while True:
             conn, addr = s.accept()
-            peer_connections[addr] = conn
-            log_event(f"Chấp nhận kết nối P2P từ {addr}")
-            threading.Thread(target=receive_messages, args=(conn,), daemon=True).start()
+            threading.Thread(target=classify_connection, args=(conn, addr), daemon=True).start()
     except socket.error as e:
         log_event(f"Lỗi socket khi lắng nghe P2P trên cổng {port}: {type(e).__name__}: {str(e)}")
         raise Exception(f"Không thể bind cổng {port}: {str(e)}")
@@ -223,26 +290,114 @@ def listen_for_connections(port: int) -> None:
         log_event(f"Lỗi lắng nghe P2P: {type(e).__name__}: {str(e)}")
         raise
 
+def classify_connection(conn: socket.socket, addr: tuple) -> None:
+    """Đọc dòng đầu tiên để tách kết nối push của server khỏi kết nối của peer.
+
+    Kết nối push chỉ được đọc bởi receive_push và không bao giờ nằm trong peer_connections,
+    nên tin nhắn chat gửi cho mọi peer không đi đến server.
+    """
+    buffer = b""
+    try:
+        conn.settimeout(HELLO_TIMEOUT)
+        while b'\n' not in buffer:
+            data = conn.recv(1024)
+            if not data:
+                log_event(f"Kết nối P2P từ {addr} đóng trước khi gửi dữ liệu")
+                conn.close()
+                return
+            buffer += data
+    except socket.timeout:
+        pass
+    except Exception as e:
+        log_event(f"Lỗi đọc kết nối P2P từ {addr}: {type(e).__name__}: {str(e)}")
+        conn.close()
+        return
+    first, _, rest = buffer.partition(b'\n')
+    try:
+        hello = json.loads(first).get("type") if b'\n' in buffer else None
+    except (ValueError, AttributeError):
+        hello = None
+    if hello == PUSH_HELLO:
+        log_event(f"Chấp nhận kết nối push của server từ {addr}")
+        receive_push(conn, rest)
+        return
+    peer_connections[addr] = conn
+    log_event(f"Chấp nhận kết nối P2P từ {addr}")
+    # Client cũ không gửi peer_hello: dòng đầu tiên là tin nhắn và phải được xử lý như thường
+    receive_messages(conn, (rest if hello == PEER_HELLO else buffer).decode('utf-8', errors='replace'))
+
+def receive_push(s: socket.socket, buffer: bytes = b"") -> None:
+    """Đọc thông báo server đẩy trên kết nối push và giữ kết nối sống bằng ping."""
+    if global_app is None:
+        raise ValueError("global_app chưa được thiết lập")
+    stats = SampledCounter("Kết nối push từ server")
+    last_ping = time.time()
+    try:
+        s.settimeout(20)
+        while True:
+            while b'\n' in buffer:
+                line, buffer = buffer.split(b'\n', 1)
+                if not line:
+                    continue
+                try:
+                    msg_data = json.loads(line)
+                except ValueError as e:
+                    log_event(f"Thông báo push không hợp lệ: {e}")
+                    continue
+                if msg_data.get("type") == "pong":
+                    stats.add("pong nhận")
+                    continue
+                stats.add("thông báo")
+                try:
+                    global_app.receive_message(msg_data, s)
+                except Exception as e:
+                    log_event(f"Lỗi xử lý thông báo push: {type(e).__name__}: {str(e)}")
+            if time.time() - last_ping >= 10:
+                s.sendall(json_line({"type": "ping"}))
+                stats.add("ping gửi")
+                last_ping = time.time()
+            try:
+                data = s.recv(4096)
+            except socket.timeout:
+                continue
+            if not data:
+                log_event("Server đóng kết nối push")
+                break
+            buffer += data
+    except Exception as e:
+        log_event(f"Lỗi nhận thông báo push: {type(e).__name__}: {str(e)}")
+    stats.flush()
+    try:
+        s.close()
+    except Exception:
+        pass
+    # Server không tự mở lại kết nối push đã đánh dấu chết: client phải đăng ký lại
+    try:
+        global_app.push_closed()
+    except Exception as e:
+        log_event(f"Lỗi xử lý đóng kết nối push: {type(e).__name__}: {str(e)}")
+
 def accept_video_connections(video_s: socket.socket) -> None:
     while True:
         try:
             conn, addr = video_s.accept()
             video_connections[addr] = conn
             log_event(f"Chấp nhận kết nối video từ {addr}")
+            threading.Thread(target=receive_video, args=(conn,), daemon=True).start()
         except Exception as e:
             log_event(f"Lỗi chấp nhận kết nối video: {type(e).__name__}: {str(e)}")
             break
 
-def receive_messages(s: socket.socket) -> None:
+def receive_messages(s: socket.socket, buffer: str = "") -> None:
     if global_app is None:
         raise ValueError("global_app chưa được thiết lập")
-    buffer = ""
     last_ping = time.time()
+    stats = SampledCounter(f"Kết nối P2P {s.getpeername()}")
     while True:
         if time.time() - last_ping >= 10:
             try:
-                s.sendall((json.dumps({"type": "ping"}) + '\n').encode('utf-8'))
-                log_event(f"Gửi ping đến {s.getpeername()}")
+                s.sendall(json_line({"type": "ping"}))
+                stats.add("ping gửi")
                 last_ping = time.time()
             except Exception as e:
                 log_event(f"Lỗi gửi ping đến {s.getpeername()}: {type(e).__name__}: {str(e)}")
@@ -250,32 +405,34 @@ def receive_messages(s: socket.socket) -> None:
 
         try:
             s.settimeout(20)
-            data = s.recv(1024).decode('utf-8')
-            if not data:
-                log_event(f"Peer {s.getpeername()} ngắt kết nối (không có dữ liệu)")
-                break
-            buffer += data
+            if '\n' not in buffer:
+                data = s.recv(1024).decode('utf-8')
+                if not data:
+                    log_event(f"Peer {s.getpeername()} ngắt kết nối (không có dữ liệu)")
+                    break
+                buffer += data
             while '\n' in buffer:
                 message, buffer = buffer.split('\n', 1)
                 if not message:
                     continue
                 try:
                     msg_data = json.loads(message)
-                    log_event(f"Nhận tin nhắn từ {s.getpeername()}: {msg_data}")
                     if msg_data.get("type") == "ping":
-                        s.sendall((json.dumps({"type": "pong"}) + '\n').encode('utf-8'))
-                        log_event(f"Gửi pong đến {s.getpeername()}")
+                        s.sendall(json_line({"type": "pong"}))
+                        stats.add("ping nhận")
                         continue
                     if msg_data.get("type") == "pong":
-                        log_event(f"Nhận pong từ {s.getpeername()}")
+                        stats.add("pong nhận")
                         continue
+                    stats.add("tin nhắn")
+                    log_event("Nhận tin nhắn từ %s: %s", s.getpeername(), msg_data, level=DEBUG)
                     global_app.receive_message(msg_data, s)
                 except json.JSONDecodeError as e:
                     log_event(f"Tin nhắn P2P không hợp lệ từ {s.getpeername()}: {e}")
                 except Exception as e:
                     log_event(f"Lỗi xử lý tin nhắn từ {s.getpeername()}: {type(e).__name__}: {str(e)}")
         except socket.timeout:
-            log_event(f"Timeout khi nhận dữ liệu từ {s.getpeername()}, thử lại...")
+            stats.add("timeout")
             continue
         except socket.error as e:
             log_event(f"Lỗi socket trong receive_messages từ {s.getpeername()}: {type(e).__name__}: {str(e)}")
@@ -283,6 +440,7 @@ def receive_messages(s: socket.socket) -> None:
         except Exception as e:
             log_event(f"Lỗi nhận tin nhắn từ {s.getpeername()}: {type(e).__name__}: {str(e)}")
             break
+    stats.flush()
     try:
         addr = s.getpeername()
         s.close()
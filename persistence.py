@@ -0,0 +1,105 @@
+import threading
+import time
+import atexit
+from collections import deque
+from concurrent.futures import Future
+from datetime import datetime
+import database
+from utils import log_event
+
+FLUSH_SIZE = 256  # Số tin nhắn tối đa trong một lần commit
+# Thời gian chờ tối đa (giây) để gom thêm tin nhắn trước khi commit. Với 0, writer commit ngay
+# khi rảnh và nhóm tự hình thành từ các tin đến trong lúc commit trước đang chạy; đặt khoảng
+# 0.005 chỉ có lợi khi mỗi fsync rất chậm (ổ đĩa quay, synchronous=FULL)
+FLUSH_DEADLINE = 0
+MAX_PENDING = 10000  # Số tin nhắn chờ tối đa; submit bị chặn khi vượt quá
+COMMIT_TIMEOUT = 10  # Thời gian chờ commit tối đa của bên gọi
+
+class MessageWriter:
+    """Hàng đợi ghi sau (write-behind) gom các tin nhắn và commit theo nhóm.
+
+    submit() trả về một Future nhận True khi nhóm chứa tin nhắn đã commit và
+    False khi commit thất bại; bên cần xác nhận bền vững (sync_upload, API)
+    gọi future.result() trước khi trả lời. Tin nhắn được ghi đúng thứ tự submit.
+    """
+    def __init__(self, flush_size=FLUSH_SIZE, flush_deadline=FLUSH_DEADLINE, max_pending=MAX_PENDING,
+                 save_rows=None):
+        self.flush_size = flush_size
+        self.flush_deadline = flush_deadline
+        self.max_pending = max_pending
+        self.save_rows = save_rows or database.save_message_rows
+        self.pending = deque()  # [(row, future, thời điểm submit)]
+        self.cond = threading.Condition()
+        self.thread = None
+        self.committing = 0
+        self.stats = {"messages": 0, "batches": 0, "failed": 0, "max_batch": 0}
+
+    def submit(self, channel, sender, message, timestamp=None, status=database.ACTIVE_STATUS):
+        if not timestamp:
+            timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        future = Future()
+        with self.cond:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name="message-writer", daemon=True)
+                self.thread.start()
+            while len(self.pending) >= self.max_pending:
+                self.cond.wait()
+            self.pending.append(((channel, sender, message, timestamp, status), future, time.monotonic()))
+            self.cond.notify_all()
+        return future
+
+    def save(self, channel, sender, message, timestamp=None, status=database.ACTIVE_STATUS, timeout=COMMIT_TIMEOUT):
+        """Gửi tin nhắn vào hàng đợi và chờ commit. Trả về True khi tin nhắn đã được lưu bền vững."""
+        try:
+            return self.submit(channel, sender, message, timestamp, status).result(timeout)
+        except Exception as e:
+            log_event(f"Không chờ được commit tin nhắn kênh {channel}: {type(e).__name__}: {str(e)}")
+            return False
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while not self.pending:
+                    self.cond.wait()
+                # Chờ thêm tin nhắn cho đến khi đủ nhóm hoặc hết hạn tính từ tin nhắn cũ nhất
+                deadline = self.pending[0][2] + self.flush_deadline
+                while len(self.pending) < self.flush_size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self.cond.wait(remaining)
+                batch = [self.pending.popleft() for _ in range(min(self.flush_size, len(self.pending)))]
+                self.committing = len(batch)
+                self.cond.notify_all()
+            ok = self.save_rows([row for row, _, _ in batch])
+            with self.cond:
+                self.committing = 0
+                self.stats["batches"] += 1
+                self.stats["messages" if ok else "failed"] += len(batch)
+                self.stats["max_batch"] = max(self.stats["max_batch"], len(batch))
+                self.cond.notify_all()
+            if not ok:
+                log_event(f"Commit nhóm {len(batch)} tin nhắn thất bại")
+            for _, future, _ in batch:
+                future.set_result(ok)
+
+    def flush(self, timeout=COMMIT_TIMEOUT):
+        """Chờ cho đến khi mọi tin nhắn đã submit được commit."""
+        deadline = time.monotonic() + timeout
+        with self.cond:
+            while self.pending or self.committing:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self.cond.wait(remaining)
+        return True
+
+    def metrics(self):
+        with self.cond:
+            stats = dict(self.stats)
+            stats["pending"] = len(self.pending)
+        stats["avg_batch"] = round(stats["messages"] / stats["batches"], 1) if stats["batches"] else 0
+        return stats
+
+message_writer = MessageWriter()
+atexit.register(message_writer.flush)
@@ -0,0 +1,389 @@
+import json
+import socket
+import struct
+import threading
+import itertools
+import zlib
+from collections import deque
+from concurrent.futures import Future, TimeoutError as FutureTimeout
+from utils import log_event
+from codec import JSON_CODEC, available_codecs, get_codec
+from compression import COMPRESS_MIN_BYTES, available_compressions, compression_stats, get_compression
+
+PROTOCOL_VERSION = 2  # Phiên bản giao thức cao nhất mà tiến trình này hỗ trợ
+SUPPORTED_VERSIONS = (1, 2)
+HEADER = struct.Struct(">IB")  # (độ dài payload, cờ) đứng trước mỗi frame của giao thức v2
+MAX_FRAME_SIZE = 16 * 1024 * 1024  # Frame lớn hơn bị coi là lỗi giao thức
+RECV_BUFFER_SIZE = 64 * 1024  # Kích thước ban đầu của bộ đệm nhận, tự mở rộng khi gặp frame lớn hơn
+REQUEST_TIMEOUT = 15
+MAX_IN_FLIGHT = 64  # Số yêu cầu v2 tối đa server xử lý đồng thời cho một kết nối
+FLAG_COMPRESSED = 0x01  # Payload của frame đã được nén bằng thuật toán đã thỏa thuận
+FLAG_RESULT = 0x02  # Phản hồi có request_id: 1 byte độ dài + request_id UTF-8, rồi kết quả đã mã hóa (nén nếu có FLAG_COMPRESSED)
+COMPRESSED_CACHE_SIZE = 32  # Số payload dùng chung (danh sách peer, danh sách kênh) giữ bản nén sẵn
+
+class ProtocolError(Exception):
+    pass
+
+def encode_frame(payload, flags=0):
+    """Đóng gói payload (bytes) thành một frame v2: header 5 byte rồi dữ liệu."""
+    if len(payload) > MAX_FRAME_SIZE:
+        raise ProtocolError(f"Frame quá lớn: {len(payload)} bytes")
+    return HEADER.pack(len(payload), flags) + payload
+
+def encode_line(text):
+    """Đóng gói một thông điệp theo giao thức v1 (một dòng JSON)."""
+    return (text + '\n').encode('utf-8')
+
+_compressed_cache = {}  # {(id(data), tên thuật toán): (data, cờ, payload)}
+_compressed_cache_lock = threading.Lock()
+
+def compress_payload(data, compression=None, cached=False):
+    """Trả về (cờ, payload): data nén bằng compression nếu đủ lớn và nén có lợi.
+
+    cached=True dành cho payload dùng chung giữa các lần gửi (danh sách peer, danh sách kênh):
+    bản nén được giữ theo chính đối tượng bytes đó, nên tự hết hiệu lực khi tracker hoặc
+    channel_registry tạo payload mới sau một thay đổi.
+    """
+    if compression is None or len(data) < COMPRESS_MIN_BYTES:
+        return 0, data
+    key = (id(data), compression.name)
+    if cached:
+        with _compressed_cache_lock:
+            entry = _compressed_cache.get(key)
+        if entry is not None and entry[0] is data:
+            compression_stats.sent(len(data), len(entry[2]))
+            return entry[1], entry[2]
+    compressed = compression.compress(data)
+    flags, payload = (FLAG_COMPRESSED, compressed) if len(compressed) < len(data) else (0, data)
+    compression_stats.sent(len(data), len(payload))
+    if cached:
+        with _compressed_cache_lock:
+            _compressed_cache[key] = (data, flags, payload)
+            while len(_compressed_cache) > COMPRESSED_CACHE_SIZE:
+                del _compressed_cache[next(iter(_compressed_cache))]
+    return flags, payload
+
+def encode_message(data, version, codec=JSON_CODEC, request_id=None, compression=None, cached=False):
+    """Đóng gói một thông điệp đã mã hóa bằng codec của kết nối theo phiên bản giao thức.
+
+    Ở v1 data luôn là JSON và được gửi thành một dòng. Ở v2, phản hồi không phải object
+    (ví dụ danh sách kênh đã mã hóa sẵn) được gửi với FLAG_RESULT: request_id nằm trước
+    payload chứ không nằm trong đó, nên payload (kể cả bản nén, xem compress_payload) được
+    dùng lại nguyên vẹn giữa các yêu cầu. Nếu kết nối đã thỏa thuận nén, payload từ
+    COMPRESS_MIN_BYTES trở lên được nén và đánh cờ FLAG_COMPRESSED khi nén có lợi.
+    """
+    if version < 2:
+        return data + b'\n'
+    flags, payload = compress_payload(data, compression, cached)
+    if request_id is None:
+        return encode_frame(payload, flags)
+    prefix = str(request_id).encode('utf-8')
+    if len(prefix) > 255:
+        raise ProtocolError("request_id quá dài")
+    length = 1 + len(prefix) + len(payload)
+    if length > MAX_FRAME_SIZE:
+        raise ProtocolError(f"Frame quá lớn: {length} bytes")
+    return b"".join((HEADER.pack(length, flags | FLAG_RESULT), bytes((len(prefix),)), prefix, payload))
+
+def decode_frame(flags, payload, compression=None):
+    """Tách request_id (nếu có FLAG_RESULT) và giải nén payload của một frame v2.
+
+    Trả về (request_id hoặc None, payload đã giải nén).
+    """
+    request_id = None
+    if flags & FLAG_RESULT:
+        if not payload:
+            raise ProtocolError("Frame kết quả rỗng")
+        end = 1 + payload[0]
+        request_id = str(payload[1:end], 'utf-8')
+        payload = payload[end:]
+    if not flags & FLAG_COMPRESSED:
+        return request_id, payload
+    if compression is None:
+        raise ProtocolError("Nhận frame nén khi chưa thỏa thuận nén")
+    try:
+        raw = compression.decompress(payload)
+    except (zlib.error, ValueError) as e:
+        raise ProtocolError(f"Không giải nén được frame: {e}")
+    compression_stats.received(len(payload), len(raw))
+    return request_id, raw
+
+def decode_payload(flags, payload, compression=None):
+    """Payload đã giải nén của một frame v2 gửi đến server (client không gửi FLAG_RESULT)."""
+    request_id, payload = decode_frame(flags, payload, compression)
+    if request_id is not None:
+        raise ProtocolError("Frame kết quả không hợp lệ theo chiều này")
+    return payload
+
+def hello_request(request_id="hello"):
+    return {"type": "hello", "versions": list(SUPPORTED_VERSIONS), "codecs": available_codecs(),
+            "compression": available_compressions(), "request_id": request_id}
+
+def choose_version(request):
+    """Phiên bản cao nhất mà cả hai bên cùng hỗ trợ, dựa trên yêu cầu hello của client."""
+    versions = request.get("versions") or [request.get("version", 1)]
+    common = [version for version in versions if version in SUPPORTED_VERSIONS]
+    return max(common) if common else 1
+
+class FrameReader:
+    """Đọc dòng (v1) hoặc frame (v2) từ socket vào một bytearray dùng lại giữa các lần đọc.
+
+    recv_into ghi thẳng vào bộ đệm nên không tạo bytes trung gian cho mỗi lần recv, và
+    dữ liệu chỉ được giải mã UTF-8 khi đã đủ một thông điệp, nên ký tự nhiều byte bị
+    cắt giữa hai lần recv không còn gây lỗi. Timeout giữa chừng không làm mất dữ liệu
+    đã nhận: lần đọc sau tiếp tục từ chỗ cũ.
+    """
+    def __init__(self, sock, size=RECV_BUFFER_SIZE):
+        self.sock = sock
+        self.buffer = bytearray(size)
+        self.view = memoryview(self.buffer)
+        self.start = 0  # Vị trí byte đầu tiên chưa đọc
+        self.end = 0  # Vị trí sau byte cuối cùng đã nhận
+
+    def _fill(self, needed):
+        """Nhận thêm dữ liệu cho đến khi bộ đệm có ít nhất needed byte chưa đọc. Trả về False khi EOF."""
+        while self.end - self.start < needed:
+            if self.start + needed > len(self.buffer):
+                self._compact(needed)
+            received = self.sock.recv_into(self.view[self.end:])
+            if not received:
+                return False
+            self.end += received
+        return True
+
+    def _compact(self, needed):
+        pending = self.end - self.start
+        if needed > len(self.buffer):
+            # Mở rộng bộ đệm cho frame lớn hơn bộ đệm hiện tại
+            self.buffer = self.buffer[self.start:self.end] + bytearray(max(needed, 2 * len(self.buffer)) - pending)
+            self.view = memoryview(self.buffer)
+        else:
+            # Dời phần chưa đọc về đầu bộ đệm (memoryview xử lý đúng vùng chồng lấn)
+            self.view[:pending] = self.view[self.start:self.end]
+        self.start, self.end = 0, pending
+
+    def read_frame(self):
+        """Trả về (cờ, memoryview payload) của frame tiếp theo, hoặc None khi kết nối đóng.
+
+        memoryview trỏ vào bộ đệm dùng chung nên chỉ hợp lệ đến lần đọc kế tiếp.
+        """
+        if not self._fill(HEADER.size):
+            return None
+        length, flags = HEADER.unpack_from(self.buffer, self.start)
+        if length > MAX_FRAME_SIZE:
+            raise ProtocolError(f"Frame quá lớn: {length} bytes")
+        if not self._fill(HEADER.size + length):
+            return None
+        begin = self.start + HEADER.size
+        self.start = begin + length
+        return flags, self.view[begin:self.start]
+
+    def read_line(self):
+        """Trả về dòng tiếp theo (str, không gồm '\\n'), hoặc None khi kết nối đóng."""
+        scanned = 0  # Số byte chưa đọc đã được tìm mà không thấy '\n'
+        while True:
+            newline = self.buffer.find(b'\n', self.start + scanned, self.end)
+            if newline != -1:
+                line = str(self.view[self.start:newline], 'utf-8')
+                self.start = newline + 1
+                return line
+            scanned = self.end - self.start
+            if scanned >= MAX_FRAME_SIZE:
+                raise ProtocolError("Dòng quá dài")
+            if not self._fill(scanned + 1):
+                return None
+
+    def read_message(self, version, compression=None):
+        """Đọc một thông điệp theo phiên bản giao thức: dòng (str) ở v1, payload ở v2 (đã giải nén).
+
+        Trả về None khi kết nối đóng. Giải mã bằng codec của kết nối.
+        """
+        if version >= 2:
+            frame = self.read_frame()
+            return None if frame is None else decode_payload(frame[0], frame[1], compression)
+        return self.read_line()
+
+class ServerConnection:
+    """Kết nối của client đến server, tự thỏa thuận phiên bản giao thức khi mở.
+
+    Một thread đọc duy nhất nhận mọi thông điệp từ server: phản hồi được chuyển cho
+    Future đang chờ theo request_id, thông điệp server tự gửi (có "type" nhưng không
+    khớp yêu cầu nào) được chuyển cho handler đã đăng ký bằng on(). Nhờ vậy nhiều yêu
+    cầu có thể được gửi nối tiếp trên cùng một kết nối mà không phải chờ lần lượt.
+
+    Server cũ trả lỗi cho yêu cầu hello nên kết nối ở lại v1 (mỗi dòng một JSON). Ở v1
+    server xử lý tuần tự, nên phản hồi được ghép với yêu cầu theo thứ tự gửi.
+    """
+    def __init__(self, sock):
+        self.sock = sock
+        self.reader = FrameReader(sock)
+        self.version = 1
+        self.codec = JSON_CODEC  # Chỉ đổi khi đã thỏa thuận v2
+        self.compression = None
+        self.send_lock = threading.Lock()  # Giữ thứ tự ghi và thứ tự đăng ký yêu cầu trùng nhau
+        self.lock = threading.Lock()
+        self.pending = {}  # {request_id: Future}
+        self.order = deque()  # request_id theo thứ tự gửi, dùng để ghép phản hồi ở v1
+        self.handlers = {}  # {type thông điệp: handler(message)}
+        self.default_handler = None
+        self.ids = itertools.count(1)
+        self.closed = False
+        self.reader_thread = None
+
+    @classmethod
+    def connect(cls, host, port, timeout=REQUEST_TIMEOUT):
+        sock = socket.create_connection((host, port), timeout=timeout)
+        conn = cls(sock)
+        try:
+            conn.negotiate()
+        except Exception:
+            sock.close()
+            raise
+        conn.start()
+        return conn
+
+    def negotiate(self):
+        # hello luôn được gửi theo v1 để server cũ cũng hiểu và trả lời được
+        self.sock.sendall(encode_line(json.dumps(hello_request())))
+        reply = self.reader.read_line()
+        if reply is None:
+            raise ConnectionError("Server đóng kết nối khi thỏa thuận giao thức")
+        try:
+            data = json.loads(reply)
+        except json.JSONDecodeError:
+            data = None
+        if isinstance(data, dict) and data.get("type") == "hello":
+            self.version = data.get("version", 1)
+            if self.version >= 2:
+                self.codec = get_codec(data.get("codec", JSON_CODEC.name))
+                self.compression = get_compression(data.get("compression"))
+        log_event(f"Thỏa thuận giao thức v{self.version}, codec {self.codec.name}, "
+                  f"nén {self.compression.name if self.compression else 'không'} với server {self.getpeername()}")
+        return self.version
+
+    def start(self):
+        # Thread đọc chờ vô hạn; thời gian chờ của từng yêu cầu do Future đảm nhận
+        self.sock.settimeout(None)
+        self.reader_thread = threading.Thread(target=self._read_loop, name="server-reader", daemon=True)
+        self.reader_thread.start()
+
+    def on(self, message_type, handler):
+        """Đăng ký handler cho thông điệp server tự gửi có type cho trước."""
+        self.handlers[message_type] = handler
+
+    def send(self, payload):
+        self.sock.sendall(encode_message(self.codec.encode(payload), self.version, self.codec, compression=self.compression))
+
+    def submit(self, payload):
+        """Gửi một yêu cầu và trả về Future nhận phản hồi của nó, không chờ."""
+        future = Future()
+        with self.send_lock:
+            with self.lock:
+                if self.closed:
+                    raise ConnectionError("Kết nối đến server đã đóng")
+                request_id = payload.get("request_id")
+                if request_id in (None, "unknown") or request_id in self.pending:
+                    request_id = payload["request_id"] = f"c{next(self.ids)}"
+                self.pending[request_id] = future
+                if self.version < 2:
+                    self.order.append(request_id)
+            try:
+                self.send(payload)
+            except Exception as e:
+                with self.lock:
+                    self.pending.pop(request_id, None)
+                future.set_exception(e)
+        return future
+
+    def request(self, payload, timeout=REQUEST_TIMEOUT):
+        """Gửi một yêu cầu và chờ phản hồi của nó (tối đa timeout giây)."""
+        future = self.submit(payload)
+        try:
+            return future.result(timeout)
+        except FutureTimeout:
+            # Phản hồi đến muộn sẽ bị bỏ qua; ở v1 request_id vẫn nằm trong order để giữ đúng thứ tự
+            with self.lock:
+                self.pending.pop(payload["request_id"], None)
+            raise TimeoutError(f"Hết thời gian chờ phản hồi cho yêu cầu {payload.get('type')}")
+
+    def _read_message(self):
+        """(request_id của FLAG_RESULT hoặc None, thông điệp chưa giải mã), hoặc None khi kết nối đóng."""
+        if self.version < 2:
+            line = self.reader.read_line()
+            return None if line is None else (None, line)
+        frame = self.reader.read_frame()
+        return None if frame is None else decode_frame(frame[0], frame[1], self.compression)
+
+    def _read_loop(self):
+        error = None
+        while True:
+            try:
+                received = self._read_message()
+            except Exception as e:
+                error = e
+                break
+            if received is None:
+                break
+            request_id, data = received
+            try:
+                message = self.codec.decode(data)
+                if request_id is not None:
+                    message = {"request_id": request_id, "result": message}
+            except Exception as e:
+                log_event(f"Thông điệp {self.codec.name} không hợp lệ từ server: {type(e).__name__}: {e}")
+                continue
+            try:
+                self._dispatch(message)
+            except Exception as e:
+                log_event(f"Lỗi xử lý thông điệp từ server: {type(e).__name__}: {str(e)}")
+        self._fail_pending(error or ConnectionError("Server đã đóng kết nối"))
+
+    def _dispatch(self, message):
+        request_id = message.get("request_id") if isinstance(message, dict) else None
+        with self.lock:
+            if self.version >= 2:
+                future = self.pending.pop(request_id, None) if request_id is not None else None
+            elif self.order:
+                future = self.pending.pop(self.order.popleft(), None)
+                if future is None:
+                    log_event(f"Bỏ qua phản hồi của yêu cầu đã hết thời gian chờ: {request_id}")
+                    return
+            else:
+                future = None
+        if future is not None:
+            if isinstance(message, dict) and message.keys() == {"request_id", "result"}:
+                # Phản hồi không phải object (danh sách kênh, danh sách peer...) được server bọc lại
+                message = message["result"]
+            future.set_result(message)
+            return
+        handler = self.handlers.get(message.get("type")) if isinstance(message, dict) else None
+        handler = handler or self.default_handler
+        if handler is not None:
+            handler(message)
+        else:
+            log_event(f"Bỏ qua thông điệp không khớp yêu cầu nào từ server: {request_id}")
+
+    def _fail_pending(self, error):
+        with self.lock:
+            self.closed = True
+            pending, self.pending = self.pending, {}
+            self.order.clear()
+        for future in pending.values():
+            if not future.done():
+                future.set_exception(ConnectionError(f"Mất kết nối đến server: {error}"))
+        log_event(f"Đóng kết nối đến server ({type(error).__name__}: {str(error)}), hủy {len(pending)} yêu cầu đang chờ")
+
+    def getpeername(self):
+        return self.sock.getpeername()
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except Exception:
+            pass
+        try:
+            self.sock.close()
+        except Exception:
+            pass
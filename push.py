@@ -0,0 +1,299 @@
+import socket
+import threading
+import selectors
+import queue
+from collections import deque
+from utils import log_event
+from codec import JSON_CODEC, json_line
+
+PUSH_TIMEOUT = 5  # Timeout khi kết nối và khi gửi thông báo đến peer
+QUEUE_SIZE = 256  # Số thông báo tối đa chờ gửi cho mỗi peer
+FANOUT_WORKERS = 4  # Số thread gửi thông báo
+OPEN_WORKERS = 4  # Số thread mở kết nối push; tách khỏi thread gửi để kết nối chậm không chặn việc gửi
+SEND_BATCH = 64  # Số thông báo tối đa ghi trong một lần gửi
+
+# Chính sách khi hàng đợi của peer đầy
+DROP_OLDEST = "drop_oldest"  # Bỏ thông báo cũ nhất để nhận thông báo mới
+DROP_NEWEST = "drop_newest"  # Bỏ thông báo mới
+DISCONNECT = "disconnect"  # Coi peer là quá chậm và đóng kết nối push
+DROP_POLICY = DROP_OLDEST
+PUSH_HELLO = json_line({"type": "push_hello"})  # Dòng đầu tiên trên kết nối push: client không coi đây là peer
+
+class PushConnection:
+    """Kết nối TCP lâu dài từ server đến cổng P2P của một peer, dùng để đẩy thông báo."""
+    def __init__(self, peer, sock):
+        self.peer = peer
+        self.sock = sock
+        self.send_lock = threading.Lock()
+        self.alive = True
+
+    def send(self, data):
+        with self.send_lock:
+            if not self.alive:
+                return False
+            try:
+                self.sock.sendall(data)
+                return True
+            except Exception as e:
+                log_event(f"Lỗi gửi thông báo push đến {self.peer['username']}: {type(e).__name__}: {str(e)}")
+                return False
+
+    def close(self):
+        self.alive = False
+        try:
+            self.sock.close()
+        except Exception:
+            pass
+
+def connect_push(peer):
+    """Mở kết nối push chặn đến peer (chế độ thread)."""
+    sock = socket.create_connection((peer['ip'], peer['port']), timeout=PUSH_TIMEOUT)
+    try:
+        sock.sendall(PUSH_HELLO)
+    except Exception:
+        sock.close()
+        raise
+    return PushConnection(peer, sock)
+
+class OutboundQueue:
+    """Hàng đợi thông báo có giới hạn của một peer, kèm các bộ đếm."""
+    def __init__(self, conn, maxsize=QUEUE_SIZE, policy=DROP_POLICY):
+        self.conn = conn
+        self.items = deque()
+        self.maxsize = maxsize
+        self.policy = policy
+        self.scheduled = False  # Đang nằm trong hàng đợi sẵn sàng hoặc đang được một worker gửi
+        self.enqueued = 0
+        self.sent = 0
+        self.dropped = 0
+        self.high_watermark = 0
+
+    def stats(self):
+        return {
+            "username": self.conn.peer['username'],
+            "depth": len(self.items),
+            "enqueued": self.enqueued,
+            "sent": self.sent,
+            "dropped": self.dropped,
+            "high_watermark": self.high_watermark
+        }
+
+class PushManager:
+    """Giữ một kết nối push và một hàng đợi gửi cho mỗi peer đã đăng ký.
+
+    Các yêu cầu chỉ đưa thông báo vào hàng đợi của peer; một nhóm worker gửi
+    chúng theo đúng thứ tự của từng peer, nên một peer chậm không làm chậm
+    các yêu cầu khác. Khi gửi thất bại hoặc peer đóng kết nối, peer bị đánh
+    dấu chết một lần và bị bỏ qua cho đến khi gửi lại submit_info.
+    """
+    def __init__(self, connector=connect_push, workers=FANOUT_WORKERS, open_workers=OPEN_WORKERS):
+        self.connector = connector
+        self.opener = None  # Nếu được đặt (chế độ asyncio), request_open chỉ lên lịch mở kết nối qua hàm này
+        self.queues = {}  # {(ip, port): OutboundQueue}
+        self.lock = threading.Lock()
+        self.ready = queue.Queue()
+        self.workers = workers
+        self.workers_started = False
+        self.opening = queue.Queue()  # Peer chờ mở kết nối push, do các thread opener xử lý
+        self.open_workers = open_workers
+        self.openers_started = False
+        self.totals = {"enqueued": 0, "sent": 0, "dropped": 0, "failed": 0, "skipped": 0}
+        self.selector = None
+        self.pending = []
+        self.wakeup_r = None
+        self.wakeup_w = None
+
+    def request_open(self, peer):
+        """Giao việc mở kết nối push cho các thread opener và trả về ngay, không chờ kết nối."""
+        if self.opener is not None:
+            self.opener(peer)
+            return
+        with self.lock:
+            if not self.openers_started:
+                for i in range(self.open_workers):
+                    threading.Thread(target=self._open_loop, name=f"push-opener-{i}", daemon=True).start()
+                self.openers_started = True
+        self.opening.put(dict(peer))
+
+    def _open_loop(self):
+        while True:
+            self.open(self.opening.get())
+
+    def open(self, peer):
+        """Mở kết nối push (chặn đến PUSH_TIMEOUT giây) và đăng ký hàng đợi cho peer."""
+        try:
+            conn = self.connector(peer)
+        except Exception as e:
+            self.open_failed(peer, e)
+            return False
+        self.attach(peer, conn)
+        return True
+
+    def open_failed(self, peer, error):
+        key = (peer['ip'], peer['port'])
+        log_event(f"Không thể mở kết nối push đến {peer['username']} tại {key}: {type(error).__name__}: {str(error)}")
+        self.close(*key)
+
+    def attach(self, peer, conn):
+        """Đăng ký kết nối push đã mở, thay thế kết nối cũ của peer nếu có."""
+        key = (peer['ip'], peer['port'])
+        with self.lock:
+            old = self.queues.pop(key, None)
+            self.queues[key] = OutboundQueue(conn)
+            self._start_workers()
+        if old:
+            old.conn.close()
+        if isinstance(conn, PushConnection):
+            self._watch(conn)
+        log_event(f"Mở kết nối push đến {peer['username']} tại {key}")
+
+    def _start_workers(self):
+        # Gọi khi đang giữ self.lock
+        if not self.workers_started:
+            for i in range(self.workers):
+                threading.Thread(target=self._send_loop, name=f"push-worker-{i}", daemon=True).start()
+            self.workers_started = True
+
+    def close(self, ip, port):
+        with self.lock:
+            outbox = self.queues.pop((ip, port), None)
+        if outbox:
+            outbox.conn.close()
+            log_event(f"Đóng kết nối push đến {ip}:{port}")
+
+    def mark_dead(self, conn, reason):
+        key = (conn.peer['ip'], conn.peer['port'])
+        with self.lock:
+            outbox = self.queues.get(key)
+            if outbox is not None and outbox.conn is conn:
+                del self.queues[key]
+                self.totals["failed"] += len(outbox.items)
+                outbox.items.clear()
+            else:
+                outbox = None
+        if outbox:
+            conn.close()
+            log_event(f"Peer {conn.peer['username']} tại {key} không còn nhận thông báo ({reason}), bỏ qua cho đến khi đăng ký lại")
+
+    def send(self, peer, data):
+        """Đưa thông báo vào hàng đợi của peer. Trả về False nếu peer không có kết nối sống hoặc thông báo bị bỏ."""
+        slow_conn = None
+        with self.lock:
+            outbox = self.queues.get((peer['ip'], peer['port']))
+            if outbox is None:
+                self.totals["skipped"] += 1
+                return False
+            if len(outbox.items) >= outbox.maxsize:
+                outbox.dropped += 1
+                self.totals["dropped"] += 1
+                if outbox.policy == DROP_NEWEST:
+                    return False
+                if outbox.policy == DISCONNECT:
+                    slow_conn = outbox.conn
+                else:
+                    outbox.items.popleft()
+            if slow_conn is None:
+                outbox.items.append(data)
+                outbox.enqueued += 1
+                self.totals["enqueued"] += 1
+                outbox.high_watermark = max(outbox.high_watermark, len(outbox.items))
+                if not outbox.scheduled:
+                    outbox.scheduled = True
+                    self.ready.put(outbox)
+        if slow_conn is not None:
+            self.mark_dead(slow_conn, "hàng đợi đầy")
+            return False
+        return True
+
+    def _send_loop(self):
+        while True:
+            outbox = self.ready.get()
+            with self.lock:
+                batch = [outbox.items.popleft() for _ in range(min(SEND_BATCH, len(outbox.items)))]
+            if batch and not outbox.conn.send(b"".join(batch)):
+                with self.lock:
+                    self.totals["failed"] += len(batch)
+                    outbox.scheduled = False
+                self.mark_dead(outbox.conn, "gửi thất bại")
+                continue
+            with self.lock:
+                outbox.sent += len(batch)
+                self.totals["sent"] += len(batch)
+                if outbox.items and outbox.conn.alive:
+                    self.ready.put(outbox)
+                else:
+                    outbox.scheduled = False
+
+    def metrics(self):
+        """Trả về bộ đếm tổng và theo từng peer của hàng đợi thông báo."""
+        with self.lock:
+            per_peer = {f"{ip}:{port}": outbox.stats() for (ip, port), outbox in self.queues.items()}
+            totals = dict(self.totals)
+        totals["peers"] = len(per_peer)
+        totals["queued"] = sum(stats["depth"] for stats in per_peer.values())
+        totals["policy"] = DROP_POLICY
+        totals["per_peer"] = per_peer
+        return totals
+
+    def _watch(self, conn):
+        """Đưa kết nối vào thread đọc chung để trả lời ping và phát hiện peer đóng kết nối."""
+        with self.lock:
+            if self.selector is None:
+                self.selector = selectors.DefaultSelector()
+                self.wakeup_r, self.wakeup_w = socket.socketpair()
+                self.wakeup_r.setblocking(False)
+                self.selector.register(self.wakeup_r, selectors.EVENT_READ, None)
+                threading.Thread(target=self._read_loop, name="push-reader", daemon=True).start()
+            self.pending.append(conn)
+        try:
+            self.wakeup_w.send(b'\0')
+        except Exception:
+            pass
+
+    def _read_loop(self):
+        buffers = {}
+        while True:
+            for key, _ in self.selector.select(timeout=1):
+                conn = key.data
+                if conn is None:
+                    try:
+                        self.wakeup_r.recv(4096)
+                    except BlockingIOError:
+                        pass
+                    continue
+                try:
+                    data = conn.sock.recv(4096)
+                except socket.timeout:
+                    continue
+                except Exception:
+                    data = b""
+                if not data:
+                    self.selector.unregister(conn.sock)
+                    buffers.pop(conn, None)
+                    self.mark_dead(conn, "peer đóng kết nối")
+                    continue
+                buffer = buffers.get(conn, b"") + data
+                *lines, buffers[conn] = buffer.split(b'\n')
+                for line in lines:
+                    self._handle_line(conn, line)
+            # Gỡ các kết nối đã đóng trước khi đăng ký kết nối mới, tránh trùng số fd
+            for key in list(self.selector.get_map().values()):
+                if key.data is not None and not key.data.alive:
+                    self.selector.unregister(key.fileobj)
+                    buffers.pop(key.data, None)
+            with self.lock:
+                pending, self.pending = self.pending, []
+            for conn in pending:
+                if conn.alive:
+                    self.selector.register(conn.sock, selectors.EVENT_READ, conn)
+
+    def _handle_line(self, conn, line):
+        # Peer gửi ping định kỳ trên mọi kết nối P2P; các dữ liệu khác được bỏ qua
+        try:
+            message = JSON_CODEC.decode(line)
+        except ValueError:
+            return
+        if isinstance(message, dict) and message.get("type") == "ping":
+            conn.send(json_line({"type": "pong"}))
+
+push_manager = PushManager()
@@ -1,273 +1,89 @@
 import socket
 import threading
-import json
-from tracker import Tracker
+import sys
+import time
+from tracker import Tracker, LEASE_SECONDS, LEASE_TICK
+from dispatcher import Dispatcher
+from push import push_manager
 from sync import channel_storage
-from utils import log_event
+from channel_cache import channel_registry
+from utils import log_event, DEBUG
 from message_log import log_message
-from database import init_db, save_message
+from database import init_db, save_message_batch
+from persistence import message_writer
+from protocol import FrameReader, choose_version, encode_message, MAX_IN_FLIGHT
+from codec import JSON_CODEC, choose_codec, json_line
+from compression import choose_compression
 from datetime import datetime
 
 HOST = '0.0.0.0'
 PORT = 5000
+HISTORY_PAGE_SIZE = 500  # Số tin nhắn tối đa trong một phản hồi lịch sử
 
 tracker = Tracker()
-lock = threading.Lock()
+dispatcher = Dispatcher()
+livestream_lock = threading.Lock()  # Bảo vệ livestream_status và channel_livestreamers giữa các shard
 api_started = False
 livestream_status = {}  # Theo dõi tất cả peer đang livestream {username: channel}
 channel_livestreamers = {}  # Theo dõi danh sách peer đang livestream trong mỗi kênh {channel: [username]}
 
+class ClientConnection:
+    """Bọc socket của client, gửi phản hồi theo giao thức và codec đã thỏa thuận (dòng JSON v1 hoặc frame v2)."""
+    def __init__(self, sock, addr):
+        self.sock = sock
+        self.addr = addr
+        self.version = 1
+        self.codec = JSON_CODEC
+        self.compression = None
+        self.send_lock = threading.Lock()  # Ở v2 nhiều shard có thể trả lời cùng lúc trên một kết nối
+        self.in_flight = threading.BoundedSemaphore(MAX_IN_FLIGHT)
+
+    def send(self, payload, request_id=None):
+        self.send_encoded(self.codec.encode(payload), request_id)
+
+    def send_encoded(self, data, request_id=None, cached=False):
+        """Gửi một thông điệp đã mã hóa bằng self.codec; request_id chỉ cần cho phản hồi không phải object (danh sách...).
+
+        cached=True cho payload dùng chung giữa các kết nối để bản nén của nó được dùng lại.
+        """
+        data = encode_message(data, self.version, self.codec, request_id, self.compression, cached)
+        with self.send_lock:
+            self.sock.sendall(data)
+
+    def finish(self, future):
+        """Được gọi khi một yêu cầu v2 xử lý xong: giải phóng chỗ và đóng kết nối nếu client ngắt."""
+        self.in_flight.release()
+        if not future.exception() and future.result() is False:
+            try:
+                self.sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
 def handle_client(conn, addr):
     with conn:
         print(f"[+] Kết nối từ {addr}")
         log_event(f"Kết nối từ {addr}")
-        buffer = ""
+        client = ClientConnection(conn, addr)
+        reader = FrameReader(conn)
         try:
             while True:
                 conn.settimeout(30)  # Tăng timeout lên 30 giây
-                data = conn.recv(8192).decode('utf-8')
-                if not data:
+                message = reader.read_message(client.version, client.compression)
+                if message is None:
+                    break
+                request = parse_request(message, client)
+                if request is None:
+                    continue
+                if isinstance(request, dict) and request.get('type') == 'hello':
+                    negotiate_protocol(request, client)
+                    continue
+                if client.version >= 2:
+                    # Client v2 ghép phản hồi theo request_id: đọc yêu cầu tiếp theo mà không chờ
+                    client.in_flight.acquire()
+                    dispatcher.submit(request, handle_request, request, addr, client).add_done_callback(client.finish)
+                    continue
+                if not dispatcher.submit(request, handle_request, request, addr, client).result():
                     break
-                buffer += data
-                while '\n' in buffer:
-                    message, buffer = buffer.split('\n', 1)
-                    if not message:
-                        continue
-                    try:
-                        request = json.loads(message)
-                        print(f"[SERVER] Nhận yêu cầu từ {addr}: {request}")
-                        log_event(f"Nhận yêu cầu từ {addr}: {request}")
-                    except json.JSONDecodeError as e:
-                        error_msg = f"[ERROR] JSON không hợp lệ từ {addr}: {e}"
-                        print(error_msg)
-                        log_event(error_msg)
-                        conn.sendall((json.dumps({"error": "JSON không hợp lệ", "request_id": "unknown"}) + '\n').encode('utf-8'))
-                        continue
-
-                    with lock:
-                        request_id = request.get("request_id", "unknown")
-                        try:
-                            if request['type'] == 'register':
-                                from database import register_user
-                                username = request['username']
-                                password = request['password']
-                                if not username or not password:
-                                    conn.sendall((json.dumps({"error": "Tên người dùng hoặc mật khẩu trống", "request_id": request_id}) + '\n').encode('utf-8'))
-                                    continue
-                                if register_user(username, password):
-                                    conn.sendall((json.dumps({"status": "Đăng ký thành công", "request_id": request_id}) + '\n').encode('utf-8'))
-                                    log_event(f"Đăng ký thành công: {username}")
-                                else:
-                                    conn.sendall((json.dumps({"error": "Tên người dùng đã tồn tại", "request_id": request_id}) + '\n').encode('utf-8'))
-                            
-                            elif request['type'] == 'login':
-                                from database import login_user
-                                username = request['username']
-                                password = request['password']
-                                if not username or not password:
-                                    conn.sendall((json.dumps({"error": "Tên người dùng hoặc mật khẩu trống", "request_id": request_id}) + '\n').encode('utf-8'))
-                                    continue
-                                if login_user(username, password):
-                                    conn.sendall((json.dumps({"status": "Đăng nhập thành công", "request_id": request_id}) + '\n').encode('utf-8'))
-                                    log_event(f"Đăng nhập thành công: {username}")
-                                else:
-                                    conn.sendall((json.dumps({"error": "Tên người dùng hoặc mật khẩu không đúng", "request_id": request_id}) + '\n').encode('utf-8'))
-                                    log_event(f"Đăng nhập thất bại: {username}")
-                            
-                            elif request['type'] == 'submit_info':
-                                from database import login_user
-                                username = request['username']
-                                password = request.get('password', '')
-                                if not request.get('visitor', False):
-                                    if not password:
-                                        conn.sendall((json.dumps({"error": "Thiếu mật khẩu xác thực", "request_id": request_id}) + '\n').encode('utf-8'))
-                                        continue
-                                    if not login_user(username, password):
-                                        conn.sendall((json.dumps({"error": "Tên người dùng hoặc mật khẩu không đúng", "request_id": request_id}) + '\n').encode('utf-8'))
-                                        continue
-                                peer_info = {
-                                    'ip': addr[0],
-                                    'port': request['port'],
-                                    'username': username,
-                                    'session_id': request['session_id'],
-                                    'visitor': request.get('visitor', False),
-                                    'invisible': request.get('invisible', False),
-                                    'online': True
-                                }
-                                if tracker.peer_exists(addr[0], request['port']):
-                                    tracker.remove_peer(addr[0], request['port'])
-                                    log_event(f"Xóa peer cũ: IP={addr[0]}, Port={request['port']}")
-                                tracker.add_peer(
-                                    addr[0], request['port'], username,
-                                    request['session_id'], request.get('visitor', False),
-                                    request.get('invisible', False), True
-                                )
-                                print(f"[TRACKER] Thêm/Cập nhật peer: {peer_info}")
-                                log_event(f"Thêm/Cập nhật peer: {peer_info}")
-                                conn.sendall((json.dumps({"status": "success", "message": "Thông tin được gửi thành công", "request_id": request_id}) + '\n').encode('utf-8'))
-
-                            elif request['type'] == 'get_list':
-                                peers = tracker.get_peers()
-                                if not peers:
-                                    log_event("Trả về danh sách peer rỗng")
-                                response = json.dumps(peers)
-                                conn.sendall((response + '\n').encode('utf-8'))
-                                print(f"[SERVER] Gửi danh sách peer đến {addr}: {len(peers)} peer")
-                                log_event(f"Gửi danh sách peer đến {addr}: {len(peers)} peer")
-
-                            elif request['type'] == 'sync_upload':
-                                channel = request['channel']
-                                message = request['message']
-                                from database import get_channels
-                                if channel not in get_channels():
-                                    from database import create_channel
-                                    create_channel(channel, request.get('username', 'system'))
-                                    channel_storage[channel] = {'messages': [], 'creator': request.get('username', 'system')}
-                                channel_storage[channel]['messages'].append(message)
-                                timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                                save_message(channel, request.get('username', 'system'), message, timestamp)
-                                print(f"[SYNC] Thêm tin nhắn vào {channel}: {message}")
-                                log_event(f"Thêm tin nhắn vào kênh {channel}: {message}")
-                                conn.sendall((json.dumps({"status": "success", "message": "Đồng bộ tải lên thành công", "request_id": request_id}) + '\n').encode('utf-8'))
-                                notify_clients_new_message(channel, message)
-
-                            elif request['type'] == 'sync_download':
-                                channel = request['channel']
-                                if not isinstance(channel, str):
-                                    error_msg = f"[ERROR] Kênh không hợp lệ trong sync_download: {channel}"
-                                    print(error_msg)
-                                    log_event(error_msg)
-                                    conn.sendall((json.dumps({"error": "Kênh không hợp lệ", "request_id": request_id}) + '\n').encode('utf-8'))
-                                    continue
-                                try:
-                                    conn.settimeout(0.1)
-                                    while True:
-                                        try:
-                                            conn.recv(4096)
-                                        except socket.timeout:
-                                            break
-                                    conn.settimeout(30)
-                                except:
-                                    pass
-                                from database import get_messages
-                                messages = [f"{msg['sender']}: {msg['message']} [{msg['timestamp']}]" for msg in get_messages(channel)]
-                                response = json.dumps(messages)
-                                conn.sendall((response + '\n').encode('utf-8'))
-                                print(f"[SYNC] Gửi {len(messages)} tin nhắn cho kênh {channel} đến {addr}")
-                                log_event(f"Gửi {len(messages)} tin nhắn cho kênh {channel} đến {addr}")
-
-                            elif request['type'] == 'disconnect':
-                                try:
-                                    channel = livestream_status.get(request['username'])
-                                    if channel:
-                                        del livestream_status[request['username']]
-                                        if channel in channel_livestreamers:
-                                            channel_livestreamers[channel].remove(request['username'])
-                                            if not channel_livestreamers[channel]:
-                                                del channel_livestreamers[channel]
-                                            else:
-                                                new_primary = channel_livestreamers[channel][0]
-                                                notify_new_primary_streamer(channel, new_primary)
-                                        notify_livestream_stop(channel, request['username'])
-                                    tracker.remove_peer(addr[0], request['port'])
-                                    print(f"[SERVER] Peer {addr[0]}:{request['port']} đã ngắt kết nối.")
-                                    log_event(f"Peer {addr[0]}:{request['port']} đã ngắt kết nối")
-                                    conn.sendall((json.dumps({"status": "success", "message": "Peer ngắt kết nối thành công", "request_id": request_id}) + '\n').encode('utf-8'))
-                                except Exception as e:
-                                    error_msg = f"[ERROR] Không thể ngắt kết nối peer {addr[0]}:{request['port']}: {e}"
-                                    print(error_msg)
-                                    log_event(error_msg)
-                                break
-
-                            elif request['type'] == 'create_channel':
-                                channel = request['channel']
-                                username = request['username']
-                                from database import create_channel
-                                if create_channel(channel, username):
-                                    if channel not in channel_storage:
-                                        channel_storage[channel] = {'messages': [], 'creator': username}
-                                    print(f"[SERVER] Tạo kênh mới: {channel} bởi {username}")
-                                    log_event(f"Tạo kênh mới: {channel} bởi {username}")
-                                    conn.sendall((json.dumps({"status": "success", "message": f"Kênh {channel} được tạo thành công", "request_id": request_id}) + '\n').encode('utf-8'))
-                                    notify_channel_creation(channel, username)
-                                else:
-                                    conn.sendall((json.dumps({"error": "Kênh đã tồn tại", "request_id": request_id}) + '\n').encode('utf-8'))
-
-                            elif request['type'] == 'get_channel_list':
-                                try:
-                                    from database import get_channels
-                                    channels = get_channels()
-                                    if not channels:
-                                        channels = ["general"]
-                                    response = json.dumps(channels)
-                                    conn.sendall((response + '\n').encode('utf-8'))
-                                    print(f"[SERVER] Gửi danh sách kênh đến {addr}: {channels}")
-                                    log_event(f"Gửi danh sách kênh đến {addr}: {channels}")
-                                except Exception as e:
-                                    error_msg = f"[ERROR] Không thể gửi danh sách kênh đến {addr}: {type(e).__name__}: {str(e)}"
-                                    print(error_msg)
-                                    log_event(error_msg)
-                                    conn.sendall((json.dumps(["general"], request_id=request_id) + '\n').encode('utf-8'))
-
-                            elif request['type'] == 'start_livestream':
-                                channel = request['channel']
-                                username = request['username']
-                                target_peers = request.get('target_peers', [])  # Lấy danh sách target_peers
-                                livestream_status[username] = channel
-                                if channel not in channel_livestreamers:
-                                    channel_livestreamers[channel] = []
-                                if username not in channel_livestreamers[channel]:
-                                    channel_livestreamers[channel].append(username)
-                                if len(channel_livestreamers[channel]) == 1:
-                                    notify_new_primary_streamer(channel, username)
-                                notify_livestream_start(channel, username, target_peers)  # Chuyển tiếp target_peers
-                                conn.sendall((json.dumps({"status": "success", "message": "Livestream bắt đầu", "request_id": request_id}) + '\n').encode('utf-8'))
-                                print(f"[SERVER] Livestream bắt đầu trong {channel} bởi {username}")
-                                log_event(f"Livestream bắt đầu trong {channel} bởi {username}")
-
-                            elif request['type'] == 'stop_livestream':
-                                channel = request['channel']
-                                username = request['username']
-                                if livestream_status.get(username) == channel:
-                                    del livestream_status[username]
-                                if channel in channel_livestreamers and username in channel_livestreamers[channel]:
-                                    channel_livestreamers[channel].remove(username)
-                                    if not channel_livestreamers[channel]:
-                                        del channel_livestreamers[channel]
-                                    else:
-                                        new_primary = channel_livestreamers[channel][0]
-                                        notify_new_primary_streamer(channel, new_primary)
-                                notify_livestream_stop(channel, username)
-                                conn.sendall((json.dumps({"status": "success", "message": "Livestream kết thúc", "request_id": request_id}) + '\n').encode('utf-8'))
-                                print(f"[SERVER] Livestream kết thúc trong {channel} bởi {username}")
-                                log_event(f"Livestream kết thúc trong {channel} bởi {username}")
-
-                            elif request['type'] == 'update_status':
-                                try:
-                                    tracker.update_peer_status(
-                                        addr[0], request['port'],
-                                        online=request.get('online', True),
-                                        invisible=request.get('invisible', False)
-                                    )
-                                    print(f"[TRACKER] Cập nhật trạng thái cho {addr[0]}:{request['port']}")
-                                    log_event(f"Cập nhật trạng thái cho {addr[0]}:{request['port']}")
-                                    conn.sendall((json.dumps({"status": "success", "message": "Trạng thái được cập nhật", "request_id": request_id}) + '\n').encode('utf-8'))
-                                except Exception as e:
-                                    error_msg = f"[ERROR] Không thể cập nhật trạng thái cho {addr[0]}:{request['port']}: {e}"
-                                    print(error_msg)
-                                    log_event(error_msg)
-                                    conn.sendall((json.dumps({"error": "Không thể cập nhật trạng thái", "request_id": request_id}) + '\n').encode('utf-8'))
-
-                            else:
-                                error_msg = f"[ERROR] Loại yêu cầu không xác định từ {addr}: {request['type']}"
-                                print(error_msg)
-                                log_event(error_msg)
-                                conn.sendall((json.dumps({"error": "Loại yêu cầu không xác định", "request_id": request_id}) + '\n').encode('utf-8'))
-                        except Exception as e:
-                            error_msg = f"[ERROR] Xử lý yêu cầu {request.get('type', 'unknown')} từ {addr}: {type(e).__name__}: {str(e)}"
-                            print(error_msg)
-                            log_event(error_msg)
-                            conn.sendall((json.dumps({"error": f"Yêu cầu thất bại: {str(e)}", "request_id": request_id}) + '\n').encode('utf-8'))
         except socket.timeout:
             print(f"[SERVER] Hết thời gian chờ cho client {addr}")
             log_event(f"Hết thời gian chờ cho client {addr}")
@@ -278,146 +94,489 @@ def handle_client(conn, addr):
             conn.settimeout(None)
             conn.close()
 
-def notify_clients_new_message(channel, message):
+def parse_request(message, conn):
+    """Giải mã một thông điệp từ client bằng codec của kết nối, trả về None nếu rỗng hoặc không hợp lệ."""
+    if isinstance(message, str):
+        message = message.strip()
+    if not message:
+        return None
+    try:
+        request = conn.codec.decode(message)
+        print(f"[SERVER] Nhận yêu cầu từ {conn.addr}: {request}")
+        log_event(f"Nhận yêu cầu từ {conn.addr}: {request}")
+        return request
+    except ValueError as e:
+        error_msg = f"[ERROR] Thông điệp {conn.codec.name} không hợp lệ từ {conn.addr}: {e}"
+        print(error_msg)
+        log_event(error_msg)
+        conn.send({"error": "Thông điệp không hợp lệ", "request_id": "unknown"})
+        return None
+
+def negotiate_protocol(request, conn):
+    """Trả lời hello theo v1 rồi chuyển kết nối sang phiên bản cao nhất hai bên cùng hỗ trợ.
+
+    Từ v2, hai bên cũng chọn codec (codec nhị phân đầu tiên mà client có, nếu không thì JSON)
+    và thuật toán nén frame (None nếu client không hỗ trợ).
+    """
+    version = choose_version(request)
+    codec = choose_codec(request.get("codecs")) if version >= 2 else JSON_CODEC
+    compression = choose_compression(request.get("compression")) if version >= 2 else None
+    conn.send({"type": "hello", "version": version, "codec": codec.name,
+               "compression": compression.name if compression else None,
+               "request_id": request.get("request_id", "unknown")})
+    conn.version = version
+    conn.codec = codec
+    conn.compression = compression
+    log_event(f"Kết nối {conn.addr} dùng giao thức v{version}, codec {codec.name}, "
+              f"nén {compression.name if compression else 'không'}")
+
+def handle_request(request, addr, conn):
+    """Xử lý một yêu cầu của client. Trả về False khi client yêu cầu ngắt kết nối."""
+    request_id = request.get("request_id", "unknown")
+    try:
+        if request['type'] == 'register':
+            from database import register_user
+            username = request['username']
+            password = request['password']
+            if not username or not password:
+                conn.send({"error": "Tên người dùng hoặc mật khẩu trống", "request_id": request_id})
+                return True
+            if register_user(username, password):
+                conn.send({"status": "Đăng ký thành công", "request_id": request_id})
+                log_event(f"Đăng ký thành công: {username}")
+            else:
+                conn.send({"error": "Tên người dùng đã tồn tại", "request_id": request_id})
+
+        elif request['type'] == 'login':
+            from database import login_user
+            username = request['username']
+            password = request['password']
+            if not username or not password:
+                conn.send({"error": "Tên người dùng hoặc mật khẩu trống", "request_id": request_id})
+                return True
+            if login_user(username, password):
+                conn.send({"status": "Đăng nhập thành công", "request_id": request_id})
+                log_event(f"Đăng nhập thành công: {username}")
+            else:
+                conn.send({"error": "Tên người dùng hoặc mật khẩu không đúng", "request_id": request_id})
+                log_event(f"Đăng nhập thất bại: {username}")
+
+        elif request['type'] == 'submit_info':
+            from database import login_user
+            username = request['username']
+            password = request.get('password', '')
+            if not request.get('visitor', False):
+                if not password:
+                    conn.send({"error": "Thiếu mật khẩu xác thực", "request_id": request_id})
+                    return True
+                if not login_user(username, password):
+                    conn.send({"error": "Tên người dùng hoặc mật khẩu không đúng", "request_id": request_id})
+                    return True
+            peer_info = {
+                'ip': addr[0],
+                'port': request['port'],
+                'username': username,
+                'session_id': request['session_id'],
+                'visitor': request.get('visitor', False),
+                'invisible': request.get('invisible', False),
+                'online': True
+            }
+            dispatcher.call_tracker(register_peer, addr, request)
+            print(f"[TRACKER] Thêm/Cập nhật peer: {peer_info}")
+            log_event(f"Thêm/Cập nhật peer: {peer_info}")
+            conn.send({"status": "success", "message": "Thông tin được gửi thành công", "request_id": request_id})
+            push_manager.request_open(peer_info)
+
+        elif request['type'] == 'get_list':
+            since_version = request.get('since_version')
+            if since_version is None:
+                # Client cũ: toàn bộ danh sách peer hiển thị
+                count = tracker.visible_peer_count()
+                if not count:
+                    log_event("Trả về danh sách peer rỗng")
+                conn.send_encoded(tracker.get_peers_payload(conn.codec), request_id, cached=True)
+                print(f"[SERVER] Gửi danh sách peer đến {addr}: {count} peer")
+                log_event(f"Gửi danh sách peer đến {addr}: {count} peer")
+            else:
+                payload, shared = tracker.get_delta_payload(int(since_version), request.get('epoch'), conn.codec)
+                # Chỉ ảnh chụp dùng chung mới vào bộ nhớ đệm bản nén; delta riêng sẽ đẩy các mục dùng chung ra
+                conn.send_encoded(payload, request_id, cached=shared)
+                log_event(f"Gửi thay đổi danh sách peer từ phiên bản {since_version} đến {addr}")
+
+        elif request['type'] == 'sync_upload':
+            channel = request['channel']
+            message = request['message']
+            if not channel_registry.contains(channel):
+                channel_registry.create(channel, request.get('username', 'system'))
+                channel_storage[channel] = {'messages': [], 'creator': request.get('username', 'system')}
+            timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            # Commit theo nhóm cùng các tin nhắn đồng thời khác; chỉ xác nhận sau khi đã commit
+            if not message_writer.save(channel, request.get('username', 'system'), message, timestamp):
+                conn.send({"error": "Không thể lưu tin nhắn", "request_id": request_id})
+                return True
+            channel_storage[channel]['messages'].append(message)
+            print(f"[SYNC] Thêm tin nhắn vào {channel}: {message}")
+            log_event(f"Thêm tin nhắn vào kênh {channel}: {message}")
+            conn.send({"status": "success", "message": "Đồng bộ tải lên thành công", "request_id": request_id})
+            notify_clients_new_message(channel, message, request.get('username', 'system'))
+
+        elif request['type'] == 'sync_upload_batch':
+            messages = request.get('messages')
+            username = request.get('username', 'system')
+            if not isinstance(messages, list) or not all(
+                    isinstance(msg, dict) and isinstance(msg.get('channel'), str) and isinstance(msg.get('message'), str)
+                    for msg in messages):
+                conn.send({"error": "Lô tin nhắn không hợp lệ", "request_id": request_id})
+                return True
+            timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            rows = [(msg['channel'], username, msg['message'], timestamp) for msg in messages]
+            if not save_message_batch(rows, creator=username):
+                conn.send({"error": "Không thể lưu lô tin nhắn", "request_id": request_id})
+                return True
+            channel_registry.add(msg['channel'] for msg in messages)
+            for msg in messages:
+                channel_storage.setdefault(msg['channel'], {'messages': [], 'creator': username})['messages'].append(msg['message'])
+            print(f"[SYNC] Thêm lô {len(rows)} tin nhắn từ {username}")
+            log_event(f"Thêm lô {len(rows)} tin nhắn từ {username}")
+            conn.send({"status": "success", "message": "Đồng bộ lô tải lên thành công", "count": len(rows), "request_id": request_id})
+            notify_clients_new_messages([(msg['channel'], msg['message']) for msg in messages], username)
+
+        elif request['type'] == 'sync_download':
+            channel = request['channel']
+            if not isinstance(channel, str):
+                error_msg = f"[ERROR] Kênh không hợp lệ trong sync_download: {channel}"
+                print(error_msg)
+                log_event(error_msg)
+                conn.send({"error": "Kênh không hợp lệ", "request_id": request_id})
+                return True
+            since = request.get('since')
+            if since is None:
+                # Client cũ: trả về toàn bộ lịch sử dưới dạng danh sách
+                from database import get_messages
+                messages = [f"{msg['sender']}: {msg['message']} [{msg['timestamp']}]" for msg in get_messages(channel, active_only=True)]
+                conn.send(messages, request_id)
+            else:
+                from database import get_messages_after
+                rows = get_messages_after(channel, int(since), limit=HISTORY_PAGE_SIZE + 1, active_only=True)
+                has_more = len(rows) > HISTORY_PAGE_SIZE
+                rows = rows[:HISTORY_PAGE_SIZE]
+                messages = [f"{msg['sender']}: {msg['message']} [{msg['timestamp']}]" for msg in rows]
+                cursor = rows[-1]['id'] if rows else int(since)
+                conn.send({"messages": messages, "cursor": cursor, "has_more": has_more, "request_id": request_id})
+            print(f"[SYNC] Gửi {len(messages)} tin nhắn cho kênh {channel} đến {addr}")
+            log_event(f"Gửi {len(messages)} tin nhắn cho kênh {channel} đến {addr}")
+
+        elif request['type'] == 'get_history':
+            channel = request['channel']
+            before = request.get('before')
+            limit = max(1, min(int(request.get('limit', HISTORY_PAGE_SIZE)), HISTORY_PAGE_SIZE))
+            from database import get_messages_before, get_latest_messages
+            if before is None:
+                rows = get_latest_messages(channel, limit + 1, active_only=True)
+            else:
+                rows = get_messages_before(channel, int(before), limit + 1, active_only=True)
+            has_more = len(rows) > limit
+            rows = rows[-limit:]
+            conn.send({
+                "messages": [f"{msg['sender']}: {msg['message']} [{msg['timestamp']}]" for msg in rows],
+                "oldest_id": rows[0]['id'] if rows else before,
+                "newest_id": rows[-1]['id'] if rows else None,
+                "has_more": has_more,
+                "request_id": request_id
+            })
+            log_event(f"Gửi trang {len(rows)} tin nhắn cũ hơn id {before} cho kênh {channel} đến {addr}")
+
+        elif request['type'] == 'search':
+            query = request.get('q')
+            if not isinstance(query, str) or not query.strip():
+                conn.send({"error": "Thiếu từ khóa tìm kiếm", "request_id": request_id})
+                return True
+            from database import search_messages
+            offset = int(request.get('offset', 0))
+            results, has_more = search_messages(query, request.get('channel'), request.get('limit', 20), offset)
+            conn.send({
+                "results": results,
+                "has_more": has_more,
+                "next_offset": offset + len(results) if has_more else None,
+                "request_id": request_id
+            })
+            log_event(f"Tìm kiếm '{query}' cho {addr}: {len(results)} kết quả")
+
+        elif request['type'] == 'disconnect':
+            try:
+                stop_peer_livestream(request['username'])
+                tracker.remove_peer(addr[0], request['port'])
+                push_manager.close(addr[0], request['port'])
+                print(f"[SERVER] Peer {addr[0]}:{request['port']} đã ngắt kết nối.")
+                log_event(f"Peer {addr[0]}:{request['port']} đã ngắt kết nối")
+                conn.send({"status": "success", "message": "Peer ngắt kết nối thành công", "request_id": request_id})
+            except Exception as e:
+                error_msg = f"[ERROR] Không thể ngắt kết nối peer {addr[0]}:{request['port']}: {e}"
+                print(error_msg)
+                log_event(error_msg)
+            return False
+
+        elif request['type'] == 'heartbeat':
+            # Gia hạn lease; peer đã hết hạn phải gửi lại submit_info
+            if tracker.renew(addr[0], request['port']):
+                conn.send({"status": "success", "lease": LEASE_SECONDS, "request_id": request_id})
+            else:
+                conn.send({"error": "Peer chưa đăng ký", "request_id": request_id})
+
+        elif request['type'] == 'create_channel':
+            channel = request['channel']
+            username = request['username']
+            if channel_registry.create(channel, username):
+                if channel not in channel_storage:
+                    channel_storage[channel] = {'messages': [], 'creator': username}
+                print(f"[SERVER] Tạo kênh mới: {channel} bởi {username}")
+                log_event(f"Tạo kênh mới: {channel} bởi {username}")
+                conn.send({"status": "success", "message": f"Kênh {channel} được tạo thành công", "request_id": request_id})
+                notify_channel_creation(channel, username)
+            else:
+                conn.send({"error": "Kênh đã tồn tại", "request_id": request_id})
+
+        elif request['type'] == 'get_channel_list':
+            try:
+                conn.send_encoded(channel_registry.payload(conn.codec), request_id, cached=True)
+                log_event(f"Gửi danh sách kênh đến {addr}")
+            except Exception as e:
+                error_msg = f"[ERROR] Không thể gửi danh sách kênh đến {addr}: {type(e).__name__}: {str(e)}"
+                print(error_msg)
+                log_event(error_msg)
+                conn.send(["general"], request_id)
+
+        elif request['type'] == 'start_livestream':
+            channel = request['channel']
+            username = request['username']
+            target_peers = request.get('target_peers', [])  # Lấy danh sách target_peers
+            with livestream_lock:
+                livestream_status[username] = channel
+                if channel not in channel_livestreamers:
+                    channel_livestreamers[channel] = []
+                if username not in channel_livestreamers[channel]:
+                    channel_livestreamers[channel].append(username)
+                is_primary = len(channel_livestreamers[channel]) == 1
+            if is_primary:
+                notify_new_primary_streamer(channel, username)
+            notify_livestream_start(channel, username, target_peers)  # Chuyển tiếp target_peers
+            conn.send({"status": "success", "message": "Livestream bắt đầu", "request_id": request_id})
+            print(f"[SERVER] Livestream bắt đầu trong {channel} bởi {username}")
+            log_event(f"Livestream bắt đầu trong {channel} bởi {username}")
+
+        elif request['type'] == 'stop_livestream':
+            channel = request['channel']
+            username = request['username']
+            with livestream_lock:
+                if livestream_status.get(username) == channel:
+                    del livestream_status[username]
+                new_primary = remove_livestreamer(channel, username)
+            if new_primary:
+                notify_new_primary_streamer(channel, new_primary)
+            notify_livestream_stop(channel, username)
+            conn.send({"status": "success", "message": "Livestream kết thúc", "request_id": request_id})
+            print(f"[SERVER] Livestream kết thúc trong {channel} bởi {username}")
+            log_event(f"Livestream kết thúc trong {channel} bởi {username}")
+
+        elif request['type'] == 'update_status':
+            try:
+                tracker.update_peer_status(
+                    addr[0], request['port'],
+                    online=request.get('online', True),
+                    invisible=request.get('invisible', False)
+                )
+                print(f"[TRACKER] Cập nhật trạng thái cho {addr[0]}:{request['port']}")
+                log_event(f"Cập nhật trạng thái cho {addr[0]}:{request['port']}")
+                conn.send({"status": "success", "message": "Trạng thái được cập nhật", "request_id": request_id})
+            except Exception as e:
+                error_msg = f"[ERROR] Không thể cập nhật trạng thái cho {addr[0]}:{request['port']}: {e}"
+                print(error_msg)
+                log_event(error_msg)
+                conn.send({"error": "Không thể cập nhật trạng thái", "request_id": request_id})
+
+        else:
+            error_msg = f"[ERROR] Loại yêu cầu không xác định từ {addr}: {request['type']}"
+            print(error_msg)
+            log_event(error_msg)
+            conn.send({"error": "Loại yêu cầu không xác định", "request_id": request_id})
+    except Exception as e:
+        error_msg = f"[ERROR] Xử lý yêu cầu {request.get('type', 'unknown')} từ {addr}: {type(e).__name__}: {str(e)}"
+        print(error_msg)
+        log_event(error_msg)
+        conn.send({"error": f"Yêu cầu thất bại: {str(e)}", "request_id": request_id})
+    return True
+
+def register_peer(addr, request):
+    """Thêm hoặc thay thế peer trong tracker. Chạy trong shard tracker."""
+    if tracker.replace_peer(
+            addr[0], request['port'], request['username'],
+            request['session_id'], request.get('visitor', False),
+            request.get('invisible', False), True):
+        log_event(f"Xóa peer cũ: IP={addr[0]}, Port={request['port']}")
+
+def stop_peer_livestream(username):
+    """Kết thúc livestream của peer (nếu có) và thông báo peer chính mới."""
+    with livestream_lock:
+        channel = livestream_status.pop(username, None)
+        new_primary = remove_livestreamer(channel, username) if channel else None
+    if channel:
+        if new_primary:
+            notify_new_primary_streamer(channel, new_primary)
+        notify_livestream_stop(channel, username)
+
+def expire_peers():
+    """Xóa các peer hết lease. Chạy trong shard tracker."""
+    for peer in tracker.expire_leases():
+        print(f"[TRACKER] Peer {peer['username']} tại {peer['ip']}:{peer['port']} hết hạn lease")
+        log_event(f"Peer {peer['username']} tại {peer['ip']}:{peer['port']} hết hạn lease, xóa khỏi tracker")
+        push_manager.close(peer['ip'], peer['port'])
+        stop_peer_livestream(peer['username'])
+
+def expire_peers_loop():
+    while True:
+        time.sleep(LEASE_TICK)
+        try:
+            dispatcher.call_tracker(expire_peers)
+        except Exception as e:
+            log_event(f"Lỗi xử lý peer hết hạn: {type(e).__name__}: {str(e)}")
+
+def remove_livestreamer(channel, username):
+    """Xóa username khỏi danh sách livestream của kênh, trả về peer chính mới nếu còn. Gọi khi giữ livestream_lock."""
+    if channel in channel_livestreamers and username in channel_livestreamers[channel]:
+        channel_livestreamers[channel].remove(username)
+        if not channel_livestreamers[channel]:
+            del channel_livestreamers[channel]
+        else:
+            return channel_livestreamers[channel][0]
+    return None
+
+def deliver_notification(peer, notification):
+    """Đưa thông báo vào hàng đợi gửi của peer; việc gửi qua kết nối push do các worker của push_manager đảm nhận."""
+    data = json_line(notification)
+    return push_manager.send(peer, data)
+
+def notify_peer_delta(from_version, version, changes):
+    """Đẩy một lô thay đổi danh bạ peer đến các peer online. Được tracker gọi sau mỗi thao tác, khi đã nhả khóa."""
+    notification = {
+        "type": "peer_delta",
+        "epoch": tracker.epoch,
+        "from_version": from_version,
+        "version": version,
+        "changes": changes
+    }
+    data = json_line(notification)
+    sent = 0
+    for peer in tracker.get_peers():
+        if peer['online'] and push_manager.send(peer, data):
+            sent += 1
+    log_event(f"Đẩy thay đổi danh bạ peer phiên bản {version} đến {sent} peer")
+
+tracker.listener = notify_peer_delta
+
+def notify_clients_new_message(channel, message, sender="system"):
+    notification = {"type": "notification", "channel": channel, "message": message}
+    log_message(channel, message, sender, deleted=False)
     for peer in tracker.get_peers():
         if not peer['online']:
-            log_event(f"Bỏ qua thông báo cho peer offline {peer['username']}")
+            log_event("Bỏ qua thông báo cho peer offline %s", peer['username'], level=DEBUG)
             continue
-        for attempt in range(3):  # Thử gửi 3 lần
-            try:
-                s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                s.settimeout(5)
-                s.connect((peer['ip'], peer['port']))
-                notification = json.dumps({"type": "notification", "channel": channel, "message": message})
-                s.sendall((notification + '\n').encode('utf-8'))
-                s.close()
-                log_message(channel, message, peer['username'], deleted=False)
-                log_event(f"Thông báo {peer['username']} về tin nhắn mới trong {channel}")
-                break
-            except Exception as e:
-                log_event(f"Không thể thông báo {peer['username']} về tin nhắn mới (lần {attempt+1}/3): {type(e).__name__}: {str(e)}")
-                if attempt == 2:
-                    log_event(f"Bỏ qua thông báo tin nhắn mới cho {peer['username']} sau 3 lần thất bại")
+        if deliver_notification(peer, notification):
+            log_event("Thông báo %s về tin nhắn mới trong %s", peer['username'], channel, level=DEBUG)
+
+def notify_clients_new_messages(channel_messages, sender="system"):
+    """Thông báo nhiều tin nhắn mới (của cùng người gửi) bằng một thông báo notification_batch cho mỗi peer."""
+    if not channel_messages:
+        return
+    notification = {
+        "type": "notification_batch",
+        "messages": [{"channel": channel, "message": message} for channel, message in channel_messages]
+    }
+    for channel, message in channel_messages:
+        log_message(channel, message, sender, deleted=False)
+    for peer in tracker.get_peers():
+        if not peer['online']:
+            log_event("Bỏ qua thông báo lô tin nhắn cho peer offline %s", peer['username'], level=DEBUG)
+            continue
+        if deliver_notification(peer, notification):
+            log_event("Thông báo %s về %s tin nhắn mới", peer['username'], len(channel_messages), level=DEBUG)
 
 def notify_channel_creation(channel, username):
     message = f"[SYSTEM] Kênh '{channel}' được tạo bởi {username}"
+    notification = {
+        "type": "channel_creation",
+        "channel": channel,
+        "message": message
+    }
+    log_message(channel, message, "system", deleted=False)
     for peer in tracker.get_peers():
         if not peer['online']:
-            log_event(f"Bỏ qua thông báo tạo kênh cho peer offline {peer['username']}")
+            log_event("Bỏ qua thông báo tạo kênh cho peer offline %s", peer['username'], level=DEBUG)
             continue
-        for attempt in range(3):
-            try:
-                s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                s.settimeout(5)
-                s.connect((peer['ip'], peer['port']))
-                notification = json.dumps({
-                    "type": "channel_creation",
-                    "channel": channel,
-                    "message": message
-                })
-                s.sendall((notification + '\n').encode('utf-8'))
-                s.close()
-                log_message(channel, message, "system", deleted=False)
-                log_event(f"Thông báo {peer['username']} về việc tạo kênh: {channel}")
-                break
-            except Exception as e:
-                log_event(f"Không thể thông báo {peer['username']} về việc tạo kênh (lần {attempt+1}/3): {type(e).__name__}: {str(e)}")
-                if attempt == 2:
-                    log_event(f"Bỏ qua thông báo tạo kênh cho {peer['username']} sau 3 lần thất bại")
+        if deliver_notification(peer, notification):
+            log_event("Thông báo %s về việc tạo kênh: %s", peer['username'], channel, level=DEBUG)
 
 def notify_livestream_start(channel, username, target_peers):
     message = f"{username} bắt đầu livestream trong {channel}"
+    notification = {
+        "type": "livestream_start",
+        "channel": channel,
+        "message": message,
+        "username": username,
+        "target_peers": target_peers  # Chuyển tiếp danh sách target_peers
+    }
+    log_message(channel, message, username, deleted=False)
     for peer in tracker.get_peers():
         if not peer['online']:
-            log_event(f"Bỏ qua thông báo bắt đầu livestream cho peer offline {peer['username']}")
+            log_event("Bỏ qua thông báo bắt đầu livestream cho peer offline %s", peer['username'], level=DEBUG)
             continue
-        for attempt in range(3):
-            try:
-                s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                s.settimeout(5)
-                s.connect((peer['ip'], peer['port']))
-                notification = json.dumps({
-                    "type": "livestream_start",
-                    "channel": channel,
-                    "message": message,
-                    "username": username,
-                    "target_peers": target_peers  # Chuyển tiếp danh sách target_peers
-                })
-                s.sendall((notification + '\n').encode('utf-8'))
-                s.close()
-                log_message(channel, message, username, deleted=False)
-                log_event(f"Thông báo {peer['username']} về livestream bắt đầu trong {channel}")
-                break
-            except Exception as e:
-                log_event(f"Không thể thông báo {peer['username']} về livestream bắt đầu (lần {attempt+1}/3): {type(e).__name__}: {str(e)}")
-                if attempt == 2:
-                    log_event(f"Bỏ qua thông báo livestream bắt đầu cho {peer['username']} sau 3 lần thất bại")
+        if deliver_notification(peer, notification):
+            log_event("Thông báo %s về livestream bắt đầu trong %s", peer['username'], channel, level=DEBUG)
 
 def notify_livestream_stop(channel, username):
     message = f"{username} dừng livestream trong {channel}"
+    notification = {
+        "type": "livestream_stop",
+        "channel": channel,
+        "message": message,
+        "username": username
+    }
+    log_message(channel, message, username, deleted=False)
     for peer in tracker.get_peers():
         if not peer['online']:
-            log_event(f"Bỏ qua thông báo dừng livestream cho peer offline {peer['username']}")
+            log_event("Bỏ qua thông báo dừng livestream cho peer offline %s", peer['username'], level=DEBUG)
             continue
-        for attempt in range(3):
-            try:
-                s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                s.settimeout(5)
-                s.connect((peer['ip'], peer['port']))
-                notification = json.dumps({
-                    "type": "livestream_stop",
-                    "channel": channel,
-                    "message": message,
-                    "username": username
-                })
-                s.sendall((notification + '\n').encode('utf-8'))
-                s.close()
-                log_message(channel, message, username, deleted=False)
-                log_event(f"Thông báo {peer['username']} về livestream dừng trong {channel}")
-                break
-            except Exception as e:
-                log_event(f"Không thể thông báo {peer['username']} về livestream dừng (lần {attempt+1}/3): {type(e).__name__}: {str(e)}")
-                if attempt == 2:
-                    log_event(f"Bỏ qua thông báo livestream dừng cho {peer['username']} sau 3 lần thất bại")
+        if deliver_notification(peer, notification):
+            log_event("Thông báo %s về livestream dừng trong %s", peer['username'], channel, level=DEBUG)
 
 def notify_new_primary_streamer(channel, primary_username):
     message = f"[SYSTEM] {primary_username} là peer chính livestream trong {channel}"
+    notification = {
+        "type": "new_primary_streamer",
+        "channel": channel,
+        "message": message,
+        "primary_username": primary_username
+    }
+    log_message(channel, message, "system", deleted=False)
     for peer in tracker.get_peers():
         if not peer['online']:
-            log_event(f"Bỏ qua thông báo peer chính cho peer offline {peer['username']}")
+            log_event("Bỏ qua thông báo peer chính cho peer offline %s", peer['username'], level=DEBUG)
             continue
-        for attempt in range(3):
-            try:
-                s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                s.settimeout(5)
-                s.connect((peer['ip'], peer['port']))
-                notification = json.dumps({
-                    "type": "new_primary_streamer",
-                    "channel": channel,
-                    "message": message,
-                    "primary_username": primary_username
-                })
-                s.sendall((notification + '\n').encode('utf-8'))
-                s.close()
-                log_message(channel, message, "system", deleted=False)
-                log_event(f"Thông báo {peer['username']} về peer chính mới: {primary_username}")
-                break
-            except Exception as e:
-                log_event(f"Không thể thông báo {peer['username']} về peer chính mới (lần {attempt+1}/3): {type(e).__name__}: {str(e)}")
-                if attempt == 2:
-                    log_event(f"Bỏ qua thông báo peer chính mới cho {peer['username']} sau 3 lần thất bại")
+        if deliver_notification(peer, notification):
+            log_event("Thông báo %s về peer chính mới: %s", peer['username'], primary_username, level=DEBUG)
 
-def start_server():
+def prepare_server():
+    """Khởi tạo database, channel_storage và API dùng chung cho cả hai chế độ server."""
     global api_started
     init_db()
     # Khởi tạo channel_storage từ database
-    from database import get_channels
-    for channel in get_channels():
+    for channel in channel_registry.names():
         if channel not in channel_storage:
             channel_storage[channel] = {'messages': [], 'creator': None}
     if "general" not in channel_storage:
         channel_storage["general"] = {'messages': [], 'creator': None}
-    
+
+    threading.Thread(target=expire_peers_loop, name="lease-expiry", daemon=True).start()
+
     if not api_started:
         try:
             threading.Thread(
@@ -431,6 +590,8 @@ def start_server():
             print(f"[API ERROR] Không thể khởi động API: {type(e).__name__}: {str(e)}")
             log_event(f"Không thể khởi động API: {e}")
 
+def start_server():
+    prepare_server()
     with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
         try:
             s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
@@ -446,4 +607,8 @@ def start_server():
             log_event(f"Không thể khởi động server: {e}")
 
 if __name__ == "__main__":
-    start_server()
\ No newline at end of file
+    if "--async" in sys.argv:
+        from async_server import start_async_server
+        start_async_server()
+    else:
+        start_server()
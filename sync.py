@@ -1,10 +1,12 @@
 import json
+import hashlib
 import threading
 import time
-import socket
+import os
 from utils import log_event
 from message_log import log_message
-from database import save_message, get_messages
+from database import save_message_batch, get_latest_messages
+from channel_cache import channel_registry
 from datetime import datetime
 
 unsynced_content = {}
@@ -17,6 +19,10 @@ peer_status = {
 }
 channel_storage = {"general": {'messages': [], 'creator': None}}
 app = None
+SYNC_CURSOR_FILE = "sync_cursors_{scope}.json"  # Mỗi (server, người dùng) một file con trỏ đồng bộ {kênh: id tin nhắn cuối}
+SYNC_BATCH_SIZE = 1000  # Số tin nhắn tối đa trong một yêu cầu sync_upload_batch
+HISTORY_PAGE_SIZE = 200  # Số tin nhắn trong một trang lịch sử tải khi cuộn lên
+SYNC_TIMEOUT = 20  # Thời gian chờ (giây) phản hồi của một yêu cầu đồng bộ
 
 def add_unsynced_content(channel, message):
     if not isinstance(channel, str) or not channel.strip():
@@ -30,103 +36,225 @@ def add_unsynced_content(channel, message):
         log_event(f"Thêm tin nhắn chưa đồng bộ vào kênh {channel}: {message}")
         # Đảm bảo kênh tồn tại trong channel_storage và database
         if channel not in channel_storage:
-            from database import create_channel
-            create_channel(channel, app.USERNAME if app and hasattr(app, 'USERNAME') else "system")
+            if not channel_registry.contains(channel):
+                channel_registry.create(channel, app.USERNAME if app and hasattr(app, 'USERNAME') else "system")
             channel_storage[channel] = {'messages': [], 'creator': app.USERNAME if app else None}
 
-def sync_to_server(server_socket):
-    for channel, messages in list(unsynced_content.items()):
-        for msg in messages:
-            request_id = str(app.request_counter) if app and hasattr(app, 'request_counter') else "unknown"
-            data = {"type": "sync_upload", "channel": channel, "message": msg, "request_id": request_id}
-            if app and hasattr(app, 'request_counter'):
-                app.request_counter += 1
-            try:
-                timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                sender = app.USERNAME if app and hasattr(app, 'USERNAME') else "system"
-                save_message(channel, sender, msg, timestamp)
-                
-                server_socket.sendall((json.dumps(data) + '\n').encode('utf-8'))
-                server_socket.settimeout(5)
-                response = server_socket.recv(1024).decode('utf-8').strip()
-                
-                log_event(f"Đồng bộ tin nhắn lên server: {msg} trong kênh {channel}, phản hồi: {response}")
+def sync_to_server(server_conn):
+    pending = [(channel, msg) for channel, messages in unsynced_content.items() for msg in messages]
+    sender = app.USERNAME if app and hasattr(app, 'USERNAME') else "system"
+    for start in range(0, len(pending), SYNC_BATCH_SIZE):
+        batch = pending[start:start + SYNC_BATCH_SIZE]
+        data = {
+            "type": "sync_upload_batch",
+            "username": sender,
+            "messages": [{"channel": channel, "message": msg} for channel, msg in batch]
+        }
+        try:
+            response_data = server_conn.request(data)
+            if "error" in response_data:
+                raise ValueError(response_data["error"])
+            timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            save_message_batch([(channel, sender, msg, timestamp) for channel, msg in batch], creator=sender)
+            channel_registry.add(channel for channel, _ in batch)
+            log_event(f"Đồng bộ lô {len(batch)} tin nhắn lên server, phản hồi: {response_data}")
+            uploaded = {}
+            for channel, msg in batch:
                 log_message(channel, msg, sender, deleted=False)
-                server_socket.settimeout(None)
-            except Exception as e:
-                print(f"[SYNC ERROR] Không thể đồng bộ {channel}: {type(e).__name__}: {str(e)}")
-                log_event(f"Không thể đồng bộ tin nhắn: {msg} trong kênh {channel}: {e}")
-                return False
+                uploaded[channel] = uploaded.get(channel, 0) + 1
+            # Lô được lấy theo thứ tự nên các tin đã tải lên luôn nằm ở đầu danh sách của mỗi kênh
+            for channel, count in uploaded.items():
+                del unsynced_content[channel][:count]
+        except Exception as e:
+            print(f"[SYNC ERROR] Không thể đồng bộ lô tin nhắn: {type(e).__name__}: {str(e)}")
+            log_event(f"Không thể đồng bộ lô {len(batch)} tin nhắn: {e}")
+            return False
+    for channel in unsynced_content:
         channel_sync_status[channel] = True
     unsynced_content.clear()
     print("[SYNC] Tất cả nội dung chưa đồng bộ đã được tải lên.")
     return True
 
-def sync_from_server(server_socket, channel, retries=3):
+def sync_cursor_path(server, username):
+    """File con trỏ của một (server, người dùng); tên được băm để dùng được mọi ký tự trong tên người dùng."""
+    scope = hashlib.sha256(f"{server}/{username}".encode('utf-8')).hexdigest()[:16]
+    return SYNC_CURSOR_FILE.format(scope=scope)
+
+def load_sync_cursors(path):
+    """Đọc con trỏ đồng bộ và trạng thái trang lịch sử của từng kênh từ file."""
+    try:
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            if "cursors" not in data:
+                # File cũ chỉ chứa {kênh: con trỏ}
+                data = {"cursors": data, "history": {}}
+            return ({channel: int(cursor) for channel, cursor in data["cursors"].items()},
+                    data.get("history", {}))
+    except Exception as e:
+        log_event(f"Lỗi khi đọc con trỏ đồng bộ từ {path}: {type(e).__name__}: {str(e)}")
+    return {}, {}
+
+def save_sync_cursors():
+    if sync_cursor_file is None:
+        return
+    try:
+        with open(sync_cursor_file, 'w', encoding='utf-8') as f:
+            json.dump({"cursors": sync_cursors, "history": history_pages}, f)
+    except Exception as e:
+        log_event(f"Lỗi khi lưu con trỏ đồng bộ vào {sync_cursor_file}: {type(e).__name__}: {str(e)}")
+
+def use_sync_scope(server, username):
+    """Nạp con trỏ đồng bộ của (server, người dùng) khi đăng nhập.
+
+    Con trỏ của server hoặc người dùng khác không bao giờ được dùng lại, nên không có tin nhắn bị bỏ sót.
+    """
+    global sync_cursor_file
+    sync_cursor_file = sync_cursor_path(server, username)
+    cursors, history = load_sync_cursors(sync_cursor_file)
+    sync_cursors.clear()
+    sync_cursors.update(cursors)
+    history_pages.clear()
+    history_pages.update(history)
+    log_event(f"Dùng con trỏ đồng bộ của {username} trên {server} ({sync_cursor_file}, {len(sync_cursors)} kênh)")
+
+# history_pages: {kênh: {"oldest": id tin nhắn cũ nhất đã tải, "has_more": còn trang cũ hơn trên server}}
+# Rỗng và không được lưu cho đến khi use_sync_scope chọn (server, người dùng)
+sync_cursors, history_pages = {}, {}
+sync_cursor_file = None
+
+def local_channel_messages(channel):
+    messages = [f"{msg['sender']}: {msg['message']} [{msg['timestamp']}]" for msg in get_latest_messages(channel, HISTORY_PAGE_SIZE, active_only=True)]
+    log_event(f"Lấy {len(messages)} tin nhắn cục bộ từ database cho kênh {channel}")
+    return messages
+
+def request_server(server_conn, request):
+    """Gửi một yêu cầu đến server và trả về phản hồi JSON đã giải mã (request_id do kết nối cấp)."""
+    return server_conn.request(request, timeout=SYNC_TIMEOUT)
+
+def history_request(channel, before=None, limit=HISTORY_PAGE_SIZE):
+    return {"type": "get_history", "channel": channel, "before": before, "limit": limit}
+
+def fetch_history_page(server_conn, channel, before=None, limit=HISTORY_PAGE_SIZE):
+    """Lấy một trang tin nhắn cũ hơn id before (None: trang mới nhất) và cập nhật trạng thái trang của kênh."""
+    return apply_history_page(channel, before, request_server(server_conn, history_request(channel, before, limit)))
+
+def apply_history_page(channel, before, page):
+    if not isinstance(page, dict) or not isinstance(page.get("messages"), list):
+        raise ValueError(f"Kỳ vọng trang lịch sử, nhận được: {page}")
+    history_pages[channel] = {"oldest": page.get("oldest_id"), "has_more": bool(page.get("has_more"))}
+    if before is None:
+        sync_cursors[channel] = int(page.get("newest_id") or 0)
+    save_sync_cursors()
+    log_event(f"Lấy trang {len(page['messages'])} tin nhắn cũ hơn id {before} cho kênh {channel}")
+    return page["messages"]
+
+def has_older_messages(channel):
+    return history_pages.get(channel, {}).get("has_more", False)
+
+def fetch_older_messages(server_conn, channel):
+    """Tải trang tin nhắn cũ hơn trang cũ nhất đã có; trả về [] khi đã hết hoặc lỗi."""
+    if not has_older_messages(channel):
+        return []
+    try:
+        return fetch_history_page(server_conn, channel, before=history_pages[channel].get("oldest"))
+    except Exception as e:
+        print(f"[SYNC ERROR] Không thể tải tin nhắn cũ của kênh {channel}: {type(e).__name__}: {str(e)}")
+        log_event(f"Không thể tải tin nhắn cũ của kênh {channel}: {e}")
+        return []
+
+def download_since(server_conn, channel, since, first_page=None):
+    """Tải các tin nhắn mới hơn con trỏ theo từng trang có giới hạn cho đến khi hết.
+
+    first_page là phản hồi đã nhận sẵn cho trang đầu (khi yêu cầu được gửi trước bởi sync_channels).
+    """
+    messages = []
+    while True:
+        if first_page is not None:
+            server_data, first_page = first_page, None
+        else:
+            server_data = request_server(server_conn, {"type": "sync_download", "channel": channel, "since": since})
+        if server_data is None:
+            return None
+        if isinstance(server_data, list):
+            # Server cũ không hỗ trợ con trỏ: nhận toàn bộ lịch sử
+            return server_data
+        if not isinstance(server_data, dict) or not isinstance(server_data.get("messages"), list):
+            log_event(f"Kỳ vọng danh sách tin nhắn, nhận được: {server_data}")
+            raise ValueError(f"Kỳ vọng danh sách tin nhắn, nhận được: {server_data}")
+        messages.extend(server_data["messages"])
+        since = int(server_data.get("cursor", since))
+        sync_cursors[channel] = since
+        save_sync_cursors()
+        if not server_data.get("has_more"):
+            return messages
+
+def sync_from_server(server_conn, channel, retries=3, full=False):
+    """Lấy các tin nhắn mới của kênh kể từ con trỏ đã lưu, theo thứ tự server cấp.
+
+    Với full=True (hoặc kênh chưa có con trỏ) chỉ trang mới nhất được tải; các trang
+    cũ hơn được tải dần bằng fetch_older_messages. Khi không liên lạc được server,
+    trả về tin nhắn trong database cục bộ.
+    """
     if not isinstance(channel, str) or not channel.strip():
         log_event(f"Kênh không hợp lệ trong sync_from_server: {channel}")
         return []
-    
-    # Lấy tin nhắn cục bộ từ database trước
-    local_messages = [f"{msg['sender']}: {msg['message']} [{msg['timestamp']}]" for msg in get_messages(channel)]
-    log_event(f"Lấy {len(local_messages)} tin nhắn cục bộ từ database cho kênh {channel}")
+    since = None if full else sync_cursors.get(channel)
 
     for attempt in range(retries):
         try:
-            server_socket.settimeout(0.1)
-            while True:
-                try:
-                    server_socket.recv(4096)
-                except socket.timeout:
-                    break
-            server_socket.settimeout(20)
-            
-            request_id = str(app.request_counter) if app and hasattr(app, 'request_counter') else "unknown"
-            request = {"type": "sync_download", "channel": channel, "request_id": request_id}
-            if app and hasattr(app, 'request_counter'):
-                app.request_counter += 1
-            server_socket.sendall((json.dumps(request) + '\n').encode('utf-8'))
-            
-            response = ""
-            while True:
-                chunk = server_socket.recv(8192).decode('utf-8')
-                if not chunk:
-                    break
-                response += chunk
-                if '\n' in response:
-                    response = response.split('\n')[0]
-                    break
-            if not response:
+            if since is None:
+                server_messages = fetch_history_page(server_conn, channel)
+            else:
+                server_messages = download_since(server_conn, channel, since)
+            if server_messages is None:
                 log_event(f"Không có phản hồi từ server cho kênh {channel}, lần thử {attempt+1}, trả về tin nhắn cục bộ")
-                return local_messages
-            
-            try:
-                server_messages = json.loads(response)
-            except json.JSONDecodeError as e:
-                log_event(f"Phản hồi JSON không hợp lệ cho kênh {channel}: {response}, lỗi: {e}")
-                raise ValueError(f"Phản hồi JSON không hợp lệ: {e}")
+                return local_channel_messages(channel)
             
-            if not isinstance(server_messages, list):
-                log_event(f"Kỳ vọng danh sách tin nhắn, nhận được: {server_messages}")
-                raise ValueError(f"Kỳ vọng danh sách tin nhắn, nhận được: {server_messages}")
-            
-            # Lọc tin nhắn để đảm bảo chỉ thuộc về kênh yêu cầu
-            filtered_messages = [msg for msg in server_messages]
-            log_event(f"Lấy {len(filtered_messages)} tin nhắn từ server cho kênh {channel}")
-            print(f"[SYNC] Lấy nội dung từ server cho {channel}: {filtered_messages}")
-            all_messages = list(set(local_messages + filtered_messages))
-            server_socket.settimeout(None)
-            log_event(f"Kết hợp {len(all_messages)} tin nhắn cho kênh {channel}")
-            return all_messages
+            log_event(f"Lấy {len(server_messages)} tin nhắn mới (từ id {since}) từ server cho kênh {channel}")
+            print(f"[SYNC] Lấy {len(server_messages)} tin nhắn mới từ server cho {channel}")
+            return server_messages
         except Exception as e:
             print(f"[SYNC ERROR] Không thể lấy nội dung kênh (lần thử {attempt+1}/{retries}): {type(e).__name__}: {str(e)}")
             log_event(f"Không thể lấy nội dung cho kênh {channel}: {e}")
             if attempt == retries - 1:
                 log_event(f"Không thể đồng bộ kênh {channel}, trả về tin nhắn cục bộ")
-                return local_messages
+                return local_channel_messages(channel)
             time.sleep(1)
-    server_socket.settimeout(None)
-    return local_messages
+    return local_channel_messages(channel)
+
+def sync_channels(server_conn, channels, full_channels=()):
+    """Đồng bộ nhiều kênh: gửi yêu cầu trang đầu của mọi kênh liền một lượt rồi mới chờ phản hồi.
+
+    Các yêu cầu đi nối tiếp trên cùng kết nối nên tổng thời gian gần bằng một vòng
+    khứ hồi thay vì một vòng cho mỗi kênh. Kênh nào lỗi thì thử lại bằng sync_from_server.
+    Trả về {kênh: danh sách tin nhắn}.
+    """
+    submitted = []
+    for channel in channels:
+        full = channel in full_channels
+        since = None if full else sync_cursors.get(channel)
+        request = history_request(channel) if since is None else {"type": "sync_download", "channel": channel, "since": since}
+        try:
+            submitted.append((channel, full, since, server_conn.submit(request)))
+        except Exception as e:
+            log_event(f"Không thể gửi yêu cầu đồng bộ kênh {channel}: {type(e).__name__}: {str(e)}")
+            submitted.append((channel, full, since, None))
+    results = {}
+    for channel, full, since, future in submitted:
+        try:
+            if future is None:
+                raise ConnectionError("Yêu cầu chưa được gửi")
+            reply = future.result(SYNC_TIMEOUT)
+            if since is None:
+                results[channel] = apply_history_page(channel, None, reply)
+            else:
+                results[channel] = download_since(server_conn, channel, since, first_page=reply)
+        except Exception as e:
+            log_event(f"Đồng bộ kênh {channel} theo lô thất bại, thử lại riêng: {type(e).__name__}: {str(e)}")
+            results[channel] = sync_from_server(server_conn, channel, full=full)
+    log_event(f"Đồng bộ {len(channels)} kênh trong một lượt yêu cầu")
+    return results
 
 def go_offline():
     peer_status["online"] = False
@@ -134,12 +262,12 @@ def go_offline():
     print("[STATUS] Peer hiện đang offline.")
     log_event("Peer đã offline")
 
-def go_online(server_socket):
+def go_online(server_conn):
     peer_status["online"] = True
     peer_status["invisible"] = False
     print("[STATUS] Peer hiện đang online. Đang đồng bộ nội dung lưu trữ...")
     log_event("Peer đã online")
-    sync_to_server(server_socket)
+    sync_to_server(server_conn)
 
 def go_invisible():
     peer_status["invisible"] = True
@@ -0,0 +1,46 @@
+import os
+import tempfile
+import unittest
+import message_log
+from message_log import MessageLog
+
+class RecoverTailTest(unittest.TestCase):
+    def setUp(self):
+        self.log_event = message_log.log_event
+        message_log.log_event = lambda *args, **kwargs: None
+        self.directory = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        message_log.log_event = self.log_event
+        self.directory.cleanup()
+
+    def test_partial_record_longer_than_chunk_keeps_complete_records(self):
+        log = MessageLog(directory=self.directory.name)
+        for i in range(3):
+            log.append("general", f"tin nhắn {i}", "user")
+        self.assertTrue(log.flush())
+        log._close()
+        # Tiến trình dừng giữa lúc ghi một bản ghi lớn hơn một khối đọc ngược
+        with open(os.path.join(self.directory.name, "00000000.log"), "ab") as f:
+            f.write(b'{"ts": 1, "message": "' + b"x" * (3 * message_log.RECOVER_CHUNK))
+
+        recovered = MessageLog(directory=self.directory.name)
+        recovered.append("general", "sau khi khởi động lại", "user")
+        self.assertTrue(recovered.flush())
+        messages = [record["message"] for record in recovered.read()]
+        recovered._close()
+        self.assertEqual(messages, ["tin nhắn 0", "tin nhắn 1", "tin nhắn 2", "sau khi khởi động lại"])
+
+    def test_file_without_newline_is_truncated(self):
+        os.makedirs(self.directory.name, exist_ok=True)
+        with open(os.path.join(self.directory.name, "00000000.log"), "wb") as f:
+            f.write('{"ts": 1, "message": "dở'.encode('utf-8'))
+        log = MessageLog(directory=self.directory.name)
+        log.append("general", "mới", "user")
+        self.assertTrue(log.flush())
+        messages = [record["message"] for record in log.read()]
+        log._close()
+        self.assertEqual(messages, ["mới"])
+
+if __name__ == "__main__":
+    unittest.main()
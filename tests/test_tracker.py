@@ -0,0 +1,60 @@
+import time
+import unittest
+import tracker as tracker_module
+from tracker import Tracker
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+class ExpireBatchTest(unittest.TestCase):
+    def setUp(self):
+        self.log_event = tracker_module.log_event
+        tracker_module.log_event = lambda *args, **kwargs: None
+
+    def tearDown(self):
+        tracker_module.log_event = self.log_event
+
+    def expire_all(self, count):
+        """Hết hạn count peer trong một tick; trả về (các lần gọi listener, thời gian)."""
+        clock = FakeClock()
+        tracker = Tracker(lease_seconds=10, clock=clock)
+        for i in range(count):
+            tracker.add_peer(f"10.0.{i // 256}.{i % 256}", 6000, f"user{i}", "s")
+        calls = []
+
+        def listener(from_version, version, changes):
+            # Giống server.notify_peer_delta: dựng danh sách người nhận cho mỗi lần gọi
+            calls.append((from_version, version, len(changes), len(tracker.get_peers())))
+
+        tracker.listener = listener
+        clock.now += 60
+        start = time.perf_counter()
+        expired = tracker.expire_leases()
+        elapsed = time.perf_counter() - start
+        self.assertEqual(len(expired), count)
+        return calls, elapsed
+
+    def test_expire_sends_one_batch(self):
+        calls, _ = self.expire_all(500)
+        self.assertEqual(calls, [(500, 1000, 500, 0)])
+
+    def test_expire_cost_is_not_quadratic(self):
+        _, small = min((self.expire_all(2000) for _ in range(3)), key=lambda result: result[1])
+        _, large = min((self.expire_all(8000) for _ in range(3)), key=lambda result: result[1])
+        # Gấp 4 lần số peer: tuyến tính ~4x, bậc hai ~16x
+        self.assertLess(large / small, 10)
+
+    def test_nested_operations_publish_once(self):
+        tracker = Tracker()
+        calls = []
+        tracker.listener = lambda from_version, version, changes: calls.append([change["op"] for change in changes])
+        tracker.add_peer("10.0.0.1", 6000, "a", "s1")
+        tracker.replace_peer("10.0.0.1", 6000, "a", "s2")
+        self.assertEqual(calls, [["add"], ["remove", "add"]])
+
+if __name__ == "__main__":
+    unittest.main()
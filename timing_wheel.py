@@ -0,0 +1,52 @@
+import time
+
+class TimingWheel:
+    """Bánh xe thời gian băm (hashed timing wheel) cho các hạn chót có thể gia hạn.
+
+    Mỗi khóa nằm trong đúng một ô, chọn theo tick hết hạn modulo số ô. Đặt lịch,
+    gia hạn và hủy đều O(1); mỗi tick chỉ duyệt các khóa trong ô của tick đó, nên chi
+    phí xử lý hết hạn tỉ lệ với số khóa thật sự hết hạn chứ không với tổng số khóa.
+    Khóa có hạn xa hơn một vòng bánh xe được giữ lại trong ô cho đến vòng của nó.
+    Lớp này không tự khóa; bên sở hữu chịu trách nhiệm đồng bộ.
+    """
+    def __init__(self, tick=1.0, slots=512, clock=time.monotonic):
+        self.tick = tick
+        self.slots = [set() for _ in range(slots)]
+        self.deadlines = {}  # {khóa: tick hết hạn}
+        self.clock = clock
+        self.current = self._tick_of(clock())
+
+    def _tick_of(self, now):
+        return int(now / self.tick)
+
+    def schedule(self, key, delay):
+        """Đặt (hoặc gia hạn) hạn chót của key sau delay giây."""
+        self.cancel(key)
+        # Làm tròn lên để không bao giờ hết hạn sớm hơn delay
+        deadline = max(self._tick_of(self.clock() + delay) + 1, self.current + 1)
+        self.deadlines[key] = deadline
+        self.slots[deadline % len(self.slots)].add(key)
+
+    def cancel(self, key):
+        deadline = self.deadlines.pop(key, None)
+        if deadline is not None:
+            self.slots[deadline % len(self.slots)].discard(key)
+
+    def advance(self, now=None):
+        """Xử lý các tick đã trôi qua, trả về danh sách khóa đã hết hạn."""
+        target = self._tick_of(self.clock() if now is None else now)
+        expired = []
+        # Chỉ cần duyệt tối đa một vòng: các tick xa hơn rơi lại vào cùng các ô
+        start = max(self.current + 1, target - len(self.slots) + 1)
+        for tick in range(start, target + 1):
+            slot = self.slots[tick % len(self.slots)]
+            due = [key for key in slot if self.deadlines[key] <= target]
+            for key in due:
+                slot.discard(key)
+                del self.deadlines[key]
+            expired.extend(due)
+        self.current = max(self.current, target)
+        return expired
+
+    def __len__(self):
+        return len(self.deadlines)
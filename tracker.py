@@ -1,12 +1,104 @@
 # tracker.py
 import threading
+import time
+import uuid
+from contextlib import contextmanager
+from collections import deque
+from itertools import islice
 from utils import log_event
+from codec import JSON_CODEC
+from timing_wheel import TimingWheel
 
-lock = threading.Lock()
+CHANGELOG_SIZE = 1024  # Số thay đổi gần nhất được giữ để trả về delta cho get_list
+LEASE_SECONDS = 45  # Peer không gửi submit_info/heartbeat trong khoảng này bị coi là đã rời đi
+LEASE_TICK = 1.0  # Độ phân giải (giây) của bánh xe thời gian hết hạn
 
 class Tracker:
-    def __init__(self):
-        self.peers = []
+    """Danh bạ peer đánh chỉ mục theo (ip, port) và theo username.
+
+    Mọi thao tác đọc/ghi đều giữ self.lock. Các dict peer được coi là bất biến:
+    cập nhật trạng thái thay bằng dict mới, nên danh sách peer hiển thị và bản
+    bản mã hóa của nó (theo từng codec) được dùng lại giữa các lần get_list và chỉ tạo lại sau khi có thay đổi.
+
+    Mỗi thay đổi của danh sách peer hiển thị tăng self.version và được ghi vào một
+    changelog có giới hạn, để client chỉ nhận phần chênh lệch kể từ phiên bản của mình.
+    epoch đổi sau mỗi lần khởi động server để client không dùng nhầm phiên bản cũ.
+
+    Mỗi peer có một lease được gia hạn bởi submit_info và heartbeat; expire_leases()
+    xóa các peer hết hạn (sự kiện remove với reason "expired").
+
+    Thay đổi được gom lại trong khi giữ khóa và chỉ được giao cho listener sau khi nhả
+    khóa, một lần cho mỗi thao tác công khai: expire_leases() hay replace_peer() gửi một
+    lô thay đổi duy nhất, nên listener dựng danh sách người nhận một lần cho cả lô.
+    """
+    def __init__(self, changelog_size=CHANGELOG_SIZE, lease_seconds=LEASE_SECONDS, clock=time.monotonic):
+        self.lock = threading.RLock()
+        self.by_addr = {}  # {(ip, port): peer_info}
+        self.by_username = {}  # {username: {(ip, port), ...}}
+        self.visible = None  # Danh sách peer không ẩn danh, tạo lại khi có thay đổi
+        self.visible_count = 0  # Số peer không ẩn danh, cập nhật theo từng thay đổi
+        self.visible_payload = {}  # {tên codec: bytes của self.visible}
+        self.snapshot_payload = {}  # {tên codec: bytes của ảnh chụp có phiên bản}
+        self.epoch = uuid.uuid4().hex[:12]
+        self.version = 0
+        self.changelog = deque(maxlen=changelog_size)  # [(phiên bản, thay đổi)]
+        self.listener = None  # Gọi listener(from_version, version, [thay đổi]) sau mỗi thao tác, ngoài khóa
+        self.pending = []  # Thay đổi chưa giao cho listener
+        self.pending_from = 0  # Phiên bản trước thay đổi đầu tiên trong self.pending
+        self.depth = 0  # Số thao tác thay đổi lồng nhau đang chạy; chỉ thao tác ngoài cùng giao lô
+        self.publish_lock = threading.Lock()  # Giữ thứ tự các lô giữa các thread
+        self.lease_seconds = lease_seconds
+        self.leases = TimingWheel(tick=LEASE_TICK, clock=clock)
+
+    @property
+    def peers(self):
+        with self.lock:
+            return list(self.by_addr.values())
+
+    def _changed(self, op=None, peer=None, reason=None):
+        self.visible = None
+        self.visible_payload = {}
+        self.snapshot_payload = {}
+        if op is None:
+            return
+        self.version += 1
+        if op == "remove":
+            peer = {'ip': peer['ip'], 'port': peer['port'], 'username': peer['username']}
+        change = {"op": op, "peer": peer}
+        if reason:
+            change["reason"] = reason
+        self.changelog.append((self.version, change))
+        if not self.pending:
+            self.pending_from = self.version - 1
+        self.pending.append(change)
+
+    @contextmanager
+    def _mutation(self):
+        """Giữ khóa trong một thao tác thay đổi; khi thao tác ngoài cùng kết thúc, giao lô thay đổi sau khi nhả khóa."""
+        with self.lock:
+            self.depth += 1
+            try:
+                yield
+            finally:
+                self.depth -= 1
+                outermost = self.depth == 0
+        # Thao tác lồng nhau (remove_peer trong expire_leases) để thao tác ngoài cùng giao cả lô;
+        # _publish không bao giờ được gọi khi còn giữ self.lock
+        if outermost:
+            self._publish()
+
+    def _publish(self):
+        with self.publish_lock:
+            with self.lock:
+                if not self.pending:
+                    return
+                changes, self.pending = self.pending, []
+                from_version, version = self.pending_from, self.version
+            if self.listener:
+                try:
+                    self.listener(from_version, version, changes)
+                except Exception as e:
+                    log_event(f"Lỗi gửi thay đổi danh bạ peer: {type(e).__name__}: {str(e)}")
 
     def add_peer(self, ip, port, username, session_id, visitor=False, invisible=False, online=True):
         peer_info = {
@@ -18,25 +110,130 @@ class Tracker:
             'invisible': invisible,
             'online': online
         }
-        if not self.peer_exists(ip, port):
-            self.peers.append(peer_info)
-            log_event(f"Added peer: {peer_info}")
+        with self._mutation():
+            if (ip, port) in self.by_addr:
+                return
+            self.by_addr[(ip, port)] = peer_info
+            self.by_username.setdefault(username, set()).add((ip, port))
+            self.leases.schedule((ip, port), self.lease_seconds)
+            if invisible:
+                self._changed()
+            else:
+                self.visible_count += 1
+                self._changed("add", peer_info)
+        log_event(f"Added peer: {peer_info}")
+
+    def remove_peer(self, ip, port, reason=None):
+        with self._mutation():
+            peer = self.by_addr.pop((ip, port), None)
+            if peer is None:
+                return
+            self.leases.cancel((ip, port))
+            keys = self.by_username.get(peer['username'])
+            if keys is not None:
+                keys.discard((ip, port))
+                if not keys:
+                    del self.by_username[peer['username']]
+            if peer['invisible']:
+                self._changed()
+            else:
+                self.visible_count -= 1
+                self._changed("remove", peer, reason)
+        log_event(f"Removed peer: IP={ip}, Port={port}" + (f", reason={reason}" if reason else ""))
+
+    def replace_peer(self, ip, port, username, session_id, visitor=False, invisible=False, online=True):
+        """Xóa peer cũ cùng địa chỉ (nếu có) và thêm peer mới trong cùng một lần giữ khóa."""
+        with self._mutation():
+            existed = self.peer_exists(ip, port)
+            self.remove_peer(ip, port)
+            self.add_peer(ip, port, username, session_id, visitor, invisible, online)
+        return existed
 
-    def remove_peer(self, ip, port):
-        self.peers = [peer for peer in self.peers if peer['ip'] != ip or peer['port'] != port]
-        log_event(f"Removed peer: IP={ip}, Port={port}")
+    def renew(self, ip, port):
+        """Gia hạn lease của peer. Trả về False nếu peer không còn trong tracker."""
+        with self.lock:
+            if (ip, port) not in self.by_addr:
+                return False
+            self.leases.schedule((ip, port), self.lease_seconds)
+            return True
+
+    def expire_leases(self, now=None):
+        """Xóa các peer có lease đã hết hạn, trả về danh sách peer bị xóa; listener nhận một lô cho cả tick."""
+        with self._mutation():
+            expired = [self.by_addr[key] for key in self.leases.advance(now) if key in self.by_addr]
+            for peer in expired:
+                self.remove_peer(peer['ip'], peer['port'], reason="expired")
+        return expired
 
     def peer_exists(self, ip, port):
-        return any(peer['ip'] == ip and peer['port'] == port for peer in self.peers)
+        with self.lock:
+            return (ip, port) in self.by_addr
+
+    def get_peer(self, ip, port):
+        with self.lock:
+            return self.by_addr.get((ip, port))
+
+    def find_by_username(self, username):
+        with self.lock:
+            return [self.by_addr[key] for key in self.by_username.get(username, ())]
 
     def update_peer_status(self, ip, port, online=True, invisible=False):
-        for peer in self.peers:
-            if peer['ip'] == ip and peer['port'] == port:
-                peer['online'] = online
-                peer['invisible'] = invisible
-                log_event(f"Updated peer status: IP={ip}, Port={port}, online={online}, invisible={invisible}")
-                break
+        with self._mutation():
+            peer = self.by_addr.get((ip, port))
+            if peer is None:
+                return
+            if peer['online'] != online or peer['invisible'] != invisible:
+                updated = dict(peer, online=online, invisible=invisible)
+                self.by_addr[(ip, port)] = updated
+                self.visible_count += int(peer['invisible']) - int(invisible)
+                if peer['invisible'] and invisible:
+                    self._changed()
+                elif invisible:
+                    self._changed("remove", peer)
+                else:
+                    self._changed("add" if peer['invisible'] else "update", updated)
+        log_event(f"Updated peer status: IP={ip}, Port={port}, online={online}, invisible={invisible}")
 
     def get_peers(self):
-        with lock:
-            return [peer for peer in self.peers if not peer['invisible']]
\ No newline at end of file
+        """Danh sách peer không ẩn danh. Danh sách được dùng chung giữa các lần gọi, không được sửa."""
+        with self.lock:
+            if self.visible is None:
+                self.visible = [peer for peer in self.by_addr.values() if not peer['invisible']]
+            return self.visible
+
+    def visible_peer_count(self):
+        """Số peer trong get_peers(), không phải dựng lại danh sách."""
+        with self.lock:
+            return self.visible_count
+
+    def get_peers_payload(self, codec=JSON_CODEC):
+        """get_peers() đã mã hóa bằng codec, chỉ tuần tự hóa lại sau khi danh bạ thay đổi."""
+        with self.lock:
+            payload = self.visible_payload.get(codec.name)
+            if payload is None:
+                payload = self.visible_payload[codec.name] = codec.encode(self.get_peers())
+            return payload
+
+    def get_delta_payload(self, since_version, epoch=None, codec=JSON_CODEC):
+        """(payload, dùng chung): các thay đổi kể từ since_version (đã mã hóa), hoặc ảnh chụp đầy đủ khi client quá cũ.
+
+        Ảnh chụp: {"epoch", "version", "peers": [...]}. Delta: {"epoch", "version", "changes": [...]}.
+        dùng chung là True chỉ với ảnh chụp (được giữ lại giữa các lần gọi); delta là bytes mới mỗi lần.
+        """
+        with self.lock:
+            oldest = self.changelog[0][0] if self.changelog else self.version + 1
+            if epoch != self.epoch or since_version > self.version or since_version < oldest - 1:
+                return self._snapshot(codec), True
+            changes = [change for _, change in islice(self.changelog, since_version - oldest + 1, None)]
+            return codec.encode({"epoch": self.epoch, "version": self.version, "changes": changes}), False
+
+    def _snapshot(self, codec):
+        payload = self.snapshot_payload.get(codec.name)
+        if payload is None:
+            payload = self.snapshot_payload[codec.name] = codec.encode(
+                {"epoch": self.epoch, "version": self.version, "peers": self.get_peers()})
+        return payload
+
+    def __len__(self):
+        with self.lock:
+            return len(self.by_addr)
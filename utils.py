@@ -1,34 +1,209 @@
 import os
+import atexit
+import time
+import threading
+from collections import deque
 from datetime import datetime
 
 LOG_DIR = "logs"
 LOG_FILE = os.path.join(LOG_DIR, "server_log.txt")
+LOG_MAX_BYTES = 5 * 1024 * 1024  # Kích thước tối đa của một file log trước khi xoay vòng
+LOG_BACKUPS = 5  # Số file cũ được giữ: server_log.txt.1 ... server_log.txt.5
+LOG_QUEUE_SIZE = 20000  # Số bản ghi chờ ghi tối đa; vượt quá thì bản ghi mới bị bỏ và được đếm
+LOG_FLUSH_INTERVAL = 0.2  # Thời gian chờ tối đa (giây) trước khi ghi một lô xuống đĩa
+COUNTER_INTERVAL = 10.0  # Chu kỳ (giây) ghi một dòng tổng hợp của SampledCounter
 
-def log_event(message):
-    """Ghi sự kiện vào file log với dấu thời gian."""
-    if not os.path.exists(LOG_DIR):
-        os.makedirs(LOG_DIR)
-
-    try:
-        with open(LOG_FILE, "r", encoding='utf-8') as f:
-            lines = f.readlines()
-        if len(lines) >= 10000:
-            with open(LOG_FILE, "w", encoding='utf-8') as f:
-                f.write("")
-            lines = []
-    except FileNotFoundError:
-        lines = []
-    except UnicodeDecodeError as e:
-        error_msg = f"Không thể đọc file log do lỗi mã hóa: {type(e).__name__}: {str(e)}"
-        print(error_msg)
-        lines = []
-
-    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    try:
-        with open(LOG_FILE, "a", encoding='utf-8') as f:
-            f.write(f"[{timestamp}] {message}\n")
-    except UnicodeEncodeError as e:
-        error_msg = f"Không thể ghi thông điệp log do lỗi mã hóa: {type(e).__name__}: {str(e)}"
-        print(error_msg)
-    except Exception as e:
-        print(f"Lỗi ghi log: {type(e).__name__}: {str(e)}")
\ No newline at end of file
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+LEVEL_NAMES = {DEBUG: "DEBUG", INFO: "INFO", WARNING: "WARNING", ERROR: "ERROR"}
+log_level = INFO  # Các sự kiện có mức thấp hơn bị bỏ qua trước khi định dạng
+
+class LogWriter:
+    """Ghi log bằng một thread nền để log_event chỉ tốn O(1).
+
+    Bên gọi chỉ thêm dòng log vào hàng đợi có giới hạn; thread nền gom cả lô và ghi
+    một lần vào file đang mở sẵn, xoay vòng sang các file đánh số khi vượt
+    max_bytes. Khi hàng đợi đầy, bản ghi bị bỏ và số lượng được ghi lại trong log.
+    """
+    def __init__(self, path=LOG_FILE, max_bytes=LOG_MAX_BYTES, backups=LOG_BACKUPS, queue_size=LOG_QUEUE_SIZE):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.queue_size = queue_size
+        self.records = deque()
+        self.cond = threading.Condition()
+        self.thread = None
+        self.file = None
+        self.size = 0
+        self.writing = False
+        self.stats = {"written": 0, "dropped": 0, "rotations": 0, "errors": 0}
+        self.unreported_drops = 0
+
+    def write(self, line):
+        with self.cond:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name="log-writer", daemon=True)
+                self.thread.start()
+            if len(self.records) >= self.queue_size:
+                self.stats["dropped"] += 1
+                self.unreported_drops += 1
+                return False
+            self.records.append(line)
+            if len(self.records) == 1 or len(self.records) == self.queue_size // 2:
+                self.cond.notify_all()
+        return True
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while not self.records:
+                    self.cond.wait()
+                # Chờ thêm một chút để gom lô lớn hơn, trừ khi hàng đợi đã gần đầy
+                if len(self.records) < self.queue_size // 2:
+                    self.cond.wait(LOG_FLUSH_INTERVAL)
+                batch, self.records = self.records, deque()
+                dropped, self.unreported_drops = self.unreported_drops, 0
+                self.writing = True
+            if dropped:
+                batch.append(f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] Bỏ {dropped} bản ghi log do hàng đợi đầy\n")
+            self._write_batch(batch)
+            with self.cond:
+                self.writing = False
+                self.stats["written"] += len(batch)
+                self.cond.notify_all()
+
+    def _write_batch(self, batch):
+        data = "".join(batch).encode('utf-8', errors='replace')
+        try:
+            if self.file is None:
+                self._open()
+            self.file.write(data)
+            self.file.flush()
+            self.size += len(data)
+            if self.size >= self.max_bytes:
+                self._rotate()
+        except Exception as e:
+            self.stats["errors"] += 1
+            print(f"Lỗi ghi log: {type(e).__name__}: {str(e)}")
+            self._close()
+
+    def _open(self):
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        self.file = open(self.path, "ab")
+        self.size = self.file.tell()
+
+    def _close(self):
+        if self.file is not None:
+            try:
+                self.file.close()
+            except Exception:
+                pass
+            self.file = None
+
+    def _rotate(self):
+        """server_log.txt -> server_log.txt.1 -> ... -> server_log.txt.N (file cũ nhất bị xóa)."""
+        self._close()
+        for index in range(self.backups - 1, 0, -1):
+            source = f"{self.path}.{index}"
+            if os.path.exists(source):
+                os.replace(source, f"{self.path}.{index + 1}")
+        if self.backups > 0:
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.remove(self.path)
+        self.stats["rotations"] += 1
+        self._open()
+
+    def flush(self, timeout=5):
+        """Chờ cho đến khi mọi bản ghi trong hàng đợi đã được ghi xuống file."""
+        with self.cond:
+            if self.thread is None:
+                return True
+            self.cond.notify_all()
+            return self.cond.wait_for(lambda: not self.records and not self.writing, timeout)
+
+    def metrics(self):
+        with self.cond:
+            stats = dict(self.stats)
+            stats["queued"] = len(self.records)
+        return stats
+
+log_writer = LogWriter()
+atexit.register(log_writer.flush)
+
+_timestamp_cache = (0, "")  # (giây epoch, chuỗi thời gian đã định dạng)
+
+def _timestamp():
+    global _timestamp_cache
+    second = int(time.time())
+    if _timestamp_cache[0] != second:
+        _timestamp_cache = (second, datetime.fromtimestamp(second).strftime("%Y-%m-%d %H:%M:%S"))
+    return _timestamp_cache[1]
+
+def set_log_level(level):
+    global log_level
+    log_level = level
+
+def log_enabled(level):
+    return level >= log_level
+
+def log_event(message, *args, level=INFO):
+    """Ghi sự kiện vào file log với dấu thời gian (không chặn; việc ghi do thread nền đảm nhận).
+
+    Nếu có args, message được định dạng kiểu message % args và chỉ khi mức log được bật,
+    nên trên đường nóng nên truyền tham số thay vì f-string:
+    log_event("Nhận %d bytes từ %s", n, streamer, level=DEBUG).
+    """
+    if level < log_level:
+        return
+    if args:
+        try:
+            message = message % args
+        except (TypeError, ValueError) as e:
+            message = f"{message} {args} (lỗi định dạng: {e})"
+    if level == INFO:
+        log_writer.write(f"[{_timestamp()}] {message}\n")
+    else:
+        log_writer.write(f"[{_timestamp()}] [{LEVEL_NAMES.get(level, level)}] {message}\n")
+
+class SampledCounter:
+    """Bộ đếm cho vòng lặp nóng: cộng dồn sự kiện và chỉ ghi một dòng tổng hợp mỗi chu kỳ.
+
+    add() chỉ cộng vào dict và so sánh thời gian; dòng log được tạo tối đa một lần
+    mỗi interval giây (hoặc khi gọi flush(), ví dụ lúc kết thúc luồng).
+    """
+    def __init__(self, name, interval=COUNTER_INTERVAL, level=INFO):
+        self.name = name
+        self.interval = interval
+        self.level = level
+        self.lock = threading.Lock()
+        self.counts = {}
+        self.started = time.monotonic()
+
+    def add(self, key, amount=1):
+        now = time.monotonic()
+        with self.lock:
+            self.counts[key] = self.counts.get(key, 0) + amount
+            if now - self.started < self.interval:
+                return
+            counts, elapsed = self._take(now)
+        self._emit(counts, elapsed)
+
+    def flush(self):
+        with self.lock:
+            counts, elapsed = self._take(time.monotonic())
+        self._emit(counts, elapsed)
+
+    def _take(self, now):
+        counts, self.counts = self.counts, {}
+        elapsed, self.started = now - self.started, now
+        return counts, elapsed
+
+    def _emit(self, counts, elapsed):
+        if counts and log_enabled(self.level):
+            summary = ", ".join(f"{key}={value}" for key, value in counts.items())
+            log_event("%s: %s trong %.1fs", self.name, summary, elapsed, level=self.level)